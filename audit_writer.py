@@ -0,0 +1,199 @@
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import database
+
+# Sentinel that tells the writer thread to flush and exit
+_STOP = object()
+
+
+class AuditWriter:
+    """Write-behind queue that batches audit_logs inserts into group commits.
+
+    Requests enqueue audit entries and return immediately; a background
+    thread writes them with log_audit_many every flush_interval seconds or
+    every batch_size rows, whichever comes first. When the queue is full the
+    caller waits up to put_timeout and then writes synchronously itself, so
+    overload slows requests down instead of dropping audit rows. A batch
+    that stays locked is retried batch_retries times with backoff; after
+    that, or on any other error, its rows are written one at a time so only
+    the rows that still fail are lost (and counted in failed).
+    """
+
+    def __init__(self, flush_interval=0.05, batch_size=200, max_queue=10000, put_timeout=0.5,
+                 batch_retries=3, retry_backoff=0.5):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self.batch_retries = batch_retries
+        self.retry_backoff = retry_backoff
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.written = 0
+        self.batches = 0
+        self.sync_writes = 0
+        self.failed = 0
+
+    def submit(self, entry):
+        """Queue one audit entry (a dict with log_audit's keyword arguments)"""
+        self._ensure_started()
+        try:
+            self._queue.put(entry, timeout=self.put_timeout)
+        except queue.Full:
+            # Backpressure: the writer is saturated, write in the caller's thread
+            with self._lock:
+                self.sync_writes += 1
+            database.log_audit_many([entry])
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def flush(self, timeout=5.0):
+        """Block until everything queued so far has been written (or timeout)"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.005)
+        return not self._queue.unfinished_tasks
+
+    def shutdown(self, timeout=5.0):
+        """Flush pending entries and stop the writer thread"""
+        thread = self._thread
+        if thread is None or self._pid != os.getpid() or not thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logging.error('Audit writer queue still full at shutdown; pending entries may be lost')
+            return
+        thread.join(timeout)
+        self._thread = None
+
+    def stats(self):
+        return {
+            'queue_depth': self.depth(),
+            'written': self.written,
+            'batches': self.batches,
+            'sync_writes': self.sync_writes,
+            'failed': self.failed
+        }
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid:
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == pid:
+                return
+            if self._pid is not None and self._pid != pid:
+                # Forked child: the parent's thread and queue state did not survive
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self._queue.task_done()
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write(batch)
+        database.close_db()
+
+    def _write(self, batch):
+        try:
+            if self._write_batch(batch):
+                return
+            for entry in batch:
+                try:
+                    database.log_audit(**entry)
+                    self.written += 1
+                except Exception as e:
+                    self.failed += 1
+                    logging.error(f'Audit writer failed to write entry {entry!r}: {e}')
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write_batch(self, batch):
+        """Group-commit batch, retrying while the database stays locked; False if it never went in"""
+        attempt = 0
+        while True:
+            try:
+                database.log_audit_many(batch)
+            except Exception as e:
+                busy = isinstance(e, sqlite3.OperationalError) and database.is_busy_error(e)
+                if not busy or attempt >= self.batch_retries:
+                    logging.warning(f'Audit writer could not write a batch of {len(batch)} entries '
+                                    f'({e}); writing them one at a time')
+                    return False
+                time.sleep(self.retry_backoff * (2 ** attempt))
+                attempt += 1
+                continue
+            self.written += len(batch)
+            self.batches += 1
+            return True
+
+
+def _env_flag(name, default='false'):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes')
+
+
+WRITE_BEHIND_ENABLED = _env_flag('AUDIT_WRITE_BEHIND')
+
+writer = AuditWriter(
+    flush_interval=int(os.environ.get('AUDIT_FLUSH_MS', 50)) / 1000,
+    batch_size=int(os.environ.get('AUDIT_BATCH_SIZE', 200)),
+    max_queue=int(os.environ.get('AUDIT_QUEUE_SIZE', 10000))
+)
+atexit.register(writer.shutdown)
+
+
+def log_audit(user_id, username, action, resource=None, expression=None,
+              result=None, ip_address=None, user_agent=None, tenant_id=None):
+    """Log an audit event, through the write-behind queue when enabled"""
+    if not WRITE_BEHIND_ENABLED:
+        return database.log_audit(user_id, username, action, resource, expression,
+                                  result, ip_address, user_agent, tenant_id)
+    writer.submit({
+        'user_id': user_id,
+        'username': username,
+        'action': action,
+        'resource': resource,
+        'expression': expression,
+        'result': result,
+        'ip_address': ip_address,
+        'user_agent': user_agent,
+        'tenant_id': tenant_id
+    })
+
+
+def log_audit_many(entries):
+    """Log several audit events, through the write-behind queue when enabled"""
+    if not WRITE_BEHIND_ENABLED:
+        return database.log_audit_many(entries)
+    for entry in entries:
+        writer.submit(entry)
@@ -0,0 +1,214 @@
+"""Microbenchmarks for the Calculator engine.
+
+Usage:
+    python benchmarks/bench_calculator.py                      # run and print a table
+    python benchmarks/bench_calculator.py --save base.json     # also save a baseline
+    python benchmarks/bench_calculator.py --compare base.json  # diff against a baseline
+    python benchmarks/bench_calculator.py --workload nested --quick
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from calculator_engine import Calculator, ResultCache
+
+
+def keypad_expressions(rng, count):
+    """Short expressions like the ones typed on the calculator keypad"""
+    expressions = []
+    for _ in range(count):
+        terms = [str(rng.randint(0, 999)) for _ in range(rng.randint(2, 4))]
+        ops = [rng.choice('+-*/') for _ in range(len(terms) - 1)]
+        expression = terms[0]
+        for op, term in zip(ops, terms[1:]):
+            expression += op + term
+        expressions.append(expression)
+    return expressions
+
+
+def nested_expressions(rng, count, depth=40):
+    """Deeply nested parentheses: ((((1+2)*3)-4)...)"""
+    expressions = []
+    for _ in range(count):
+        expression = str(rng.randint(1, 9))
+        for _ in range(depth):
+            expression = f'({expression}{rng.choice("+-*")}{rng.randint(1, 9)})'
+        expressions.append(expression)
+    return expressions
+
+
+def chain_expressions(rng, count, length=200):
+    """Long flat operator chains: 1+2-3*4+..."""
+    expressions = []
+    for _ in range(count):
+        parts = [str(rng.randint(1, 99))]
+        for _ in range(length):
+            parts.append(rng.choice('+-*'))
+            parts.append(str(rng.randint(1, 99)))
+        expressions.append(''.join(parts))
+    return expressions
+
+
+def exponent_expressions(rng, count):
+    """Large integer powers (big-int arithmetic dominates)"""
+    return [f'{rng.randint(2, 9)}^{rng.randint(100, 2000)}' for _ in range(count)]
+
+
+def oversized_expressions(rng, count):
+    """Powers far beyond the evaluation budget (must be refused, not computed)"""
+    templates = ['{a}^{a}^{a}', '{b}^{b}', '-({b}^{b})', '{b}^{b}*{b}']
+    return [rng.choice(templates).format(a=rng.randint(7, 9), b=rng.randint(10000, 99999))
+            for _ in range(count)]
+
+
+def invalid_expressions(rng, count):
+    """Inputs the engine must reject: bad characters, dangling operators, unbalanced parens"""
+    templates = ['{a}++{b}', '({a}+{b}', '{a}+{b})', '{a} {b}', '{a}+x', '__import__("os")', '{a}*', '.']
+    return [rng.choice(templates).format(a=rng.randint(0, 99), b=rng.randint(0, 99))
+            for _ in range(count)]
+
+
+WORKLOADS = {
+    'keypad': keypad_expressions,
+    'nested': nested_expressions,
+    'chain': chain_expressions,
+    'exponent': exponent_expressions,
+    'oversized': oversized_expressions,
+    'invalid': invalid_expressions,
+}
+
+
+def _targets():
+    """Benchmarked callables: name -> factory returning a one-argument function"""
+    return {
+        'evaluate': lambda: Calculator().evaluate,
+        # Every expression is seen once per round, so after round one this is the hit path
+        'evaluate_cached': lambda: Calculator(cache=ResultCache()).evaluate,
+        'is_valid_expression': lambda: Calculator().is_valid_expression,
+    }
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(func, expressions, rounds):
+    """Time every call individually; returns per-call latencies in seconds"""
+    timer = time.perf_counter
+    latencies = []
+    append = latencies.append
+    for _ in range(rounds):
+        for expression in expressions:
+            start = timer()
+            func(expression)
+            append(timer() - start)
+    return latencies
+
+
+def measure_allocations(func, expressions):
+    """Mean peak traced memory (bytes) and net new blocks per call, via tracemalloc"""
+    peaks = []
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for expression in expressions:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            func(expression)
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    net_blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return statistics.mean(peaks), net_blocks / len(expressions)
+
+
+def run(workloads, targets, count, rounds, seed):
+    results = {}
+    for workload in workloads:
+        expressions = WORKLOADS[workload](random.Random(seed), count)
+        for target in targets:
+            func = _targets()[target]()
+            # Warm up (also fills the cache for evaluate_cached)
+            for expression in expressions:
+                func(expression)
+            latencies = sorted(measure(func, expressions, rounds))
+            total = sum(latencies)
+            peak_bytes, blocks = measure_allocations(func, expressions)
+            results[f'{workload}/{target}'] = {
+                'calls': len(latencies),
+                'ops_per_sec': len(latencies) / total if total else float('inf'),
+                'mean_us': statistics.mean(latencies) * 1e6,
+                'p50_us': percentile(latencies, 0.50) * 1e6,
+                'p95_us': percentile(latencies, 0.95) * 1e6,
+                'p99_us': percentile(latencies, 0.99) * 1e6,
+                'peak_alloc_bytes': peak_bytes,
+                'net_blocks_per_call': blocks,
+            }
+    return results
+
+
+def print_table(results, baseline=None):
+    header = f'{"benchmark":34} {"ops/sec":>12} {"p50 us":>9} {"p95 us":>9} {"p99 us":>9} {"peak B":>9}'
+    if baseline:
+        header += f' {"vs base":>9}'
+    print(header)
+    print('-' * len(header))
+    for name, r in results.items():
+        line = (f'{name:34} {r["ops_per_sec"]:12,.0f} {r["p50_us"]:9.2f} {r["p95_us"]:9.2f} '
+                f'{r["p99_us"]:9.2f} {r["peak_alloc_bytes"]:9.0f}')
+        if baseline:
+            base = baseline['results'].get(name)
+            line += f' {r["ops_per_sec"] / base["ops_per_sec"] - 1:+9.1%}' if base else f' {"new":>9}'
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Calculator engine')
+    parser.add_argument('--workload', action='append', choices=sorted(WORKLOADS),
+                        help='Workload to run (repeatable, default: all)')
+    parser.add_argument('--target', action='append', choices=sorted(_targets()),
+                        help='Function to benchmark (repeatable, default: all)')
+    parser.add_argument('--count', type=int, default=500, help='Expressions per workload')
+    parser.add_argument('--rounds', type=int, default=5, help='Passes over each workload')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--quick', action='store_true', help='Small run for smoke testing')
+    parser.add_argument('--save', metavar='FILE', help='Write results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='Compare against a saved baseline')
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        args.count, args.rounds = 50, 1
+    workloads = args.workload or list(WORKLOADS)
+    targets = args.target or list(_targets())
+
+    results = run(workloads, targets, args.count, args.rounds, args.seed)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'params': {'count': args.count, 'rounds': args.rounds, 'seed': args.seed},
+                'results': results,
+            }, f, indent=2)
+        print(f'\nBaseline saved to {args.save}')
+
+
+if __name__ == '__main__':
+    main()
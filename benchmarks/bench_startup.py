@@ -0,0 +1,116 @@
+"""Cold-start benchmark: how long a fresh worker takes to import the app, and its memory.
+
+Each run imports calculator_app in a new interpreter (as a gunicorn worker
+without preload_app does) against a throwaway, already migrated database,
+and reports wall time plus resident memory. --importtime lists the modules
+with the largest self import time.
+
+Usage:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 20 --importtime 15
+    python benchmarks/bench_startup.py --save before.json
+    python benchmarks/bench_startup.py --compare before.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs inside the measured interpreter; prints seconds and VmRSS in bytes
+_PROBE = '''
+import time
+start = time.perf_counter()
+import calculator_app
+elapsed = time.perf_counter() - start
+rss = 0
+try:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+except OSError:
+    pass
+print(elapsed, rss)
+'''
+
+
+def server_env(db_path):
+    env = dict(os.environ)
+    env.update({
+        'DATABASE_PATH': db_path,
+        'SECRET_KEY': env.get('SECRET_KEY', 'bench-startup'),
+        'REQUEST_LOG': 'false',
+    })
+    env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    return env
+
+
+def measure(env, runs):
+    times, rss = [], []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', _PROBE], cwd=ROOT, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        elapsed, resident = output.split()
+        times.append(float(elapsed))
+        rss.append(int(resident))
+    return times, rss
+
+
+def import_profile(env, top):
+    """(module, self microseconds) for the slowest imports, from python -X importtime"""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import calculator_app'],
+                            cwd=ROOT, env=env, capture_output=True, text=True, check=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        rows.append((name.strip(), int(self_us)))
+    rows.sort(key=lambda row: row[1], reverse=True)
+    return rows[:top]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure calculator_app cold start')
+    parser.add_argument('--runs', type=int, default=10, help='Fresh interpreters to time')
+    parser.add_argument('--importtime', type=int, metavar='N', default=0,
+                        help='Also list the N slowest modules (python -X importtime)')
+    parser.add_argument('--save', metavar='FILE', help='Write results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='Compare against a saved baseline')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='calc-startup-') as workdir:
+        env = server_env(os.path.join(workdir, 'startup.db'))
+        # First import creates and migrates the database; it is not timed
+        measure(env, 1)
+        times, rss = measure(env, args.runs)
+        profile = import_profile(env, args.importtime) if args.importtime else []
+
+    result = {
+        'runs': args.runs,
+        'import_median_ms': statistics.median(times) * 1000,
+        'import_min_ms': min(times) * 1000,
+        'rss_median_mib': statistics.median(rss) / 2 ** 20,
+    }
+    print(f'import calculator_app: median {result["import_median_ms"]:.1f} ms, '
+          f'min {result["import_min_ms"]:.1f} ms over {args.runs} runs')
+    print(f'worker RSS after import: {result["rss_median_mib"]:.1f} MiB')
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+        print(f'vs {args.compare}: import {result["import_median_ms"] / base["import_median_ms"] - 1:+.1%}, '
+              f'RSS {result["rss_median_mib"] - base["rss_median_mib"]:+.1f} MiB')
+    for name, self_us in profile:
+        print(f'  {self_us / 1000:8.2f} ms  {name}')
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
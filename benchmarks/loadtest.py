@@ -0,0 +1,415 @@
+"""End-to-end HTTP load test against a throwaway gunicorn + SQLite deployment.
+
+Boots gunicorn on a temporary database seeded with users, logs virtual users
+in through /login (half keep the session cookie, half use the JWT), drives a
+weighted mix of routes for a fixed duration and reports throughput and
+p50/p95/p99 latency per route, SQLite lock errors and the server's resident
+memory (so worker profiles can be compared by throughput per GB).
+
+Usage:
+    python benchmarks/loadtest.py --concurrency 32 --duration 30
+    python benchmarks/loadtest.py --profile gthread
+    python benchmarks/loadtest.py --workers 4 --worker-class gthread --threads 8
+    python benchmarks/loadtest.py --env DB_STORAGE_PROFILE=legacy --json legacy.json
+    python benchmarks/loadtest.py --url http://127.0.0.1:2000   # existing server, no boot
+    python benchmarks/loadtest.py --url http://127.0.0.1:2000 --username alice --password secret
+
+Against an existing server (--url) every virtual user logs in as --username
+or --admin-username (default: the seeded user/admin with password admin123).
+All logins come from one address, so if that server runs with
+RATE_LIMIT_ENABLED=true, more than RATE_LIMIT_LOGIN of them (10/minute by
+default) get 429.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'loadtest'
+# Password of the admin and user accounts database.init_db seeds
+DEFAULT_PASSWORD = 'admin123'
+# Default RATE_LIMIT_LOGIN bucket (rate_limiter.py)
+LOGIN_BUCKET = 10
+
+# (method, path, weight); /calculate bodies are generated per request
+USER_MIX = [
+    ('POST', '/calculate', 55),
+    ('POST', '/calculate/batch', 5),
+    ('GET', '/history', 15),
+    ('GET', '/check-auth', 15),
+    ('GET', '/user/info', 10),
+]
+ADMIN_MIX = [
+    ('GET', '/audit?limit=100', 30),
+    ('GET', '/audit/users', 20),
+    ('GET', '/admin/user-settings?limit=100', 20),
+    ('POST', '/calculate', 30),
+]
+
+_LOCK_RE = re.compile(r'database is locked|database table is locked|SQLITE_BUSY', re.IGNORECASE)
+
+
+def seed_database(path, users, admins):
+    """Create the schema plus load-test users in the default tenant"""
+    os.environ['DATABASE_PATH'] = path
+    import database
+    database.DATABASE = path
+    database.init_db()
+    password_hash = database.hash_password(PASSWORD)
+    with database.get_db() as conn:
+        roles = dict(conn.execute('SELECT name, id FROM roles').fetchall())
+        conn.executemany(
+            'INSERT INTO users (username, password_hash, role_id, tenant_id) VALUES (?, ?, ?, 1)',
+            [(f'load-user-{i}', password_hash, roles['user']) for i in range(users)] +
+            [(f'load-admin-{i}', password_hash, roles['admin']) for i in range(admins)]
+        )
+    database.close_all_connections()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args, db_path, log_file):
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        'DATABASE_PATH': db_path,
+        'SECRET_KEY': env.get('SECRET_KEY', 'loadtest-secret'),
+        'JWT_SECRET_KEY': env.get('JWT_SECRET_KEY', 'loadtest-jwt-secret'),
+        'LOG_LEVEL': 'warning',
+        'REQUEST_LOG': 'false',
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(os.path.dirname(db_path), 'prometheus'),
+        # Every virtual user logs in from 127.0.0.1 into one tenant: measure the
+        # server, not the limits (pass --env to turn them back on)
+        'RATE_LIMIT_ENABLED': 'false',
+        'TENANT_MAX_INFLIGHT': '0',
+    })
+    if args.profile:
+        env['GUNICORN_PROFILE'] = args.profile
+    for item in args.env:
+        key, _, value = item.partition('=')
+        env[key] = value
+    cmd = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn_config.py',
+           '--bind', f'127.0.0.1:{port}', '--access-logfile', '/dev/null']
+    # Unset options fall back to the profile in gunicorn_config.py
+    if args.workers:
+        cmd += ['--workers', str(args.workers)]
+    if args.worker_class:
+        cmd += ['--worker-class', args.worker_class]
+    if args.threads:
+        cmd += ['--threads', str(args.threads)]
+    cmd.append('calculator_app:app')
+    process = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'gunicorn exited with code {process.returncode}; see {log_file.name}')
+        try:
+            requests.get(f'{url}/login', timeout=5)
+            return process, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start within 30s')
+
+
+def _children(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def _proc_field(path, field):
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def process_tree_memory(pid):
+    """(RSS, PSS) in bytes of a process tree.
+
+    RSS counts pages shared copy-on-write with the gunicorn master once per
+    worker; PSS splits them between the sharers, so it shows what
+    preload_app saves. PSS is 0 where /proc/<pid>/smaps_rollup is missing.
+    """
+    rss = pss = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        resident = _proc_field(f'/proc/{current}/status', 'VmRSS:')
+        if not resident:
+            continue
+        rss += resident
+        pss += _proc_field(f'/proc/{current}/smaps_rollup', 'Pss:')
+        pending.extend(_children(current))
+    return rss, pss
+
+
+class MemorySampler(threading.Thread):
+    """Samples the server's process-tree RSS and PSS while the load runs"""
+
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.pss_samples = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            rss, pss = process_tree_memory(self.pid)
+            if rss:
+                self.samples.append(rss)
+                self.pss_samples.append(pss)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def peak(self):
+        return max(self.samples, default=0)
+
+    def peak_pss(self):
+        return max(self.pss_samples, default=0)
+
+
+def random_expression(rng):
+    terms = [str(rng.randint(0, 999)) for _ in range(rng.randint(2, 5))]
+    return ''.join(t + rng.choice('+-*/') for t in terms[:-1]) + terms[-1]
+
+
+class Stats:
+    """Per-route latency samples and status counts, shared by all virtual users"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = defaultdict(int)
+
+    def record(self, route, seconds, status):
+        with self._lock:
+            self.latencies[route].append(seconds)
+            self.statuses[route][status] += 1
+
+    def record_error(self, route, error):
+        with self._lock:
+            self.errors[f'{route}: {type(error).__name__}'] += 1
+
+
+class VirtualUser(threading.Thread):
+    def __init__(self, url, username, password, mix, use_jwt, stats, stop_at, seed):
+        super().__init__(daemon=True)
+        self.url = url
+        self.username = username
+        self.password = password
+        self.mix = mix
+        self.use_jwt = use_jwt
+        self.stats = stats
+        self.stop_at = stop_at
+        self.rng = random.Random(seed)
+        self.http = requests.Session()
+
+    def login(self):
+        headers = {'Accept': 'application/json'}
+        response = self.http.post(f'{self.url}/login', headers=headers,
+                                  json={'username': self.username, 'password': self.password})
+        response.raise_for_status()
+        if self.use_jwt:
+            # Token clients do not send the session cookie
+            self.http.cookies.clear()
+            self.http.headers['Authorization'] = f'Bearer {response.json()["token"]}'
+
+    def run(self):
+        try:
+            self.login()
+        except requests.RequestException as e:
+            self.stats.record_error('POST /login', e)
+            return
+        routes = [(method, path) for method, path, _ in self.mix]
+        weights = [weight for _, _, weight in self.mix]
+        mode = 'jwt' if self.use_jwt else 'session'
+        while time.monotonic() < self.stop_at:
+            method, path = self.rng.choices(routes, weights)[0]
+            route = f'{method} {path.split("?")[0]} [{mode}]'
+            body = None
+            if path == '/calculate':
+                body = {'expression': random_expression(self.rng)}
+            elif path == '/calculate/batch':
+                body = {'expressions': [random_expression(self.rng) for _ in range(10)]}
+            start = time.perf_counter()
+            try:
+                response = self.http.request(method, f'{self.url}{path}', json=body, timeout=30)
+            except requests.RequestException as e:
+                self.stats.record_error(route, e)
+                continue
+            self.stats.record(route, time.perf_counter() - start, response.status_code)
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(stats, duration):
+    report = {}
+    for route in sorted(stats.latencies):
+        samples = sorted(stats.latencies[route])
+        report[route] = {
+            'requests': len(samples),
+            'rps': len(samples) / duration,
+            'mean_ms': statistics.mean(samples) * 1000,
+            'p50_ms': percentile(samples, 0.50) * 1000,
+            'p95_ms': percentile(samples, 0.95) * 1000,
+            'p99_ms': percentile(samples, 0.99) * 1000,
+            'statuses': dict(stats.statuses[route]),
+        }
+    return report
+
+
+def print_report(report, duration, lock_errors, errors, peak_rss=0, peak_pss=0):
+    header = f'{"route":40} {"reqs":>7} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}  statuses'
+    print(header)
+    print('-' * len(header))
+    total = 0
+    for route, r in report.items():
+        total += r['requests']
+        statuses = ' '.join(f'{code}:{count}' for code, count in sorted(r['statuses'].items()))
+        print(f'{route:40} {r["requests"]:7} {r["rps"]:8.1f} {r["p50_ms"]:8.2f} '
+              f'{r["p95_ms"]:8.2f} {r["p99_ms"]:8.2f}  {statuses}')
+    print('-' * len(header))
+    print(f'total: {total} requests in {duration:.1f}s ({total / duration:.1f} req/s)')
+    print(f'SQLite lock errors in server log: {lock_errors}')
+    if peak_rss:
+        gigabytes = peak_rss / 2 ** 30
+        print(f'server peak RSS: {peak_rss / 2 ** 20:.1f} MiB '
+              f'({total / duration / gigabytes:.0f} req/s per GiB)')
+    if peak_pss:
+        print(f'server peak PSS: {peak_pss / 2 ** 20:.1f} MiB '
+              f'({total / duration / (peak_pss / 2 ** 30):.0f} req/s per GiB)')
+    for name, count in sorted(errors.items()):
+        print(f'client error {name}: {count}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='HTTP load test for the calculator app')
+    parser.add_argument('--url', help='Target an already running server instead of booting one')
+    parser.add_argument('--concurrency', type=int, default=16, help='Virtual users')
+    parser.add_argument('--admin-fraction', type=float, default=0.1,
+                        help='Share of virtual users driving admin/audit endpoints')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds of load')
+    parser.add_argument('--profile', choices=['sync', 'gthread', 'gevent'],
+                        help='GUNICORN_PROFILE for the server (default: gunicorn_config.py default)')
+    parser.add_argument('--workers', type=int, help='gunicorn workers (overrides the profile)')
+    parser.add_argument('--worker-class', help='gunicorn worker class (overrides the profile)')
+    parser.add_argument('--threads', type=int, help='gunicorn threads per worker (overrides the profile)')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='Extra environment for the server, e.g. DB_STORAGE_PROFILE=legacy')
+    parser.add_argument('--username', default='user', help='User account to log in as with --url')
+    parser.add_argument('--admin-username', default='admin', help='Admin account to log in as with --url')
+    parser.add_argument('--password', default=DEFAULT_PASSWORD,
+                        help='Password of both accounts with --url (default: the seeded admin123)')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--json', metavar='FILE', help='Write the report as JSON')
+    args = parser.parse_args(argv)
+
+    admins = max(1, int(args.concurrency * args.admin_fraction)) if args.admin_fraction > 0 else 0
+    users = args.concurrency - admins
+
+    workdir = tempfile.TemporaryDirectory(prefix='calc-loadtest-')
+    process = None
+    log_path = os.path.join(workdir.name, 'server.log')
+    try:
+        with open(log_path, 'w') as log_file:
+            if args.url:
+                url = args.url.rstrip('/')
+                username_prefix = None
+                password = args.password
+                if args.concurrency > LOGIN_BUCKET:
+                    print(f'warning: {args.concurrency} logins from one address exceed the default '
+                          f'login rate limit ({LOGIN_BUCKET}/minute); if the server runs with '
+                          'RATE_LIMIT_ENABLED=true, expect 429s on POST /login', file=sys.stderr)
+            else:
+                password = PASSWORD
+                db_path = os.path.join(workdir.name, 'loadtest.db')
+                seed_database(db_path, users, admins)
+                process, url = start_server(args, db_path, log_file)
+                username_prefix = 'load'
+
+            stats = Stats()
+            stop_at = time.monotonic() + args.duration
+            threads = []
+            for i in range(args.concurrency):
+                is_admin = i >= users
+                if username_prefix:
+                    username = f'load-admin-{i - users}' if is_admin else f'load-user-{i}'
+                else:
+                    username = args.admin_username if is_admin else args.username
+                threads.append(VirtualUser(url, username, password, ADMIN_MIX if is_admin else USER_MIX,
+                                           use_jwt=i % 2 == 1, stats=stats, stop_at=stop_at,
+                                           seed=args.seed + i))
+            sampler = MemorySampler(process.pid) if process is not None else None
+            if sampler:
+                sampler.start()
+            started = time.monotonic()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            duration = time.monotonic() - started
+            peak_rss = peak_pss = 0
+            if sampler:
+                sampler.stop()
+                peak_rss = sampler.peak()
+                peak_pss = sampler.peak_pss()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    with open(log_path) as f:
+        lock_errors = len(_LOCK_RE.findall(f.read()))
+    report = summarize(stats, duration)
+    print_report(report, duration, lock_errors, stats.errors, peak_rss, peak_pss)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'params': vars(args),
+                'duration': duration,
+                'lock_errors': lock_errors,
+                'peak_rss_bytes': peak_rss,
+                'peak_pss_bytes': peak_pss,
+                'client_errors': dict(stats.errors),
+                'routes': report,
+            }, f, indent=2)
+    workdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,116 +1,58 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import (
+    Blueprint, Flask, Response, current_app, render_template, request, jsonify, session,
+    redirect, url_for, g, stream_with_context
+)
 from flask_cors import CORS
 from flask_wtf.csrf import CSRFProtect
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
-import re
 import os
-from functools import wraps
+import hashlib
+import hmac
+import json
+import click
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache, wraps
 from datetime import datetime, timedelta
 import jwt
-from authlib.integrations.flask_client import OAuth
 from database import (
-    init_db, authenticate_user, authenticate_google_user, has_permission, log_audit, 
-    get_audit_logs, get_user_permissions, get_user_settings, update_user_settings,
+    ensure_schema, migrate, get_schema_version, SCHEMA_VERSION, authenticate_user, authenticate_google_user, has_permission,
+    iter_audit_logs, encode_audit_cursor, decode_audit_cursor, AUDIT_LOG_COLUMNS,
+    get_calculation_history, get_audit_user_counts, rebuild_audit_user_counts,
+    get_tenant_user_settings, get_user_permissions, get_user_settings, update_user_settings,
+    get_settings_version, get_generation, get_tenant_eval_limits, set_tenant_eval_limits,
     get_users_without_tenant, assign_user_to_tenant, get_all_tenants, create_user_by_email,
     remove_user_from_tenant, delete_tenant, create_tenant
 )
+import audit_writer
+import eval_pool
+from eval_pool import EvaluationAborted
+from audit_writer import log_audit, log_audit_many
+import instrumentation
+import metrics
+import rate_limiter
+import sql_profiler
+from calculator_engine import Calculator, EvaluationLimits, ResultCache, normalize_expression
 
-class Calculator:
-    def __init__(self):
-        self.operators = {
-            '+': (lambda x, y: x + y, 1),
-            '-': (lambda x, y: x - y, 1),
-            '*': (lambda x, y: x * y, 2),
-            '/': (lambda x, y: x / y, 2),
-            '^': (lambda x, y: x ** y, 3),
-        }
-
-    def evaluate(self, expression):
-        # Basic validation
-        if not self.is_valid_expression(expression):
-            return "Invalid expression"
-
-        try:
-            # Replace ^ with ** for exponentiation
-            expression = expression.replace('^', '**')
-            
-            # Check for invalid characters
-            allowed_chars = re.compile(r'^[0-9+\-*/().^\s]+$')
-            if not allowed_chars.match(expression):
-                return "Invalid characters in expression"
-            
-            # Evaluate the expression
-            result = eval(expression, {"__builtins__": {}}, {})
-            
-            # Handle division by zero
-            if isinstance(result, float) and result == float('inf'):
-                return "Division by zero"
-            
-            return str(result)
-        except ZeroDivisionError:
-            return "Division by zero"
-        except Exception:
-            return "Invalid expression"
-
-    def is_valid_expression(self, expression):
-        # Check for balanced parentheses
-        open_parentheses = 0
-        for char in expression:
-            if char == '(': open_parentheses += 1
-            elif char == ')': open_parentheses -= 1
-            if open_parentheses < 0: return False
-        
-        # Check if parentheses are balanced
-        if open_parentheses != 0: return False
-        
-        # Check for invalid operator sequences (but allow negative numbers)
-        # Allow: +, -, *, / after operators or at start
-        # Allow: - after opening parenthesis or at start (for negative numbers)
-        # Don't allow: ++, --, **, //, +*, -*, etc. (except for negative numbers)
-        
-        # Normalize spaces
-        expression = expression.replace(' ', '')
-        
-        # Check for consecutive operators (except - for negative numbers)
-        # Pattern: operator followed by another operator (except - after opening paren or at start)
-        invalid_patterns = [
-            r'[+\*/]{2,}',  # Multiple +, *, / not allowed
-            r'\+\+', r'\*\*', r'//',  # Specific invalid sequences
-            r'[+\-*/]\*[+\-*/]',  # Operator-*-operator (except ** which is exponentiation, already replaced)
-            r'[+\-*/]/[+\-*/]',  # Operator-/operator
-        ]
-        
-        for pattern in invalid_patterns:
-            if re.search(pattern, expression):
-                return False
-        
-        # Allow negative numbers: - at start, - after (, - after operators
-        # But ensure it's not just a minus sign alone
-        if expression.strip() == '-':
-            return False
-        
-        return True
-
-app = Flask(__name__)
-app.secret_key = os.environ.get('SECRET_KEY')
-if not app.secret_key:
+SECRET_KEY = os.environ.get('SECRET_KEY')
+if not SECRET_KEY:
     raise ValueError('SECRET_KEY environment variable is required')
 
-# Session configuration for security
-app.config['SESSION_COOKIE_SECURE'] = False  # Set to True in production with HTTPS
-app.config['SESSION_COOKIE_HTTPONLY'] = True
-app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
-app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
+# Routes, hooks and CLI commands live on this blueprint; create_app() builds the app
+bp = Blueprint('calculator', __name__, cli_group=None)
 
 # JWT Configuration
-JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY', app.secret_key or '')
+JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY', SECRET_KEY)
 if not JWT_SECRET_KEY:
     raise ValueError('JWT_SECRET_KEY or SECRET_KEY environment variable is required')
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION_DELTA = timedelta(hours=24)  # Tokens expire in 24 hours
 
-def generate_token(user_id, username, role_name, tenant_id):
+# Fat tokens: sign permissions and calculator settings into the JWT so API
+# requests can skip the permission and settings lookups
+JWT_EMBED_CLAIMS = os.environ.get('JWT_EMBED_CLAIMS', 'false').lower() == 'true'
+
+def generate_token(user_id, username, role_name, tenant_id, claims=None):
     """Generate JWT token for user"""
     payload = {
         'user_id': user_id,
@@ -120,17 +62,91 @@ def generate_token(user_id, username, role_name, tenant_id):
         'exp': datetime.utcnow() + JWT_EXPIRATION_DELTA,
         'iat': datetime.utcnow()
     }
+    if claims:
+        payload.update(claims)
     return jwt.encode(payload, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
 
+def build_token_claims(user_id):
+    """Permissions and settings embedded in a fat token, with the versions they were read at"""
+    settings = get_user_settings(user_id)
+    return {
+        'perms': get_user_permissions(user_id),
+        'settings': {
+            'allow_parentheses': settings['allow_parentheses'],
+            'allow_exponents': settings['allow_exponents']
+        },
+        'sv': get_settings_version(user_id),
+        'rg': get_generation('rbac')
+    }
+
+def issue_token(user_id, username, role_name, tenant_id):
+    """Generate a token for a user, embedding claims when JWT_EMBED_CLAIMS is enabled"""
+    claims = build_token_claims(user_id) if JWT_EMBED_CLAIMS else None
+    return generate_token(user_id, username, role_name, tenant_id, claims)
+
+def token_claims_fresh(payload):
+    """Check that the permissions/settings signed into a fat token are still current"""
+    if 'perms' not in payload:
+        return False
+    return (payload.get('sv') == get_settings_version(payload['user_id'])
+            and payload.get('rg') == get_generation('rbac'))
+
+class VerifiedTokenCache:
+    """Bounded LRU of recently verified tokens, keyed by SHA-256 digest.
+
+    Entries are only returned while the token's exp claim is in the future,
+    so a cached token can never outlive its expiry.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, token, payload):
+        if self.max_entries <= 0 or 'exp' not in payload:
+            return
+        key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            self._entries[key] = (payload['exp'], payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+token_cache = VerifiedTokenCache(int(os.environ.get('JWT_CACHE_SIZE', 10000)))
+
 def verify_token(token):
-    """Verify and decode JWT token"""
+    """Verify and decode JWT token (recently verified tokens are served from cache)"""
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
     try:
         payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
-        return payload
     except jwt.ExpiredSignatureError:
         return None  # Token expired
     except jwt.InvalidTokenError:
         return None  # Invalid token
+    token_cache.put(token, payload)
+    return payload
 
 def get_token_from_request():
     """Extract token from Authorization header"""
@@ -140,24 +156,35 @@ def get_token_from_request():
     return None
 
 
-# Google OAuth configuration (optional)
-google = None
-try:
-    oauth = OAuth(app)
-    google_client_id = os.environ.get('GOOGLE_CLIENT_ID', '')
-    google_client_secret = os.environ.get('GOOGLE_CLIENT_SECRET', '')
-    if google_client_id and google_client_secret:
-        google = oauth.register(
-            name='google',
-            client_id=google_client_id,
-            client_secret=google_client_secret,
-            server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
-            client_kwargs={
-                'scope': 'openid email profile'
-            }
-        )
-except Exception as e:
-    print(f'Warning: Google OAuth not configured: {e}')
+# Google OAuth configuration (optional). authlib and the client are only
+# loaded on the first /login/google or /auth/google request: most workers never
+# need them, and they are the slowest part of importing this module.
+_google = None
+_google_lock = threading.Lock()
+
+def google_oauth_configured():
+    return bool(os.environ.get('GOOGLE_CLIENT_ID') and os.environ.get('GOOGLE_CLIENT_SECRET'))
+
+def get_google_client():
+    """The registered Google OAuth client, or None when it is not configured"""
+    global _google
+    if _google is None and google_oauth_configured():
+        with _google_lock:
+            if _google is None:
+                try:
+                    from authlib.integrations.flask_client import OAuth
+                    _google = OAuth(current_app).register(
+                        name='google',
+                        client_id=os.environ['GOOGLE_CLIENT_ID'],
+                        client_secret=os.environ['GOOGLE_CLIENT_SECRET'],
+                        server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
+                        client_kwargs={
+                            'scope': 'openid email profile'
+                        }
+                    )
+                except Exception as e:
+                    print(f'Warning: Google OAuth not configured: {e}')
+    return _google
 
 # CORS configuration - use environment variable or default to development
 # Set CORS_ORIGINS in .env for production (comma-separated list)
@@ -167,30 +194,24 @@ cors_origins = os.environ.get("CORS_ORIGINS", "").split(",") if os.environ.get("
 # Filter out empty strings
 cors_origins = [origin.strip() for origin in cors_origins if origin.strip()]
 
-CORS(app, resources={
+CORS_RESOURCES = {
     r"/*": {
         "origins": cors_origins if cors_origins else ["*"],  # Default to * for development
         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
         "allow_headers": ["Content-Type", "Authorization"],
+        "expose_headers": ["X-Token-Refresh", "Retry-After"],
         "supports_credentials": True
     }
-})
+}
 
 # CSRF Protection (for web forms)
 # Note: CSRF works perfectly with Gunicorn and Docker
 # Sessions use SECRET_KEY which is consistent across workers
 
-# Rate limiting - Add Flask-Limiter for production:
-# from flask_limiter import Limiter
-# from flask_limiter.util import get_remote_address
-# limiter = Limiter(app=app, key_func=get_remote_address)
-# Then add @limiter.limit("10 per minute") to sensitive endpoints
-
-
-csrf = CSRFProtect(app)
+csrf = CSRFProtect()
 
 # Security Headers
-@app.after_request
+@bp.after_app_request
 def set_security_headers(response):
     """Add security headers to all responses"""
     # HSTS - Force HTTPS (only in production with HTTPS)
@@ -224,14 +245,106 @@ def set_security_headers(response):
     
     return response
 
+@bp.after_app_request
+def flag_stale_token(response):
+    """Ask clients holding an outdated fat token to call /api/auth/refresh"""
+    if g.get('token_refresh_required'):
+        response.headers['X-Token-Refresh'] = 'required'
+    return response
+
+# Per-request instrumentation: query count, DB time, evaluator time
+@bp.before_app_request
+def start_request_metrics():
+    instrumentation.start_request()
+
+@bp.after_app_request
+def report_request_metrics(response):
+    """Expose request timings via Server-Timing, a structured log line and /metrics"""
+    request_metrics = instrumentation.current()
+    if request_metrics is None:
+        return response
+    if instrumentation.SERVER_TIMING_ENABLED:
+        response.headers['Server-Timing'] = request_metrics.server_timing()
+    # View name without the blueprint prefix, as logged before the app factory
+    endpoint = request.endpoint.rpartition('.')[2] if request.endpoint else None
+    instrumentation.log_request(request_metrics, request.method, request.path,
+                                endpoint, response.status_code)
+    if METRICS_ENABLED:
+        # Route template, not the raw path, keeps label cardinality bounded
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe_request(request.method, route, response.status_code, request_metrics.elapsed())
+        # Every worker pushes its own figures; /metrics is served by just one of them
+        metrics.sync_worker_stats(calc_cache, audit_writer.writer, eval_pool.pool)
+    return response
+
+@bp.teardown_app_request
+def end_request_metrics(exc):
+    instrumentation.end_request()
+
+
+# Result cache shared by all requests in this worker (CALC_CACHE_SIZE=0 disables it)
+calc_cache_size = int(os.environ.get('CALC_CACHE_SIZE', 4096))
+calc_cache = None
+if calc_cache_size > 0:
+    calc_cache = ResultCache(
+        max_entries=calc_cache_size,
+        max_bytes=int(os.environ.get('CALC_CACHE_MAX_BYTES', 4 * 1024 * 1024))
+    )
+# Evaluation budget: integers with more than CALC_MAX_DIGITS digits are refused
+# ('Result too large') or, with CALC_OVERFLOW=scientific, approximated when final.
+# Tenants can be given their own budget with `flask set-eval-limits`.
+# With EVAL_BACKEND=pool, expensive expressions run in eval_pool's processes.
+calculator = Calculator(cache=calc_cache, limits=EvaluationLimits(
+    max_digits=int(os.environ.get('CALC_MAX_DIGITS', 4300)),
+    overflow=os.environ.get('CALC_OVERFLOW', 'error').lower()
+), offload=eval_pool.pool)
+
+@lru_cache(maxsize=256)
+def _eval_limits(max_digits, overflow):
+    # One object per distinct budget, so result cache keys stay shared
+    limits = EvaluationLimits(max_digits=max_digits, overflow=overflow)
+    return calculator.limits if limits == calculator.limits else limits
 
-calculator = Calculator()
+def evaluate_expression(expression, limits):
+    """Evaluate for a request; a missed evaluation deadline becomes the result (and is not cached)"""
+    with instrumentation.timed_eval():
+        try:
+            return calculator.evaluate(expression, limits)
+        except EvaluationAborted as e:
+            return str(e)
+
+def get_request_limits(tenant_id):
+    """Evaluation budget for the current request's tenant"""
+    overrides = get_tenant_eval_limits(tenant_id) if tenant_id else None
+    if not overrides:
+        return calculator.limits
+    return _eval_limits(overrides['max_digits'] or calculator.limits.max_digits,
+                        overrides['overflow'] or calculator.limits.overflow)
+
+# Maximum number of expressions accepted by /calculate/batch
+MAX_BATCH_SIZE = int(os.environ.get('CALC_BATCH_MAX_SIZE', 100))
+
+# Serve Prometheus metrics on /metrics (off by default: it shares the public port)
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+# When set, scrapers must send 'Authorization: Bearer <METRICS_TOKEN>'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Largest page /admin/user-settings returns
+ADMIN_USERS_PAGE_SIZE = int(os.environ.get('ADMIN_USERS_PAGE_SIZE', 500))
+USER_SETTINGS_COLUMNS = ('id', 'username', 'allow_parentheses', 'allow_exponents')
 
-# Initialize database on startup
-init_db()
+# Most calculations /history returns per page
+HISTORY_DEPTH = int(os.environ.get('HISTORY_DEPTH', 50))
+
+# Largest page /audit will return, whatever ?limit= asks for
+AUDIT_MAX_PAGE_SIZE = int(os.environ.get('AUDIT_MAX_PAGE_SIZE', 1000))
 
 def login_required(f):
-    """Decorator to require login - supports both session and JWT token"""
+    """Decorator to require login - supports both session and JWT token.
+
+    The authenticated user is exposed as g.user. Bearer-token requests are
+    stateless: they never write to the session, so no cookie is re-signed.
+    """
     @wraps(f)
     def decorated_function(*args, **kwargs):
         # Try token-based auth first (for mobile)
@@ -239,11 +352,18 @@ def login_required(f):
         if token:
             payload = verify_token(token)
             if payload:
-                # Set session from token for compatibility
-                session['user_id'] = payload['user_id']
-                session['username'] = payload['username']
-                session['role_name'] = payload.get('role_name')
-                session['tenant_id'] = payload.get('tenant_id')
+                g.user = {
+                    'user_id': payload['user_id'],
+                    'username': payload['username'],
+                    'role_name': payload.get('role_name'),
+                    'tenant_id': payload.get('tenant_id')
+                }
+                # Fat token: trust embedded claims only while they are current
+                if 'perms' in payload:
+                    if token_claims_fresh(payload):
+                        g.token_claims = payload
+                    else:
+                        g.token_refresh_required = True
                 return f(*args, **kwargs)
             else:
                 return jsonify({'error': 'Invalid or expired token'}), 401
@@ -251,6 +371,12 @@ def login_required(f):
         # Fall back to session-based auth (for web)
         if 'user_id' not in session:
             return jsonify({'error': 'Authentication required'}), 401
+        g.user = {
+            'user_id': session['user_id'],
+            'username': session.get('username'),
+            'role_name': session.get('role_name'),
+            'tenant_id': session.get('tenant_id')
+        }
         return f(*args, **kwargs)
     return decorated_function
 
@@ -259,14 +385,76 @@ def permission_required(permission):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            if 'user_id' not in session:
+            if g.get('user') is None:
                 return jsonify({'error': 'Authentication required'}), 401
-            if not has_permission(session['user_id'], permission):
+            claims = g.get('token_claims')
+            if claims is not None:
+                allowed = permission in claims['perms']
+            else:
+                allowed = has_permission(g.user['user_id'], permission)
+            if not allowed:
                 return jsonify({'error': 'Permission denied'}), 403
             return f(*args, **kwargs)
         return decorated_function
     return decorator
 
+def too_many_requests(message, retry_after):
+    """429 response telling the client how many seconds to wait"""
+    response = jsonify({'error': message, 'retry_after': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def rate_limited(name, key, cost=None):
+    """Decorator: answer 429 once the caller's token bucket for limit `name` is empty.
+
+    key() names the bucket for this request (None skips the check) and
+    cost() how many tokens it takes (default 1). Buckets are shared by all
+    workers (see rate_limiter.py).
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            bucket = key() if rate_limiter.limiter.enabled else None
+            if bucket is not None:
+                decision = rate_limiter.limiter.hit(name, bucket, cost() if cost else 1)
+                if not decision.allowed:
+                    return too_many_requests('Rate limit exceeded', decision.retry_after)
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+def admission_controlled(f):
+    """Decorator: hold one of the tenant's TENANT_MAX_INFLIGHT slots for the request (429 when none is free)"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        tenant_id = g.user.get('tenant_id')
+        if not rate_limiter.admission.enabled or tenant_id is None:
+            return f(*args, **kwargs)
+        lease = rate_limiter.admission.acquire(tenant_id)
+        if lease is None:
+            return too_many_requests('Too many concurrent requests for this tenant', 1)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            rate_limiter.admission.release(lease)
+    return decorated_function
+
+def client_address():
+    return rate_limiter.client_address(request.remote_addr, request.headers.get('X-Forwarded-For'),
+                                       rate_limiter.PROXY_HOPS)
+
+def batch_size():
+    expressions = (request.get_json(silent=True) or {}).get('expressions')
+    return len(expressions) if isinstance(expressions, list) and expressions else 1
+
+def get_request_settings(user_id):
+    """Calculator settings for the current request (from a fresh fat token if present)"""
+    claims = g.get('token_claims')
+    if claims is not None:
+        return claims['settings']
+    return get_user_settings(user_id)
+
 def get_client_info():
     """Get client IP and user agent"""
     ip_address = request.remote_addr
@@ -275,10 +463,10 @@ def get_client_info():
     user_agent = request.headers.get('User-Agent', 'Unknown')
     return ip_address, user_agent
 
-@app.route('/')
+@bp.route('/')
 def index():
     if 'user_id' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
     # Check if user has tenant assignment
     if not session.get('tenant_id'):
@@ -293,9 +481,10 @@ def index():
                          allow_exponents=settings['allow_exponents'],
                          is_admin=session.get('role_name') == 'admin')
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 @csrf.exempt  # Exempt from CSRF for API JSON requests
               # Note: If web forms are added later, create separate /api/login endpoint
+@rate_limited('login', key=lambda: client_address() if request.method == 'POST' else None)
 def login():
     if request.method == 'POST':
         data = request.get_json()
@@ -329,7 +518,7 @@ def login():
                 }), 403
             
             # Generate JWT token
-            token = generate_token(
+            token = issue_token(
                 user['id'],
                 user['username'],
                 user['role_name'],
@@ -352,13 +541,14 @@ def login():
             }), 401
     
     # Check if Google OAuth is configured
-    google_oauth_available = google is not None
+    google_oauth_available = google_oauth_configured()
     return render_template('login.html', google_oauth_available=google_oauth_available)
 
 
-@app.route('/login/google')
+@bp.route('/login/google')
 def login_google():
     """Initiate Google OAuth login"""
+    google = get_google_client()
     if not google:
         return jsonify({'error': 'Google OAuth not configured'}), 503
     
@@ -375,7 +565,7 @@ def login_google():
     
     return google.authorize_redirect(redirect_uri)
 
-@app.route('/auth/google')
+@bp.route('/auth/google')
 def auth_google():
     """Handle Google OAuth callback"""
     try:
@@ -385,16 +575,19 @@ def auth_google():
             import logging
             logging.error(f'Google OAuth error: {error}')
             error_description = request.args.get('error_description', error)
-            return redirect(url_for('login') + f'?error=google_auth_failed&details={error_description}')
+            return redirect(url_for('.login') + f'?error=google_auth_failed&details={error_description}')
         
+        google = get_google_client()
+        if not google:
+            return redirect(url_for('.login') + '?error=google_auth_failed&details=not_configured')
         token = google.authorize_access_token()
         if not token:
-            return redirect(url_for('login') + '?error=google_auth_failed&details=no_token')
+            return redirect(url_for('.login') + '?error=google_auth_failed&details=no_token')
             
         user_info = token.get('userinfo')
         
         if not user_info:
-            return redirect(url_for('login') + '?error=google_auth_failed&details=no_userinfo')
+            return redirect(url_for('.login') + '?error=google_auth_failed&details=no_userinfo')
         
         google_id = user_info.get('sub')
         email = user_info.get('email')
@@ -422,12 +615,12 @@ def auth_google():
             
             # Check if user has tenant assignment
             if not user.get('tenant_id'):
-                return redirect(url_for('no_tenant'))
+                return redirect(url_for('.no_tenant'))
             
             
             # Check if this is an API request (mobile client)
             if request.headers.get('Accept') == 'application/json' or request.args.get('format') == 'json':
-                token = generate_token(
+                token = issue_token(
                     user['id'],
                     user['username'],
                     user['role_name'],
@@ -441,30 +634,30 @@ def auth_google():
                     'tenant_id': user.get('tenant_id')
                 })
             
-            return redirect(url_for('index'))
+            return redirect(url_for('.index'))
         else:
-            return redirect(url_for('login') + '?error=auth_failed')
+            return redirect(url_for('.login') + '?error=auth_failed')
     except Exception as e:
         import logging
         logging.error(f'Google OAuth error: {e}')
-        return redirect(url_for('login') + '?error=google_auth_failed')
+        return redirect(url_for('.login') + '?error=google_auth_failed')
 
-@app.route('/no-tenant')
+@bp.route('/no-tenant')
 def no_tenant():
     """Landing page for users without tenant assignment"""
     if 'user_id' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
     if session.get('tenant_id'):
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     
     return render_template('no_tenant.html', username=session.get('username'))
 
-@app.route('/logout', methods=['POST'])
+@bp.route('/logout', methods=['POST'])
 @login_required
 def logout():
-    user_id = session.get('user_id')
-    username = session.get('username')
+    user_id = g.user.get('user_id')
+    username = g.user.get('username')
     
     ip_address, user_agent = get_client_info()
     log_audit(
@@ -479,11 +672,28 @@ def logout():
     session.clear()
     return jsonify({'success': True, 'message': 'Logged out successfully'})
 
-@app.route('/calculate', methods=['POST'])
+def check_restrictions(expression, settings):
+    """Check an expression against user restrictions.
+
+    Returns None if allowed, otherwise (audit reason, user-facing error).
+    """
+    # Check for parentheses restriction
+    if not settings['allow_parentheses'] and ('(' in expression or ')' in expression):
+        return ('Parentheses not allowed', 'Parentheses are not allowed for your account')
+    
+    # Check for exponents restriction (on the canonical form, so ** is caught too)
+    if not settings['allow_exponents'] and '^' in normalize_expression(expression):
+        return ('Exponents not allowed', 'Exponents are not allowed for your account')
+    
+    return None
+
+@bp.route('/calculate', methods=['POST'])
 @csrf.exempt  # Exempt from CSRF when used as API (JWT token in header)
               # Note: Web forms would use a different endpoint if needed
 @login_required
 @permission_required('calculate')
+@rate_limited('calculate', key=lambda: g.user['user_id'])
+@admission_controlled
 def calculate():
     data = request.get_json()
     expression = data.get('expression', '')
@@ -492,146 +702,225 @@ def calculate():
         return jsonify({'result': 'Empty expression', 'error': 'Empty expression'}), 400
     
     # Check user restrictions
-    settings = get_user_settings(session['user_id'])
-    
-    # Check for parentheses restriction
-    if not settings['allow_parentheses'] and ('(' in expression or ')' in expression):
-        log_audit(
-            user_id=session['user_id'],
-            username=session['username'],
-            action='calculate_denied',
-            resource='calculator',
-            expression=expression,
-            result='Denied: Parentheses not allowed',
-            ip_address=get_client_info()[0],
-            user_agent=get_client_info()[1]
-        )
-        return jsonify({'result': 'Error', 'error': 'Parentheses are not allowed for your account'}), 403
-    
-    # Check for exponents restriction
-    if not settings['allow_exponents'] and '^' in expression:
+    settings = get_request_settings(g.user['user_id'])
+    denial = check_restrictions(expression, settings)
+    if denial:
+        metrics.CALCULATE_DENIED.labels(denial[0]).inc()
         log_audit(
-            user_id=session['user_id'],
-            username=session['username'],
+            user_id=g.user['user_id'],
+            username=g.user['username'],
             action='calculate_denied',
             resource='calculator',
             expression=expression,
-            result='Denied: Exponents not allowed',
+            result=f'Denied: {denial[0]}',
             ip_address=get_client_info()[0],
             user_agent=get_client_info()[1]
         )
-        return jsonify({'result': 'Error', 'error': 'Exponents are not allowed for your account'}), 403
+        return jsonify({'result': 'Error', 'error': denial[1]}), 403
     
-    result = calculator.evaluate(expression)
+    limits = get_request_limits(g.user.get('tenant_id'))
+    result = evaluate_expression(expression, limits)
     
     # Log the calculation
     ip_address, user_agent = get_client_info()
     log_audit(
-        user_id=session['user_id'],
-        username=session['username'],
+        user_id=g.user['user_id'],
+        username=g.user['username'],
         action='calculate',
         resource='calculator',
         expression=expression,
         result=result,
         ip_address=ip_address,
         user_agent=user_agent,
-        tenant_id=session.get('tenant_id')
+        tenant_id=g.user.get('tenant_id')
     )
     
     return jsonify({'result': result})
 
-@app.route('/history', methods=['GET'])
+@bp.route('/calculate/batch', methods=['POST'])
+@csrf.exempt  # API endpoint (JWT token in header)
+@login_required
+@permission_required('calculate')
+@rate_limited('calculate', key=lambda: g.user['user_id'], cost=batch_size)
+@admission_controlled
+def calculate_batch():
+    """Evaluate several expressions with one auth check, one settings lookup and one audit commit"""
+    data = request.get_json(silent=True) or {}
+    expressions = data.get('expressions')
+    
+    if not isinstance(expressions, list) or not expressions:
+        return jsonify({'error': 'expressions must be a non-empty list'}), 400
+    if len(expressions) > MAX_BATCH_SIZE:
+        return jsonify({'error': f'At most {MAX_BATCH_SIZE} expressions per batch'}), 400
+    
+    user_id = g.user['user_id']
+    username = g.user['username']
+    tenant_id = g.user.get('tenant_id')
+    settings = get_request_settings(user_id)
+    limits = get_request_limits(tenant_id)
+    ip_address, user_agent = get_client_info()
+    
+    results = []
+    audit_entries = []
+    for expression in expressions:
+        if not isinstance(expression, str) or not expression:
+            results.append({'expression': expression, 'result': 'Empty expression', 'error': 'Empty expression'})
+            continue
+        
+        denial = check_restrictions(expression, settings)
+        if denial:
+            metrics.CALCULATE_DENIED.labels(denial[0]).inc()
+            results.append({'expression': expression, 'result': 'Error', 'error': denial[1]})
+            action, result = 'calculate_denied', f'Denied: {denial[0]}'
+        else:
+            result = evaluate_expression(expression, limits)
+            results.append({'expression': expression, 'result': result})
+            action = 'calculate'
+        
+        audit_entries.append({
+            'user_id': user_id,
+            'username': username,
+            'action': action,
+            'resource': 'calculator',
+            'expression': expression,
+            'result': result,
+            'ip_address': ip_address,
+            'user_agent': user_agent,
+            'tenant_id': tenant_id
+        })
+    
+    # All audit rows go out in a single transaction
+    log_audit_many(audit_entries)
+    
+    return jsonify({'results': results})
+
+@bp.route('/history', methods=['GET'])
 @csrf.exempt  # Exempt from CSRF - API endpoint (JWT token in header)
 @login_required
 @permission_required('view_history')
 def history():
-    """Get calculation history for the current user"""
-    user_id = session['user_id']
-    logs = get_audit_logs(user_id=user_id, limit=50)
+    """Get calculation history for the current user (newest first, ?before=<next_before> for older)"""
+    user_id = g.user['user_id']
+    limit = request.args.get('limit', HISTORY_DEPTH, type=int)
+    limit = max(1, min(limit, HISTORY_DEPTH))
+    before_id = request.args.get('before', type=int)
+    rows = get_calculation_history(user_id, limit=limit, before_id=before_id)
     
-    # Filter to only calculation actions
     calculations = [
         {
-            'expression': log['expression'],
-            'result': log['result'],
-            'timestamp': log['timestamp']
+            'expression': row['expression'],
+            'result': row['result'],
+            'timestamp': row['timestamp']
         }
-        for log in logs if log['action'] == 'calculate'
+        for row in rows
     ]
+    next_before = rows[-1]['id'] if len(rows) == limit else None
     
-    return jsonify({'calculations': calculations})
+    return jsonify({'calculations': calculations, 'next_before': next_before})
 
-@app.route('/audit', methods=['GET'])
+@bp.route('/audit', methods=['GET'])
 @login_required
 @permission_required('view_audit')
 def audit():
-    """Get audit logs (admin only) - multitenancy: only shows logs for users in admin's tenancy"""
+    """Get audit logs (admin only) - multitenancy: only shows logs for users in admin's tenancy
+
+    Streams one page of logs newest first. Pass ?cursor=<next_cursor> for the
+    next page and ?fields=a,b,c to return only some columns.
+    """
     limit = request.args.get('limit', 100, type=int)
+    limit = max(1, min(limit, AUDIT_MAX_PAGE_SIZE))
     user_id_filter = request.args.get('user_id', type=int)
-    tenant_id = session.get('tenant_id')
+    cursor = request.args.get('cursor') or None
+    fields = request.args.get('fields')
+    columns = [f.strip() for f in fields.split(',') if f.strip()] if fields else None
+    tenant_id = g.user.get('tenant_id')
+    
+    if columns:
+        unknown = set(columns) - set(AUDIT_LOG_COLUMNS)
+        if unknown:
+            return jsonify({'error': f'Unknown audit log columns: {", ".join(sorted(unknown))}'}), 400
+    if cursor:
+        try:
+            decode_audit_cursor(cursor)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
     
     # Multitenancy: Admin can only see logs for users in their tenant
-    if user_id_filter:
-        # Filter by specific user (must be in same tenant)
-        logs = get_audit_logs(user_id=user_id_filter, tenant_id=tenant_id, limit=limit)
-    else:
-        # Get all logs for admin's tenant only
-        logs = get_audit_logs(tenant_id=tenant_id, limit=limit)
+    # (user_id_filter narrows it to one user, who must be in the same tenant).
+    # One extra row is fetched to know whether another page exists.
+    rows = iter_audit_logs(user_id=user_id_filter, tenant_id=tenant_id,
+                           limit=limit + 1, cursor=cursor, columns=columns)
     
-    return jsonify({'logs': logs})
+    def generate():
+        yield '{"logs":['
+        last = None
+        for count, row in enumerate(rows):
+            if count == limit:
+                break
+            if last is not None:
+                yield ','
+            last = row
+            yield json.dumps({k: row[k] for k in columns} if columns else row)
+        next_cursor = encode_audit_cursor(last) if last is not None and count == limit else None
+        rows.close()
+        yield '],"next_cursor":' + json.dumps(next_cursor) + '}'
+    
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
-@app.route('/audit/users', methods=['GET'])
+@bp.route('/audit/users', methods=['GET'])
 @login_required
 @permission_required('view_audit')
 def audit_users():
     """Get list of users for audit log filtering (admin only) - multitenancy: only users in admin's tenant"""
-    from database import get_db
-    tenant_id = session.get('tenant_id')
-    with get_db() as conn:
-        cursor = conn.cursor()
-        # Multitenancy: Only show users in the same tenant
-        cursor.execute('''
-            SELECT DISTINCT u.id, u.username, COUNT(al.id) as log_count
-            FROM users u
-            LEFT JOIN audit_logs al ON u.id = al.user_id AND al.tenant_id = ?
-            WHERE u.tenant_id = ?
-            GROUP BY u.id, u.username
-            ORDER BY u.username
-        ''', (tenant_id, tenant_id))
-        users = [dict(row) for row in cursor.fetchall()]
-        return jsonify({'users': users})
-
-@app.route('/user/info', methods=['GET'])
+    # Counts come from the trigger-maintained audit_user_counts rollup
+    users = get_audit_user_counts(g.user.get('tenant_id'))
+    return jsonify({'users': users})
+
+@bp.route('/user/info', methods=['GET'])
 @login_required
 def user_info():
     """Get current user information"""
-    permissions = get_user_permissions(session['user_id'])
+    permissions = get_user_permissions(g.user['user_id'])
     return jsonify({
-        'username': session.get('username'),
-        'role': session.get('role_name'),
+        'username': g.user.get('username'),
+        'role': g.user.get('role_name'),
         'permissions': permissions
     })
 
-@app.route('/check-auth', methods=['GET'])
+@bp.route('/check-auth', methods=['GET'])
 def check_auth():
     """Check if user is authenticated"""
-    if 'user_id' in session:
-        settings = get_user_settings(session['user_id'])
-        return jsonify({
-            'authenticated': True,
-            'username': session.get('username'),
-            'role': session.get('role_name'),
-            'settings': settings
-        })
-    return jsonify({'authenticated': False}), 401
+    token = get_token_from_request()
+    payload = verify_token(token) if token else None
+    if payload:
+        user = {'user_id': payload['user_id'], 'username': payload['username'],
+                'role_name': payload.get('role_name')}
+    elif 'user_id' in session:
+        user = {'user_id': session['user_id'], 'username': session.get('username'),
+                'role_name': session.get('role_name')}
+    else:
+        return jsonify({'authenticated': False}), 401
+    
+    settings = get_user_settings(user['user_id'])
+    return jsonify({
+        'authenticated': True,
+        'username': user['username'],
+        'role': user['role_name'],
+        'settings': settings
+    })
 
-@app.route('/admin/user-settings', methods=['GET'])
+@bp.route('/admin/user-settings', methods=['GET'])
 @login_required
 @permission_required('manage_users')
 def get_all_user_settings():
-    """Get all user settings for admin's tenant only (admin only)"""
-    from database import get_db
-    tenant_id = session.get('tenant_id')
+    """Get user settings for admin's tenant only (admin only)
+
+    Pages by username when asked to (?limit= and/or ?after=<next_after>,
+    at most ADMIN_USERS_PAGE_SIZE rows), otherwise returns every user;
+    filters by username prefix (?q=) and returns column/row arrays with
+    ?format=compact.
+    """
+    tenant_id = g.user.get('tenant_id')
     if not tenant_id:
         return jsonify({'error': 'You must be assigned to a tenant'}), 403
     
@@ -643,57 +932,37 @@ def get_all_user_settings():
         logging.error(f'Invalid tenant_id in session: {tenant_id} (type: {type(tenant_id)})')
         return jsonify({'error': 'Invalid tenant_id in session'}), 500
     
-    with get_db() as conn:
-        cursor = conn.cursor()
-        # Only return users in the admin's tenant (tenant_id must match exactly, not NULL)
-        # Use IS NOT NULL first to ensure we don't match NULL values
-        # Include tenant_id in SELECT so we can verify it directly
-        cursor.execute('''
-            SELECT u.id, u.username, u.tenant_id,
-                   COALESCE(us.allow_parentheses, 1) as allow_parentheses,
-                   COALESCE(us.allow_exponents, 1) as allow_exponents
-            FROM users u
-            LEFT JOIN user_settings us ON u.id = us.user_id
-            WHERE u.tenant_id IS NOT NULL AND u.tenant_id = ?
-            ORDER BY u.username
-        ''', (tenant_id,))
-        rows = cursor.fetchall()
-        users = []
-        
-        # Convert rows to dicts and verify tenant_id for each user
-        for row in rows:
-            user_dict = dict(row)
-            user_id = user_dict['id']
-            row_tenant_id = user_dict.get('tenant_id')
-            
-            # CRITICAL: Always verify from database (don't trust the row)
-            cursor.execute('SELECT tenant_id FROM users WHERE id = ?', (user_id,))
-            actual_tenant = cursor.fetchone()
-            actual_tenant_id = actual_tenant[0] if actual_tenant else None
-            
-            # Only include if tenant_id matches and is not NULL
-            # Use strict comparison: must be integer, must match exactly, must not be None
-            if (actual_tenant_id is not None and 
-                isinstance(actual_tenant_id, int) and
-                actual_tenant_id == tenant_id):
-                # Remove tenant_id from response (not needed by frontend)
-                user_dict.pop('tenant_id', None)
-                users.append(user_dict)
-            else:
-                import logging
-                logging.warning(f'FILTERED OUT: user {user_dict.get("username")} (ID: {user_id}) - actual_tenant_id={actual_tenant_id} (type: {type(actual_tenant_id)}), expected={tenant_id} (type: {type(tenant_id)})')
-                # Explicitly skip this user
-                continue
-        
-        # Debug logging
+    # Clients that predate paging send neither parameter and expect the full list
+    limit = None
+    if 'limit' in request.args or 'after' in request.args:
+        limit = request.args.get('limit', ADMIN_USERS_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, ADMIN_USERS_PAGE_SIZE))
+    after = request.args.get('after')
+    prefix = request.args.get('q', '').strip() or None
+    compact = request.args.get('format') == 'compact'
+    
+    # Single query filtered on u.tenant_id; every row still carries its tenant_id
+    # so isolation is checked on the same snapshot instead of re-querying per user
+    rows = get_tenant_user_settings(tenant_id, limit=limit, after_username=after, prefix=prefix)
+    leaked = [row['id'] for row in rows if row['tenant_id'] != tenant_id]
+    if leaked:
         import logging
-        logging.info(f'get_all_user_settings: tenant_id={tenant_id}, returned {len(users)} users')
-        logging.info(f'User IDs: {[u["id"] for u in users]}')
-        logging.info(f'Usernames: {[u["username"] for u in users]}')
-        
-        return jsonify({'users': users})
+        logging.error(f'get_all_user_settings: rows from another tenant returned for tenant {tenant_id}: {leaked}')
+        return jsonify({'error': 'Internal error'}), 500
+    
+    next_after = rows[-1]['username'] if limit is not None and len(rows) == limit else None
+    if compact:
+        return jsonify({
+            'columns': list(USER_SETTINGS_COLUMNS),
+            'rows': [[row[column] for column in USER_SETTINGS_COLUMNS] for row in rows],
+            'next_after': next_after
+        })
+    
+    # tenant_id is not needed by the frontend
+    users = [{column: row[column] for column in USER_SETTINGS_COLUMNS} for row in rows]
+    return jsonify({'users': users, 'next_after': next_after})
 
-@app.route('/admin/user-settings/<int:target_user_id>', methods=['PUT'])
+@bp.route('/admin/user-settings/<int:target_user_id>', methods=['PUT'])
 @csrf.exempt  # API endpoint
 @login_required
 @permission_required('manage_users')
@@ -717,8 +986,8 @@ def update_target_user_settings(target_user_id):
     # Log the change
     ip_address, user_agent = get_client_info()
     log_audit(
-        user_id=session['user_id'],
-        username=session['username'],
+        user_id=g.user['user_id'],
+        username=g.user['username'],
         action='update_user_settings',
         resource='admin',
         expression=f'Updated settings for user_id {target_user_id}',
@@ -730,7 +999,7 @@ def update_target_user_settings(target_user_id):
     return jsonify({'success': True, 'message': 'Settings updated'})
 
 
-@app.route('/admin/assign-tenant', methods=['GET', 'POST'])
+@bp.route('/admin/assign-tenant', methods=['GET', 'POST'])
 @login_required
 @permission_required('view_audit')
 def assign_tenant():
@@ -750,7 +1019,7 @@ def assign_tenant():
         except (ValueError, TypeError):
             return jsonify({'error': 'Invalid user_id or tenant_id'}), 400
         
-        admin_tenant_id = session.get('tenant_id')
+        admin_tenant_id = g.user.get('tenant_id')
         
         # Admin can only assign to their own tenant
         if not admin_tenant_id:
@@ -765,8 +1034,8 @@ def assign_tenant():
                 ip_address, user_agent = get_client_info()
                 try:
                     log_audit(
-                        user_id=session['user_id'],
-                        username=session['username'],
+                        user_id=g.user['user_id'],
+                        username=g.user['username'],
                         action='assign_tenant',
                         resource='admin',
                         expression=f'Assigned user_id {user_id} to tenant_id {tenant_id}',
@@ -800,7 +1069,7 @@ def assign_tenant():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/admin/create-user', methods=['POST'])
+@bp.route('/admin/create-user', methods=['POST'])
 @csrf.exempt  # API endpoint
 @login_required
 @permission_required('view_audit')
@@ -813,7 +1082,7 @@ def create_user():
     if not email:
         return jsonify({'error': 'Email is required'}), 400
     
-    admin_tenant_id = session.get('tenant_id')
+    admin_tenant_id = g.user.get('tenant_id')
     if not admin_tenant_id:
         return jsonify({'error': 'You must be assigned to a tenant'}), 403
     
@@ -833,8 +1102,8 @@ def create_user():
         try:
             ip_address, user_agent = get_client_info()
             log_audit(
-                user_id=session['user_id'],
-                username=session['username'],
+                user_id=g.user['user_id'],
+                username=g.user['username'],
                 action='create_user',
                 resource='admin',
                 expression=f'Created user {result.get("username", "unknown")} ({email})',
@@ -860,7 +1129,7 @@ def create_user():
     
     return jsonify({'error': result.get('error', 'Failed to create user')}), 400
 
-@app.route('/admin/remove-tenant', methods=['POST'])
+@bp.route('/admin/remove-tenant', methods=['POST'])
 @csrf.exempt  # API endpoint
 @login_required
 @permission_required('manage_users')
@@ -877,7 +1146,7 @@ def remove_tenant():
     except (ValueError, TypeError):
         return jsonify({'error': 'Invalid user_id'}), 400
     
-    admin_tenant_id = session.get('tenant_id')
+    admin_tenant_id = g.user.get('tenant_id')
     if not admin_tenant_id:
         return jsonify({'error': 'You must be assigned to a tenant'}), 403
     
@@ -895,8 +1164,8 @@ def remove_tenant():
             ip_address, user_agent = get_client_info()
             try:
                 log_audit(
-                    user_id=session['user_id'],
-                    username=session['username'],
+                    user_id=g.user['user_id'],
+                    username=g.user['username'],
                     action='remove_user_from_tenant',
                     resource='admin',
                     expression=f'Removed user {removed_username} (ID: {user_id}) from tenant_id {admin_tenant_id}',
@@ -918,8 +1187,9 @@ def remove_tenant():
         traceback.print_exc()
         return jsonify({'error': f'Failed to remove user: {str(e)}'}), 500
 
-@app.route('/api/auth/refresh', methods=['POST'])
+@bp.route('/api/auth/refresh', methods=['POST'])
 @csrf.exempt  # Exempt from CSRF - uses JWT token in Authorization header (not vulnerable to CSRF)
+@rate_limited('refresh', key=client_address)
 def refresh_token():
     """Refresh JWT token"""
     token = get_token_from_request()
@@ -930,8 +1200,8 @@ def refresh_token():
     if not payload:
         return jsonify({'error': 'Invalid token'}), 401
     
-    # Generate new token
-    new_token = generate_token(
+    # Generate new token (fat tokens get freshly read permissions/settings)
+    new_token = issue_token(
         payload['user_id'],
         payload['username'],
         payload.get('role_name', 'user'),
@@ -943,5 +1213,99 @@ def refresh_token():
         'token': new_token
     })
 
+@bp.route('/admin/sql-profile', methods=['GET', 'DELETE'])
+@csrf.exempt  # API endpoint (JWT token in header)
+@login_required
+@permission_required('manage_users')
+def sql_profile():
+    """Top SQL statements by time for this worker (SQL_PROFILE=true); DELETE resets the counters"""
+    if not sql_profiler.ENABLED:
+        return jsonify({'error': 'SQL profiling is disabled (set SQL_PROFILE=true)'}), 404
+    if request.method == 'DELETE':
+        sql_profiler.profiler.reset()
+        return jsonify({'success': True})
+    
+    sort = request.args.get('sort', 'total')
+    if sort not in ('total', 'max', 'count', 'rows'):
+        return jsonify({'error': 'sort must be one of total, max, count, rows'}), 400
+    limit = max(1, min(request.args.get('limit', 20, type=int), 200))
+    return jsonify({
+        'pid': os.getpid(),
+        'slow_query_ms': sql_profiler.profiler.slow_query_ms,
+        'slow_queries': sql_profiler.profiler.slow_queries,
+        'statements': sql_profiler.profiler.top(limit, sort)
+    })
+
+@bp.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus metrics aggregated across all gunicorn workers (keep this port internal)"""
+    if not METRICS_ENABLED:
+        return jsonify({'error': 'Not found'}), 404
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''),
+                                                 f'Bearer {METRICS_TOKEN}'):
+        return jsonify({'error': 'Authentication required'}), 401
+    metrics.sync_worker_stats(calc_cache, audit_writer.writer, eval_pool.pool)
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+@bp.cli.command('rebuild-audit-counts')
+@click.option('--tenant-id', type=int, default=None, help='Only rebuild one tenant')
+def rebuild_audit_counts_command(tenant_id):
+    """Recompute the /audit/users counters from audit_logs"""
+    rebuild_audit_user_counts(tenant_id)
+    click.echo('Audit user counts rebuilt' + (f' for tenant {tenant_id}' if tenant_id else ''))
+
+@bp.cli.command('migrate-db')
+def migrate_db_command():
+    """Apply pending schema migrations"""
+    applied = migrate()
+    if applied:
+        click.echo(f'Applied migrations {", ".join(map(str, applied))}; schema version {SCHEMA_VERSION}')
+    else:
+        click.echo(f'Schema is up to date (version {get_schema_version()})')
+
+@bp.cli.command('set-eval-limits')
+@click.argument('tenant_id', type=int)
+@click.option('--max-digits', type=int, default=None, help='Largest integer result, in decimal digits')
+@click.option('--overflow', type=click.Choice(['error', 'scientific']), default=None,
+              help='Over-budget results: error or scientific-notation approximation')
+def set_eval_limits_command(tenant_id, max_digits, overflow):
+    """Give a tenant its own evaluation budget (no options: back to the defaults)"""
+    try:
+        EvaluationLimits(max_digits=max_digits or calculator.limits.max_digits,
+                         overflow=overflow or calculator.limits.overflow)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    set_tenant_eval_limits(tenant_id, max_digits=max_digits, overflow=overflow)
+    click.echo(f'Evaluation limits for tenant {tenant_id}: ' +
+               (f'max_digits={max_digits}, overflow={overflow}' if max_digits or overflow else 'defaults'))
+
+def create_app():
+    """Build the Flask app.
+
+    Importing this module only defines the blueprint and per-process state
+    (caches, the evaluator); everything bound to an app happens here. With
+    gunicorn's preload_app the master builds it once and workers share the
+    pages copy-on-write (see gunicorn_config.py).
+    """
+    app = Flask(__name__)
+    app.secret_key = SECRET_KEY
+
+    # Session configuration for security
+    app.config['SESSION_COOKIE_SECURE'] = False  # Set to True in production with HTTPS
+    app.config['SESSION_COOKIE_HTTPONLY'] = True
+    app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
+    app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
+
+    CORS(app, resources=CORS_RESOURCES)
+    csrf.init_app(app)
+    app.register_blueprint(bp)
+
+    # Schema check on startup (gunicorn migrates once in the master; see gunicorn_config.py)
+    ensure_schema()
+    return app
+
+app = create_app()
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5002, debug=False)
\ No newline at end of file
@@ -0,0 +1,341 @@
+import math
+import operator
+import re
+import sys
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+# Token pattern: a number (123, 1.5, .5, 5.) or any single non-space character.
+# ASCII digits only: \d would also accept e.g. Arabic-Indic or fullwidth digits
+_TOKEN_RE = re.compile(r'\s*(?:([0-9]+\.?[0-9]*|\.[0-9]+)|(\S))')
+
+# Whitespace that separates two numbers is kept ("2 3" must stay invalid)
+_SPACE_RE = re.compile(r'\s+')
+_NUMBER_CHARS = frozenset('0123456789.')
+
+# Marker for unary negation in compiled programs
+NEG = 'neg'
+
+# Unary minus binds tighter than * and / but looser than ^ (so -2^2 == -4)
+UNARY_PRECEDENCE = 3
+
+_LOG10_2 = math.log10(2)
+
+RESULT_TOO_LARGE = 'Result too large'
+
+
+class ExpressionError(ValueError):
+    """Raised when an expression cannot be tokenized or parsed"""
+
+
+class ResultTooLarge(ExpressionError):
+    """An integer operation would exceed the evaluation budget.
+
+    log10 is the estimated magnitude of the value it would have produced;
+    final is set when that value would have been the expression's result.
+    """
+
+    def __init__(self, log10, negative=False, final=False):
+        super().__init__(RESULT_TOO_LARGE)
+        self.log10 = log10
+        self.negative = negative
+        self.final = final
+
+
+@dataclass(frozen=True)
+class EvaluationLimits:
+    """Cost budget for one evaluation.
+
+    Integer arithmetic is exact, so a single ^ can ask for millions of digits
+    (and str() of the result is quadratic). Every integer ^, * and + / - is
+    checked against max_digits before (or, for + and -, right after) it runs.
+    overflow='scientific' reports an over-budget final result as an
+    approximation such as 3.67868e+499994 instead of an error.
+    """
+    max_digits: int = 4300  # CPython's own int <-> str conversion limit
+    overflow: str = 'error'
+
+    def __post_init__(self):
+        if self.max_digits < 1:
+            raise ValueError('max_digits must be positive')
+        # Larger results could be computed but not converted to a string
+        str_limit = sys.get_int_max_str_digits() if hasattr(sys, 'get_int_max_str_digits') else 0
+        if str_limit and self.max_digits > str_limit:
+            raise ValueError(f'max_digits cannot exceed the interpreter limit of {str_limit}')
+        if self.overflow not in ('error', 'scientific'):
+            raise ValueError(f'Unknown overflow policy: {self.overflow}')
+
+    @property
+    def max_bits(self):
+        return int(self.max_digits / _LOG10_2)
+
+
+def format_scientific(log10, negative=False, digits=6):
+    """Scientific notation for a value known only by its base-10 logarithm"""
+    exponent = math.floor(log10)
+    mantissa = round(10 ** (log10 - exponent), digits - 1)
+    if mantissa >= 10:
+        mantissa, exponent = mantissa / 10, exponent + 1
+    sign = '-' if negative else ''
+    return f'{sign}{mantissa:.{digits - 1}f}e+{exponent}'
+
+
+def normalize_expression(expression):
+    """Canonical form of an expression: insignificant whitespace removed, ** written as ^"""
+    # Only a ** typed as one token is an exponent: "2* *3" must stay invalid
+    expression = expression.strip().replace('**', '^')
+    return _SPACE_RE.sub(_collapse_space, expression)
+
+
+def _collapse_space(match):
+    text = match.string
+    if text[match.start() - 1] in _NUMBER_CHARS and text[match.end()] in _NUMBER_CHARS:
+        return ' '
+    return ''
+
+
+class ResultCache:
+    """Thread-safe LRU cache of evaluation results bounded by entry count and memory"""
+
+    # Rough per-entry bookkeeping cost (OrderedDict node + size record)
+    ENTRY_OVERHEAD = 100
+
+    def __init__(self, max_entries=4096, max_bytes=4 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = sys.getsizeof(key) + sys.getsizeof(value) + self.ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return  # Never cache a single entry that would flush everything else
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+class Calculator:
+    def __init__(self, cache=None, limits=None, offload=None):
+        # Operator table: symbol -> (function, precedence)
+        self.operators = {
+            '+': (operator.add, 1),
+            '-': (operator.sub, 1),
+            '*': (operator.mul, 2),
+            '/': (operator.truediv, 2),
+            '^': (operator.pow, 3),
+        }
+        self.right_associative = {'^'}
+        self.cache = cache
+        self.limits = limits or EvaluationLimits()
+        # Optional backend for expensive expressions (eval_pool.EvaluationPool)
+        self.offload = offload
+
+    def evaluate(self, expression, limits=None):
+        """Evaluate an expression to its result string (limits: per-call budget override)"""
+        expression = normalize_expression(expression)
+        if limits is None:
+            limits = self.limits
+        if self.cache is None:
+            return self._run(expression, limits)
+
+        # Results depend on the budget, so non-default budgets get their own keys
+        key = expression if limits is self.limits else (expression, limits)
+        result = self.cache.get(key)
+        if result is None:
+            result = self._run(expression, limits)
+            self.cache.put(key, result)
+        return result
+
+    def _run(self, expression, limits):
+        if self.offload is not None and self.offload.should_offload(expression):
+            return self.offload.evaluate(expression, limits)
+        return self._evaluate(expression, limits)
+
+    def _evaluate(self, expression, limits):
+        try:
+            program = self.compile(expression)
+            result = self.execute(program, limits)
+
+            # Handle division by zero
+            if isinstance(result, float) and result == float('inf'):
+                return "Division by zero"
+
+            return str(result)
+        except ResultTooLarge as e:
+            if e.final and limits.overflow == 'scientific':
+                return format_scientific(e.log10, e.negative)
+            return str(e)
+        except ExpressionError as e:
+            return str(e)
+        except ZeroDivisionError:
+            return "Division by zero"
+        except (OverflowError, MemoryError):
+            # Float pow out of range, int / int beyond float range, or an
+            # evaluation process hitting its memory limit
+            return RESULT_TOO_LARGE
+        except Exception:
+            return "Invalid expression"
+
+    def is_valid_expression(self, expression):
+        try:
+            self.compile(expression)
+        except ExpressionError:
+            return False
+        return True
+
+    def tokenize(self, expression):
+        """Split an expression into numbers (int/float) and operator symbols"""
+        tokens = []
+        for match in _TOKEN_RE.finditer(expression):
+            number, symbol = match.groups()
+            if number is not None:
+                tokens.append(float(number) if '.' in number else int(number))
+            elif symbol in self.operators or symbol in '()':
+                tokens.append(symbol)
+            elif symbol == '.':
+                raise ExpressionError('Invalid expression')
+            else:
+                raise ExpressionError('Invalid characters in expression')
+        if not tokens:
+            raise ExpressionError('Invalid expression')
+        return tokens
+
+    def compile(self, expression):
+        """Compile an expression into a postfix program (tuple of numbers and operators)"""
+        tokens = self.tokenize(expression)
+        program = []
+        try:
+            pos = self._parse_expression(tokens, 0, 1, program)
+        except RecursionError:
+            raise ExpressionError('Invalid expression')
+        if pos != len(tokens):
+            raise ExpressionError('Invalid expression')
+        return tuple(program)
+
+    def execute(self, program, limits=None):
+        """Run a compiled program on a value stack, enforcing the integer budget"""
+        operators = self.operators
+        max_bits = (limits or self.limits).max_bits
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        for index, item in enumerate(program):
+            if item.__class__ is str:
+                if item == NEG:
+                    stack[-1] = -stack[-1]
+                    continue
+                right = pop()
+                left = stack[-1]
+                if left.__class__ is int and right.__class__ is int:
+                    try:
+                        stack[-1] = _checked_int_op(item, left, right, max_bits)
+                    except ResultTooLarge as e:
+                        # Only negations left: the over-budget value is the result
+                        rest = program[index + 1:]
+                        e.final = all(op == NEG for op in rest)
+                        e.negative ^= len(rest) % 2 == 1
+                        raise
+                else:
+                    stack[-1] = operators[item][0](left, right)
+            else:
+                push(item)
+        return stack[0]
+
+    def _parse_expression(self, tokens, pos, min_precedence, out):
+        # Precedence climbing: parse an operand, then fold in operators whose
+        # precedence is at least min_precedence
+        pos = self._parse_operand(tokens, pos, out)
+        while pos < len(tokens):
+            token = tokens[pos]
+            entry = self.operators.get(token) if token.__class__ is str else None
+            if entry is None or entry[1] < min_precedence:
+                break
+            precedence = entry[1]
+            if token not in self.right_associative:
+                precedence += 1
+            pos = self._parse_expression(tokens, pos + 1, precedence, out)
+            out.append(token)
+        return pos
+
+    def _parse_operand(self, tokens, pos, out):
+        if pos >= len(tokens):
+            raise ExpressionError('Invalid expression')
+        token = tokens[pos]
+        if token.__class__ is not str:
+            out.append(token)
+            return pos + 1
+        if token == '(':
+            pos = self._parse_expression(tokens, pos + 1, 1, out)
+            if pos >= len(tokens) or tokens[pos] != ')':
+                raise ExpressionError('Invalid expression')
+            return pos + 1
+        if token == '-':
+            # Negative numbers: - at start, after ( or after another operator
+            pos = self._parse_expression(tokens, pos + 1, UNARY_PRECEDENCE, out)
+            out.append(NEG)
+            return pos
+        if token == '+' and (pos == 0 or tokens[pos - 1] not in ('+', '*', '/')):
+            # Unary plus is a no-op, but ++, *+ and /+ stay invalid
+            return self._parse_expression(tokens, pos + 1, UNARY_PRECEDENCE, out)
+        raise ExpressionError('Invalid expression')
+
+
+def _checked_int_op(op, left, right, max_bits):
+    """Apply an integer operator, refusing results estimated to exceed max_bits"""
+    if op == '^':
+        if right > 0 and abs(left) > 1:
+            # |left|^right has about right * log2|left| bits: estimate before computing
+            log2 = math.log2(abs(left))
+            if right * log2 > max_bits:
+                raise ResultTooLarge(right * log2 * _LOG10_2, left < 0 and right % 2 == 1)
+        return left ** right
+    if op == '*':
+        # The product has at least bits(left) + bits(right) - 1 bits
+        if left and right and left.bit_length() + right.bit_length() - 1 > max_bits:
+            raise ResultTooLarge(math.log10(abs(left)) + math.log10(abs(right)),
+                                 (left < 0) != (right < 0))
+        return left * right
+    if op == '/':
+        return left / right
+    result = left + right if op == '+' else left - right
+    if result.bit_length() > max_bits:
+        raise ResultTooLarge(math.log10(abs(result)), result < 0)
+    return result
@@ -1,129 +1,570 @@
 import sqlite3
+import base64
 import hashlib
 import datetime
+import json
+import logging
+import os
+import random
+import threading
+import time
 from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from functools import wraps
 
-DATABASE = 'calculator.db'
+import instrumentation
+import sql_profiler
+from instrumentation import instrumented
+
+DATABASE = os.environ.get('DATABASE_PATH', 'calculator.db')
+
+@dataclass(frozen=True)
+class StorageProfile:
+    """SQLite tuning applied to every connection handed out by get_db"""
+    journal_mode: str = 'WAL'
+    synchronous: str = 'NORMAL'
+    cache_size: int = -16000          # negative = KiB (16 MiB page cache per connection)
+    mmap_size: int = 64 * 1024 * 1024
+    busy_timeout_ms: int = 5000       # how long SQLite itself waits on a lock
+    busy_retries: int = 5             # extra attempts for write functions after a lock timeout
+    busy_backoff: float = 0.05        # first retry delay in seconds, doubled per attempt
+
+    def apply(self, conn):
+        conn.execute(f'PRAGMA journal_mode = {self.journal_mode}')
+        conn.execute(f'PRAGMA synchronous = {self.synchronous}')
+        conn.execute(f'PRAGMA cache_size = {int(self.cache_size)}')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout_ms)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+
+STORAGE_PROFILES = {
+    # Concurrent readers with a single writer, fsync only at checkpoints
+    'wal': StorageProfile(),
+    # SQLite defaults (rollback journal, fsync on every commit)
+    'legacy': StorageProfile(journal_mode='DELETE', synchronous='FULL', cache_size=-2000,
+                             mmap_size=0, busy_retries=0),
+}
+
+def storage_profile_from_env():
+    """Build the storage profile from DB_STORAGE_PROFILE plus optional DB_* overrides"""
+    name = os.environ.get('DB_STORAGE_PROFILE', 'wal').lower()
+    if name not in STORAGE_PROFILES:
+        raise ValueError(f'Unknown DB_STORAGE_PROFILE: {name}')
+    overrides = {}
+    for field, env_name, cast in (
+        ('journal_mode', 'DB_JOURNAL_MODE', str),
+        ('synchronous', 'DB_SYNCHRONOUS', str),
+        ('cache_size', 'DB_CACHE_SIZE', int),
+        ('mmap_size', 'DB_MMAP_SIZE', int),
+        ('busy_timeout_ms', 'DB_BUSY_TIMEOUT_MS', int),
+        ('busy_retries', 'DB_BUSY_RETRIES', int),
+        ('busy_backoff', 'DB_BUSY_BACKOFF', float),
+    ):
+        if os.environ.get(env_name):
+            overrides[field] = cast(os.environ[env_name])
+    return replace(STORAGE_PROFILES[name], **overrides)
+
+STORAGE_PROFILE = storage_profile_from_env()
+
+# Persistent connections, reopened when DATABASE changes or after fork.
+# DB_CONNECTION_STRATEGY picks how they are shared:
+#   thread - one connection per thread, kept for the thread's lifetime (sync/gthread workers)
+#   pool   - a bounded pool; the outermost get_db block checks a connection out and
+#            returns it (gevent workers, where every request is a short-lived greenlet)
+CONNECTION_STRATEGY = os.environ.get('DB_CONNECTION_STRATEGY', 'thread').lower()
+if CONNECTION_STRATEGY not in ('thread', 'pool'):
+    raise ValueError(f'Unknown DB_CONNECTION_STRATEGY: {CONNECTION_STRATEGY}')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 16))
+
+_local = threading.local()
+_connections = []  # (pid, connection) for every pooled connection opened in this process
+_connections_lock = threading.Lock()
+_pool_generation = 0  # bumped by close_all_connections so other threads reopen
+_idle = []  # (pid, path, generation, connection) available for checkout (pool strategy)
+_pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+
+def configure_storage(profile):
+    """Switch to a different storage profile; pooled connections are reopened"""
+    global STORAGE_PROFILE
+    STORAGE_PROFILE = profile
+    close_all_connections()
+
+def _connect(path):
+    """Open a new SQLite connection and apply per-connection settings once"""
+    profile = STORAGE_PROFILE
+    # SQL_PROFILE=true swaps in a connection class that times every statement
+    factory = sql_profiler.ProfilingConnection if sql_profiler.ENABLED else sqlite3.Connection
+    conn = sqlite3.connect(path, timeout=profile.busy_timeout_ms / 1000, check_same_thread=False,
+                           factory=factory)
+    conn.row_factory = sqlite3.Row
+    profile.apply(conn)
+    # Per-request query counts for Server-Timing / request logs; with both off
+    # no Python callback runs per statement
+    if instrumentation.enabled():
+        conn.set_trace_callback(instrumentation.count_statement)
+    return conn
+
+def _get_connection():
+    """Return this thread's pooled connection, opening one if needed"""
+    if CONNECTION_STRATEGY == 'pool':
+        return _checkout()
+    pid = os.getpid()
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == pid and _local.generation == _pool_generation:
+        if _local.path == DATABASE:
+            return conn
+        # DATABASE was repointed (e.g. tests) - drop the stale connection
+        _release(conn)
+    # Connections inherited across fork are never reused (or closed) by the child
+    if getattr(_local, 'pid', None) != pid:
+        _local.depth = 0
+    return _adopt(_open_registered(), pid)
+
+def _open_registered():
+    pid = os.getpid()
+    conn = _connect(DATABASE)
+    with _connections_lock:
+        _connections.append((pid, conn))
+    return conn
+
+def _adopt(conn, pid):
+    _local.conn = conn
+    _local.path = DATABASE
+    _local.pid = pid
+    _local.generation = _pool_generation
+    return conn
+
+def _checkout():
+    """Pool strategy: the current connection inside a get_db block, else one from the pool"""
+    pid = os.getpid()
+    if getattr(_local, 'depth', 0) and getattr(_local, 'pid', None) == pid and _local.conn is not None:
+        return _local.conn
+    _local.depth = 0
+    # Blocks (cooperatively under gevent) while DB_POOL_SIZE connections are checked out
+    _pool_slots.acquire()
+    try:
+        conn = None
+        with _connections_lock:
+            while _idle:
+                owner, path, generation, candidate = _idle.pop()
+                if owner == pid and path == DATABASE and generation == _pool_generation:
+                    conn = candidate
+                    break
+                if owner == pid:
+                    candidate.close()  # stale: repointed DATABASE or closed by close_all_connections
+        if conn is None:
+            conn = _open_registered()
+    except BaseException:
+        _pool_slots.release()
+        raise
+    return _adopt(conn, pid)
+
+def _checkin():
+    """Pool strategy: return the connection taken by the outermost get_db block"""
+    conn = _local.conn
+    _local.conn = None
+    if _local.pid != os.getpid():
+        return
+    if _local.generation == _pool_generation and _local.path == DATABASE:
+        with _connections_lock:
+            _idle.append((_local.pid, _local.path, _local.generation, conn))
+    else:
+        _release(conn)
+    _pool_slots.release()
+
+def _release(conn):
+    with _connections_lock:
+        _connections[:] = [entry for entry in _connections if entry[1] is not conn]
+    conn.close()
+
+def close_db():
+    """Close the current thread's pooled connection"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid():
+        _release(conn)
+    _local.conn = None
+
+def close_all_connections():
+    """Close every pooled connection opened by this process (worker shutdown, tests)"""
+    global _pool_generation
+    pid = os.getpid()
+    with _connections_lock:
+        _pool_generation += 1
+        owned = [conn for owner, conn in _connections if owner == pid]
+        _connections[:] = [entry for entry in _connections if entry[0] != pid]
+        _idle[:] = [entry for entry in _idle if entry[0] != pid]
+    for conn in owned:
+        conn.close()
+    _local.conn = None
+
+_inherited = []  # connections forked from the parent; kept referenced so they are never closed here
+
+def reinit_after_fork():
+    """Forget connections and locks inherited from the parent (gunicorn preload_app).
+
+    A SQLite handle must not be used in both processes, and closing one in
+    the child could checkpoint or unlock on the parent's behalf, so inherited
+    handles are parked instead. Locks are recreated in case another parent
+    thread held one at fork time. The worker opens its own connections on
+    first use.
+    """
+    global _connections_lock, _pool_slots, _local
+    _inherited.extend(conn for _, conn in _connections)
+    _inherited.extend(entry[3] for entry in _idle)
+    _connections.clear()
+    _idle.clear()
+    _connections_lock = threading.Lock()
+    _pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+    _local = threading.local()
 
 @contextmanager
 def get_db():
-    """Context manager for database connections"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
+    """Context manager for database connections.
+
+    Hands out the calling thread's persistent connection (or, with the pool
+    strategy, one checked out for the outermost block). Only the outermost
+    block commits or rolls back, so nested use shares one transaction.
+    """
+    conn = _get_connection()
+    _local.depth += 1
+    start = None
+    if _local.depth == 1:
+        start = time.perf_counter()
+        _local.after_commit = []
     try:
         yield conn
-        conn.commit()
-    except Exception:
-        conn.rollback()
+        if _local.depth == 1:
+            conn.commit()
+            callbacks, _local.after_commit = _local.after_commit, []
+            for callback in callbacks:
+                callback()
+    except BaseException:
+        # BaseException too: GeneratorExit from an abandoned streamed response, a
+        # gevent Timeout or SystemExit must not leave the persistent (or pooled)
+        # connection inside a transaction for the next request
+        if _local.depth == 1:
+            conn.rollback()
+            _local.after_commit = []
         raise
     finally:
-        conn.close()
+        _local.depth -= 1
+        if start is not None:
+            instrumentation.record_db_time(time.perf_counter() - start)
+            if CONNECTION_STRATEGY == 'pool':
+                _checkin()
 
-def init_db():
-    """Initialize database with all required tables"""
+def _after_commit(callback):
+    """Run callback once the outermost get_db block commits (dropped if it rolls back)"""
+    if getattr(_local, 'depth', 0):
+        _local.after_commit.append(callback)
+    else:
+        callback()
+
+def is_busy_error(error):
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+def retry_on_busy(func):
+    """Retry a write function with exponential backoff when SQLite reports a lock timeout.
+
+    Only top-level calls are retried: inside an outer get_db block the
+    transaction belongs to the caller.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if (not is_busy_error(e) or attempt >= STORAGE_PROFILE.busy_retries
+                        or getattr(_local, 'depth', 0) > 0):
+                    raise
+                delay = STORAGE_PROFILE.busy_backoff * (2 ** attempt)
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                attempt += 1
+    return wrapper
+
+# Schema migrations, applied in order and recorded in PRAGMA user_version.
+# Never edit a released migration: append a new one. Databases created
+# before versioning (user_version 0) are adopted by the baseline, whose
+# statements are all idempotent.
+
+def _add_column_if_missing(cursor, table, column, definition):
+    columns = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+    if column in columns:
+        return False
+    cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
+def _migration_1_baseline(cursor):
+    """Tables, indexes, triggers and default roles/users as of the first versioned release"""
+    # Tenants table (for multitenancy)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tenants (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Users table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT,
+            email TEXT UNIQUE,
+            google_id TEXT UNIQUE,
+            role_id INTEGER,
+            tenant_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_login TIMESTAMP,
+            FOREIGN KEY (role_id) REFERENCES roles(id),
+            FOREIGN KEY (tenant_id) REFERENCES tenants(id)
+        )
+    ''')
+    
+    # Databases created before Google sign-in (SQLite cannot add a UNIQUE column)
+    if _add_column_if_missing(cursor, 'users', 'google_id', 'TEXT'):
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_users_google_id ON users(google_id)')
+    
+    # Roles table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS roles (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            description TEXT
+        )
+    ''')
+    
+    # Permissions table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS permissions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            description TEXT
+        )
+    ''')
+    
+    # Role-Permission mapping table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS role_permissions (
+            role_id INTEGER,
+            permission_id INTEGER,
+            PRIMARY KEY (role_id, permission_id),
+            FOREIGN KEY (role_id) REFERENCES roles(id),
+            FOREIGN KEY (permission_id) REFERENCES permissions(id)
+        )
+    ''')
+    
+    # User settings table (for restrictions)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id INTEGER PRIMARY KEY,
+            allow_parentheses INTEGER DEFAULT 1,
+            allow_exponents INTEGER DEFAULT 1,
+            settings_version INTEGER DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    
+    # Databases created before settings versions
+    _add_column_if_missing(cursor, 'user_settings', 'settings_version', 'INTEGER DEFAULT 0')
+    
+    # Audit logs table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS audit_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            username TEXT,
+            tenant_id INTEGER,
+            action TEXT NOT NULL,
+            resource TEXT,
+            expression TEXT,
+            result TEXT,
+            ip_address TEXT,
+            user_agent TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (tenant_id) REFERENCES tenants(id)
+        )
+    ''')
+    
+    # Calculation history (written alongside the 'calculate' audit rows so
+    # /history is a single index range scan instead of filtering audit_logs)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS calculations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            tenant_id INTEGER,
+            expression TEXT NOT NULL,
+            result TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (tenant_id) REFERENCES tenants(id)
+        )
+    ''')
+    # Covering index: history pages never touch the table itself
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_calculations_user
+        ON calculations(user_id, id DESC, expression, result, timestamp)
+    ''')
+    # One-time backfill from existing audit logs
+    cursor.execute('''
+        INSERT INTO calculations (user_id, tenant_id, expression, result, timestamp)
+        SELECT user_id, tenant_id, expression, result, timestamp
+        FROM audit_logs
+        WHERE action = 'calculate' AND user_id IS NOT NULL AND expression IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM calculations)
+        ORDER BY id
+    ''')
+    
+    # Per-user audit log counts for /audit/users, kept current by a trigger
+    # (rebuild_audit_user_counts reconciles them if they ever drift)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS audit_user_counts (
+            tenant_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            log_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (tenant_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_audit_user_counts
+        AFTER INSERT ON audit_logs
+        WHEN NEW.tenant_id IS NOT NULL AND NEW.user_id IS NOT NULL
+        BEGIN
+            INSERT INTO audit_user_counts (tenant_id, user_id, log_count)
+            VALUES (NEW.tenant_id, NEW.user_id, 1)
+            ON CONFLICT (tenant_id, user_id) DO UPDATE SET log_count = log_count + 1;
+        END
+    ''')
+    cursor.execute('SELECT 1 FROM audit_user_counts LIMIT 1')
+    if cursor.fetchone() is None:
+        _rebuild_audit_user_counts(cursor)
+    
+    # Cache generation counters (lets every worker notice RBAC/tenant changes)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cache_generations (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO cache_generations (name) VALUES ('rbac'), ('settings'), ('limits')")
+    
+    # Per-tenant evaluation budgets (NULL columns fall back to the CALC_* defaults)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tenant_eval_limits (
+            tenant_id INTEGER PRIMARY KEY,
+            max_digits INTEGER,
+            overflow TEXT,
+            FOREIGN KEY (tenant_id) REFERENCES tenants (id)
+        )
+    ''')
+    
+    # Indexes, one per access path (tests/test_query_plans.py keeps them honest).
+    # Audit pages are keyed on (timestamp, id), so every audit index ends with both.
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_audit_tenant_time ON audit_logs(tenant_id, timestamp, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_audit_tenant_user_time ON audit_logs(tenant_id, user_id, timestamp, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_audit_user_time ON audit_logs(user_id, timestamp, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_audit_time ON audit_logs(timestamp, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_calculations_tenant ON calculations(tenant_id)')
+    # Tenant user listings come back sorted by username straight from the index
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_tenant_username ON users(tenant_id, username)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_tenant_created ON users(tenant_id, created_at)')
+    # Superseded by the composite indexes above (username/email/google_id are
+    # already covered by their UNIQUE constraints)
+    for index in ('idx_audit_user', 'idx_audit_timestamp', 'idx_users_username'):
+        cursor.execute(f'DROP INDEX IF EXISTS {index}')
+    
+    # Default tenant, roles, permissions and users
+    init_default_data(cursor)
+
+def _migration_2_rate_limits(cursor):
+    """Shared state for rate_limiter.py: token buckets and per-tenant admission leases"""
+    # One row per key that took a token recently; rows of full buckets are swept
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    # One row per in-flight request of a tenant with a concurrency quota; a
+    # worker that dies mid-request leaves a row that stops counting at expires_at.
+    # AUTOINCREMENT so a late release can never free a reused id.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admission_leases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tenant_id INTEGER NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_admission_leases_tenant ON admission_leases(tenant_id, expires_at)
+    ''')
+    # The periodic sweep (prune_rate_limits) deletes by age alone
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_rate_limit_buckets_updated ON rate_limit_buckets(updated_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_admission_leases_expires ON admission_leases(expires_at)')
+
+MIGRATIONS = [
+    (1, _migration_1_baseline),
+    (2, _migration_2_rate_limits),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version():
+    """The database's PRAGMA user_version (0 for a new or pre-versioning database)"""
     with get_db() as conn:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+
+@retry_on_busy
+def migrate():
+    """Apply pending migrations; returns the versions applied.
+
+    Runs under BEGIN IMMEDIATE and re-reads the version inside the
+    transaction, so processes racing to migrate apply each step once.
+    Must be called outside any get_db block: migrations commit on their own.
+    """
+    applied = []
+    with get_db() as conn:
+        if _local.depth > 1 or conn.in_transaction:
+            raise RuntimeError('migrate() cannot run inside an open get_db transaction')
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return applied
+        conn.execute('BEGIN IMMEDIATE')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
         cursor = conn.cursor()
-        
-        # Tenants table (for multitenancy)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS tenants (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT,
-                email TEXT UNIQUE,
-                google_id TEXT UNIQUE,
-                role_id INTEGER,
-                tenant_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_login TIMESTAMP,
-                FOREIGN KEY (role_id) REFERENCES roles(id),
-                FOREIGN KEY (tenant_id) REFERENCES tenants(id)
-            )
-        ''')
-        
-        # Add google_id column if it doesn't exist (for existing databases)
-        try:
-            cursor.execute('ALTER TABLE users ADD COLUMN google_id TEXT UNIQUE')
-        except sqlite3.OperationalError:
-            pass  # Column already exists
-        
-        # Roles table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS roles (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE NOT NULL,
-                description TEXT
-            )
-        ''')
-        
-        # Permissions table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS permissions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE NOT NULL,
-                description TEXT
-            )
-        ''')
-        
-        # Role-Permission mapping table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS role_permissions (
-                role_id INTEGER,
-                permission_id INTEGER,
-                PRIMARY KEY (role_id, permission_id),
-                FOREIGN KEY (role_id) REFERENCES roles(id),
-                FOREIGN KEY (permission_id) REFERENCES permissions(id)
-            )
-        ''')
-        
-        # User settings table (for restrictions)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_settings (
-                user_id INTEGER PRIMARY KEY,
-                allow_parentheses INTEGER DEFAULT 1,
-                allow_exponents INTEGER DEFAULT 1,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        ''')
-        
-        # Audit logs table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS audit_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                username TEXT,
-                tenant_id INTEGER,
-                action TEXT NOT NULL,
-                resource TEXT,
-                expression TEXT,
-                result TEXT,
-                ip_address TEXT,
-                user_agent TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id),
-                FOREIGN KEY (tenant_id) REFERENCES tenants(id)
-            )
-        ''')
-        
-        # Create indexes for better performance
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_audit_user ON audit_logs(user_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_audit_timestamp ON audit_logs(timestamp)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)')
-        
-        # Initialize default roles and permissions if they don't exist
-        init_default_data(cursor)
-        
-        conn.commit()
+        for target, migration in MIGRATIONS:
+            if target <= version:
+                continue
+            migration(cursor)
+            cursor.execute(f'PRAGMA user_version = {int(target)}')
+            applied.append(target)
+    if applied:
+        logging.info(f'Database migrated to schema version {SCHEMA_VERSION} (applied {applied})')
+    return applied
+
+def init_db():
+    """Bring the schema up to date and warm the permission cache"""
+    migrate()
+    # Precompute the role -> permissions map once at startup
+    permission_cache.invalidate()
+    permission_cache.load_roles()
+
+def ensure_schema():
+    """Startup check: one PRAGMA read when the schema is current, otherwise migrate.
+
+    gunicorn_config.py migrates in the master before any worker starts, so
+    workers only check; flask run and tests migrate here on first use.
+    """
+    version = get_schema_version()
+    if version < SCHEMA_VERSION:
+        init_db()
+    elif version > SCHEMA_VERSION:
+        logging.warning(f'Database schema version {version} is newer than this code ({SCHEMA_VERSION})')
 
 def init_default_data(cursor):
     """Initialize default roles and permissions"""
@@ -219,6 +660,8 @@ def verify_password(password, password_hash):
     """Verify password against hash"""
     return hash_password(password) == password_hash
 
+@instrumented
+@retry_on_busy
 def authenticate_user(username, password):
     """Authenticate user and return user data if successful"""
     with get_db() as conn:
@@ -247,6 +690,8 @@ def authenticate_user(username, password):
             }
         return None
 
+@instrumented
+@retry_on_busy
 def authenticate_google_user(google_id, email, name):
     """Authenticate or create user via Google SSO"""
     with get_db() as conn:
@@ -339,6 +784,7 @@ def authenticate_google_user(google_id, email, name):
                 'role_name': 'user'
             }
 
+@instrumented
 def get_users_without_tenant():
     """Get all users without tenant assignment"""
     with get_db() as conn:
@@ -351,6 +797,8 @@ def get_users_without_tenant():
         ''')
         return [dict(row) for row in cursor.fetchall()]
 
+@instrumented
+@retry_on_busy
 def assign_user_to_tenant(user_id, tenant_id):
     """Assign a user to a tenant - validates both user and tenant exist"""
     with get_db() as conn:
@@ -370,9 +818,12 @@ def assign_user_to_tenant(user_id, tenant_id):
         cursor.execute('''
             UPDATE users SET tenant_id = ? WHERE id = ?
         ''', (tenant_id, user_id))
+        _bump_generation(conn, 'rbac')
         return cursor.rowcount > 0
 
 
+@instrumented
+@retry_on_busy
 def remove_user_from_tenant(user_id, admin_tenant_id):
     """Remove a user from a tenant (admin can only remove from their own tenant)"""
     with get_db() as conn:
@@ -390,10 +841,13 @@ def remove_user_from_tenant(user_id, admin_tenant_id):
         
         # Remove tenant assignment (set to NULL)
         cursor.execute('UPDATE users SET tenant_id = NULL WHERE id = ?', (user_id,))
+        _bump_generation(conn, 'rbac')
         conn.commit()
         return cursor.rowcount > 0
 
 
+@instrumented
+@retry_on_busy
 def create_user_by_email(email, tenant_id, username=None):
     """Create a new user by email and assign to tenant (admin function)"""
     with get_db() as conn:
@@ -462,6 +916,7 @@ def create_user_by_email(email, tenant_id, username=None):
             'tenant_id': tenant_id
         }
 
+@instrumented
 def get_all_tenants():
     """Get all tenants"""
     with get_db() as conn:
@@ -469,6 +924,8 @@ def get_all_tenants():
         cursor.execute('SELECT id, name, created_at FROM tenants ORDER BY name')
         return [dict(row) for row in cursor.fetchall()]
 
+@instrumented
+@retry_on_busy
 def create_tenant(name, admin_user_id):
     """Create a new tenant (admin only)"""
     with get_db() as conn:
@@ -488,10 +945,13 @@ def create_tenant(name, admin_user_id):
         
         # Assign admin to the new tenant
         cursor.execute('UPDATE users SET tenant_id = ? WHERE id = ?', (tenant_id, admin_user_id))
+        _bump_generation(conn, 'rbac')
         
         conn.commit()
         return {'success': True, 'tenant_id': tenant_id}
 
+@instrumented
+@retry_on_busy
 def delete_tenant(tenant_id, admin_tenant_id):
     """Delete a tenant (admin can only delete their own tenant)"""
     with get_db() as conn:
@@ -514,13 +974,18 @@ def delete_tenant(tenant_id, admin_tenant_id):
         
         # Delete audit logs for this tenant (optional cleanup)
         cursor.execute('DELETE FROM audit_logs WHERE tenant_id = ?', (tenant_id,))
+        cursor.execute('DELETE FROM calculations WHERE tenant_id = ?', (tenant_id,))
+        cursor.execute('DELETE FROM audit_user_counts WHERE tenant_id = ?', (tenant_id,))
+        cursor.execute('DELETE FROM tenant_eval_limits WHERE tenant_id = ?', (tenant_id,))
         
         # Delete the tenant record
         cursor.execute('DELETE FROM tenants WHERE id = ?', (tenant_id,))
+        _bump_generation(conn, 'rbac')
         conn.commit()
         
         return cursor.rowcount > 0
 
+@instrumented
 def check_duplicate_user(username=None, email=None, google_id=None):
     """Check if a user with given credentials already exists"""
     with get_db() as conn:
@@ -549,25 +1014,312 @@ def check_duplicate_user(username=None, email=None, google_id=None):
         return cursor.fetchone()
 
 
+class GenerationWatcher:
+    """Tracks one cache_generations counter, reading it at most every check_interval seconds"""
+
+    def __init__(self, name, check_interval=1.0):
+        self.name = name
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._value = None
+            self._checked_at = None
+            self._path = DATABASE
+
+    def current(self):
+        """Latest known generation (re-read when the check interval has passed)"""
+        with self._lock:
+            now = time.monotonic()
+            if (self._path == DATABASE and self._checked_at is not None
+                    and now - self._checked_at < self.check_interval):
+                return self._value
+        # Read outside the lock: threads racing here each get a fresh value
+        value = _read_generation(self.name)
+        with self._lock:
+            self._value = value
+            self._checked_at = now
+            self._path = DATABASE
+        return value
+
+class PermissionCache:
+    """Per-process RBAC cache: role -> permissions map plus user -> role lookups.
+
+    User entries expire after ttl seconds. The whole cache is dropped when
+    the 'rbac' generation changes, which any worker can trigger.
+    """
+
+    def __init__(self, ttl=60.0, check_interval=1.0):
+        self.ttl = ttl
+        self.watcher = GenerationWatcher('rbac', check_interval)
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._role_permissions = None
+        self._user_roles = {}
+        self._generation = None
+        self._path = DATABASE
+
+    def invalidate(self):
+        with self._lock:
+            self._reset()
+            self.watcher.reset()
+
+    def load_roles(self):
+        """Load the complete role -> permissions map (a handful of rows)"""
+        with get_db() as conn:
+            rows = conn.execute('''
+                SELECT rp.role_id, p.name
+                FROM role_permissions rp
+                JOIN permissions p ON p.id = rp.permission_id
+            ''').fetchall()
+        role_permissions = {}
+        for role_id, name in rows:
+            role_permissions.setdefault(role_id, set()).add(name)
+        with self._lock:
+            self._role_permissions = {
+                role_id: frozenset(names) for role_id, names in role_permissions.items()
+            }
+        return self._role_permissions
+
+    def get(self, user_id):
+        self._check_generation()
+        now = time.monotonic()
+        with self._lock:
+            role_permissions = self._role_permissions
+            entry = self._user_roles.get(user_id)
+        if role_permissions is None:
+            role_permissions = self.load_roles()
+        if entry is None or entry[1] < now:
+            with get_db() as conn:
+                row = conn.execute('SELECT role_id FROM users WHERE id = ?', (user_id,)).fetchone()
+            entry = (row[0] if row else None, now + self.ttl)
+            with self._lock:
+                self._user_roles[user_id] = entry
+        return role_permissions.get(entry[0], frozenset())
+
+    def _check_generation(self):
+        generation = self.watcher.current()
+        with self._lock:
+            if self._path != DATABASE or (self._generation is not None and generation != self._generation):
+                self._reset()
+            self._generation = generation
+
+class SettingsVersionCache:
+    """Per-process cache of user_settings.settings_version, dropped when the 'settings' generation changes"""
+
+    def __init__(self, ttl=60.0, check_interval=1.0):
+        self.ttl = ttl
+        self.watcher = GenerationWatcher('settings', check_interval)
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._versions = {}
+        self._generation = None
+        self._path = DATABASE
+
+    def invalidate(self):
+        with self._lock:
+            self._reset()
+            self.watcher.reset()
+
+    def get(self, user_id):
+        generation = self.watcher.current()
+        now = time.monotonic()
+        with self._lock:
+            if self._path != DATABASE or (self._generation is not None and generation != self._generation):
+                self._reset()
+            self._generation = generation
+            entry = self._versions.get(user_id)
+        if entry is None or entry[1] < now:
+            with get_db() as conn:
+                row = conn.execute('SELECT settings_version FROM user_settings WHERE user_id = ?',
+                                   (user_id,)).fetchone()
+            entry = (row[0] if row and row[0] is not None else 0, now + self.ttl)
+            with self._lock:
+                self._versions[user_id] = entry
+        return entry[0]
+
+class TenantLimitsCache:
+    """Per-process copy of tenant_eval_limits, reloaded when the 'limits' generation changes"""
+
+    def __init__(self, check_interval=1.0):
+        self.watcher = GenerationWatcher('limits', check_interval)
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._limits = None
+        self._generation = None
+        self._path = DATABASE
+
+    def invalidate(self):
+        with self._lock:
+            self._reset()
+            self.watcher.reset()
+
+    def get(self, tenant_id):
+        generation = self.watcher.current()
+        with self._lock:
+            if self._limits is not None and self._path == DATABASE and self._generation == generation:
+                return self._limits.get(tenant_id)
+        # One row per tenant with custom budgets: load them all
+        with get_db() as conn:
+            rows = conn.execute('SELECT tenant_id, max_digits, overflow FROM tenant_eval_limits').fetchall()
+        limits = {row['tenant_id']: {'max_digits': row['max_digits'], 'overflow': row['overflow']}
+                  for row in rows}
+        with self._lock:
+            self._limits = limits
+            self._generation = generation
+            self._path = DATABASE
+        return limits.get(tenant_id)
+
+def _read_generation(name):
+    with get_db() as conn:
+        try:
+            row = conn.execute('SELECT value FROM cache_generations WHERE name = ?', (name,)).fetchone()
+        except sqlite3.OperationalError:
+            return 0  # Table not created yet
+    return row[0] if row else 0
+
+def _bump_generation(conn, name):
+    """Bump a cache generation inside the caller's transaction and drop local caches once it commits"""
+    conn.execute('''
+        INSERT INTO cache_generations (name, value) VALUES (?, 1)
+        ON CONFLICT(name) DO UPDATE SET value = value + 1
+    ''', (name,))
+    # Dropping them now would let another thread reload the old rows before the
+    # commit and keep them until the next generation check
+    cache = {'rbac': permission_cache, 'settings': settings_version_cache,
+             'limits': tenant_limits_cache}.get(name)
+    if cache is not None:
+        _after_commit(cache.invalidate)
+
+def invalidate_permission_cache():
+    """Drop cached permissions in every worker (call after changing roles or role_permissions)"""
+    with get_db() as conn:
+        _bump_generation(conn, 'rbac')
+
+permission_cache = PermissionCache(
+    ttl=float(os.environ.get('PERMISSION_CACHE_TTL', 60)),
+    check_interval=float(os.environ.get('CACHE_GENERATION_CHECK_INTERVAL', 1.0))
+)
+
+settings_version_cache = SettingsVersionCache(
+    ttl=float(os.environ.get('PERMISSION_CACHE_TTL', 60)),
+    check_interval=float(os.environ.get('CACHE_GENERATION_CHECK_INTERVAL', 1.0))
+)
+
+tenant_limits_cache = TenantLimitsCache(
+    check_interval=float(os.environ.get('CACHE_GENERATION_CHECK_INTERVAL', 1.0))
+)
+
+def get_generation(name):
+    """Current value of a cache generation counter (polled, not read on every call)"""
+    if name == 'rbac':
+        return permission_cache.watcher.current()
+    if name == 'limits':
+        return tenant_limits_cache.watcher.current()
+    return settings_version_cache.watcher.current()
+
+@instrumented
+def get_tenant_eval_limits(tenant_id):
+    """A tenant's evaluation budget overrides ({'max_digits', 'overflow'}, None values = default) or None"""
+    return tenant_limits_cache.get(tenant_id)
+
+@instrumented
+@retry_on_busy
+def set_tenant_eval_limits(tenant_id, max_digits=None, overflow=None):
+    """Set a tenant's evaluation budget overrides; both None removes them"""
+    with get_db() as conn:
+        if max_digits is None and overflow is None:
+            conn.execute('DELETE FROM tenant_eval_limits WHERE tenant_id = ?', (tenant_id,))
+        else:
+            conn.execute('''
+                INSERT INTO tenant_eval_limits (tenant_id, max_digits, overflow) VALUES (?, ?, ?)
+                ON CONFLICT(tenant_id) DO UPDATE SET max_digits = excluded.max_digits,
+                                                     overflow = excluded.overflow
+            ''', (tenant_id, max_digits, overflow))
+        _bump_generation(conn, 'limits')
+
+@instrumented
+@retry_on_busy
+def take_rate_limit_tokens(key, cost, capacity, rate, now):
+    """Take cost tokens from a shared token bucket; returns (taken, tokens left).
+
+    The bucket holds up to capacity tokens and refills at rate tokens per
+    second. Refill and withdrawal are a single statement, so workers racing
+    on the same key never both spend the last token. A refused request
+    changes nothing; tokens left is then the current (too low) level.
+    """
+    with get_db() as conn:
+        row = conn.execute('''
+            INSERT INTO rate_limit_buckets (key, tokens, updated_at)
+            SELECT :key, level - :cost, :now FROM (
+                SELECT min(:capacity, coalesce(
+                    (SELECT tokens + max(:now - updated_at, 0) * :rate
+                     FROM rate_limit_buckets WHERE key = :key),
+                    :capacity)) AS level
+            ) WHERE level >= :cost
+            ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at
+            RETURNING tokens
+        ''', {'key': key, 'cost': cost, 'capacity': capacity, 'rate': rate, 'now': now}).fetchone()
+        if row is not None:
+            return True, row[0]
+        row = conn.execute('SELECT tokens, updated_at FROM rate_limit_buckets WHERE key = ?', (key,)).fetchone()
+        if row is None:  # cost is larger than the whole bucket
+            return False, capacity
+        return False, min(capacity, row[0] + max(now - row[1], 0) * rate)
+
+@instrumented
+@retry_on_busy
+def acquire_admission_lease(tenant_id, max_inflight, expires_at, now):
+    """Register an in-flight request for a tenant unless it already has max_inflight; lease id or None"""
+    with get_db() as conn:
+        row = conn.execute('''
+            INSERT INTO admission_leases (tenant_id, expires_at)
+            SELECT ?, ? WHERE (
+                SELECT COUNT(*) FROM admission_leases WHERE tenant_id = ? AND expires_at > ?
+            ) < ?
+            RETURNING id
+        ''', (tenant_id, expires_at, tenant_id, now, max_inflight)).fetchone()
+        return row[0] if row is not None else None
+
+@instrumented
+@retry_on_busy
+def release_admission_lease(lease_id):
+    with get_db() as conn:
+        conn.execute('DELETE FROM admission_leases WHERE id = ?', (lease_id,))
+
+@retry_on_busy
+def prune_rate_limits(full_before, now):
+    """Sweep buckets idle since full_before (refilled, so same as absent) and expired leases"""
+    with get_db() as conn:
+        buckets = conn.execute('DELETE FROM rate_limit_buckets WHERE updated_at < ?', (full_before,)).rowcount
+        leases = conn.execute('DELETE FROM admission_leases WHERE expires_at <= ?', (now,)).rowcount
+    return buckets, leases
+
+@instrumented
+def get_settings_version(user_id):
+    """Current settings_version for a user (cached per process)"""
+    return settings_version_cache.get(user_id)
+
+@instrumented
 def get_user_permissions(user_id):
     """Get all permissions for a user based on their role"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT p.name
-            FROM permissions p
-            JOIN role_permissions rp ON p.id = rp.permission_id
-            JOIN users u ON rp.role_id = u.role_id
-            WHERE u.id = ?
-        ''', (user_id,))
-        
-        return [row[0] for row in cursor.fetchall()]
+    return sorted(permission_cache.get(user_id))
 
+@instrumented
 def has_permission(user_id, permission_name):
     """Check if user has a specific permission"""
-    permissions = get_user_permissions(user_id)
-    return permission_name in permissions
+    return permission_name in permission_cache.get(user_id)
 
+@instrumented
+@retry_on_busy
 def log_audit(user_id, username, action, resource=None, expression=None, 
               result=None, ip_address=None, user_agent=None, tenant_id=None):
     """Log an audit event"""
@@ -584,43 +1336,217 @@ def log_audit(user_id, username, action, resource=None, expression=None,
             (user_id, username, tenant_id, action, resource, expression, result, ip_address, user_agent)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (user_id, username, tenant_id, action, resource, expression, result, ip_address, user_agent))
+        if action == 'calculate' and user_id is not None and expression is not None:
+            _record_calculations(cursor, [(user_id, tenant_id, expression, result)])
 
-def get_audit_logs(user_id=None, tenant_id=None, limit=100):
-    """Get audit logs, optionally filtered by user or tenant (multitenancy)"""
+@instrumented
+@retry_on_busy
+def log_audit_many(entries):
+    """Log several audit events in a single transaction.
+
+    Each entry is a dict with the same keys as log_audit's arguments.
+    """
+    if not entries:
+        return
     with get_db() as conn:
         cursor = conn.cursor()
-        if tenant_id:
-            # Multitenancy: only show logs for users in the same tenant
-            if user_id:
-                cursor.execute('''
-                    SELECT * FROM audit_logs 
-                    WHERE tenant_id = ? AND user_id = ?
-                    ORDER BY timestamp DESC
-                    LIMIT ?
-                ''', (tenant_id, user_id, limit))
-            else:
-                cursor.execute('''
-                    SELECT * FROM audit_logs 
-                    WHERE tenant_id = ?
-                    ORDER BY timestamp DESC
-                    LIMIT ?
-                ''', (tenant_id, limit))
-        elif user_id:
-            cursor.execute('''
-                SELECT * FROM audit_logs 
+        # Resolve missing tenant_ids once per user instead of once per row
+        tenant_ids = {}
+        for entry in entries:
+            user_id = entry.get('user_id')
+            if entry.get('tenant_id') is None and user_id not in tenant_ids:
+                cursor.execute('SELECT tenant_id FROM users WHERE id = ?', (user_id,))
+                tenant_row = cursor.fetchone()
+                tenant_ids[user_id] = tenant_row[0] if tenant_row else None
+
+        rows = []
+        for entry in entries:
+            tenant_id = entry.get('tenant_id')
+            if tenant_id is None:
+                tenant_id = tenant_ids.get(entry.get('user_id'))
+            rows.append((
+                entry.get('user_id'), entry.get('username'), tenant_id, entry['action'],
+                entry.get('resource'), entry.get('expression'), entry.get('result'),
+                entry.get('ip_address'), entry.get('user_agent')
+            ))
+
+        cursor.executemany('''
+            INSERT INTO audit_logs 
+            (user_id, username, tenant_id, action, resource, expression, result, ip_address, user_agent)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        _record_calculations(cursor, [
+            (user_id, tenant_id, expression, result)
+            for user_id, _, tenant_id, action, _, expression, result, _, _ in rows
+            if action == 'calculate' and user_id is not None and expression is not None
+        ])
+
+def _rebuild_audit_user_counts(cursor, tenant_id=None):
+    if tenant_id is None:
+        cursor.execute('DELETE FROM audit_user_counts')
+        cursor.execute('''
+            INSERT INTO audit_user_counts (tenant_id, user_id, log_count)
+            SELECT tenant_id, user_id, COUNT(*) FROM audit_logs
+            WHERE tenant_id IS NOT NULL AND user_id IS NOT NULL
+            GROUP BY tenant_id, user_id
+        ''')
+    else:
+        cursor.execute('DELETE FROM audit_user_counts WHERE tenant_id = ?', (tenant_id,))
+        cursor.execute('''
+            INSERT INTO audit_user_counts (tenant_id, user_id, log_count)
+            SELECT tenant_id, user_id, COUNT(*) FROM audit_logs
+            WHERE tenant_id = ? AND user_id IS NOT NULL
+            GROUP BY tenant_id, user_id
+        ''', (tenant_id,))
+
+@instrumented
+@retry_on_busy
+def rebuild_audit_user_counts(tenant_id=None):
+    """Recompute the per-user audit counters from audit_logs (all tenants or one)"""
+    with get_db() as conn:
+        _rebuild_audit_user_counts(conn.cursor(), tenant_id)
+
+@instrumented
+def get_audit_user_counts(tenant_id):
+    """Users in a tenant with their audit log counts, ordered by username"""
+    with get_db() as conn:
+        rows = conn.execute('''
+            SELECT u.id, u.username, COALESCE(c.log_count, 0) as log_count
+            FROM users u
+            LEFT JOIN audit_user_counts c ON c.tenant_id = u.tenant_id AND c.user_id = u.id
+            WHERE u.tenant_id = ?
+            ORDER BY u.username
+        ''', (tenant_id,))
+        return [dict(row) for row in rows.fetchall()]
+
+def _record_calculations(cursor, rows):
+    """Append (user_id, tenant_id, expression, result) rows to the calculation history"""
+    if rows:
+        cursor.executemany('''
+            INSERT INTO calculations (user_id, tenant_id, expression, result)
+            VALUES (?, ?, ?, ?)
+        ''', rows)
+
+@instrumented
+def get_calculation_history(user_id, limit=50, before_id=None):
+    """Get a user's calculations newest first; pass before_id (the last id seen) for the next page"""
+    with get_db() as conn:
+        if before_id is None:
+            rows = conn.execute('''
+                SELECT id, expression, result, timestamp FROM calculations
                 WHERE user_id = ?
-                ORDER BY timestamp DESC
+                ORDER BY id DESC
                 LIMIT ?
             ''', (user_id, limit))
         else:
-            cursor.execute('''
-                SELECT * FROM audit_logs 
-                ORDER BY timestamp DESC
+            rows = conn.execute('''
+                SELECT id, expression, result, timestamp FROM calculations
+                WHERE user_id = ? AND id < ?
+                ORDER BY id DESC
                 LIMIT ?
-            ''', (limit,))
-        
-        return [dict(row) for row in cursor.fetchall()]
+            ''', (user_id, before_id, limit))
+        return [dict(row) for row in rows.fetchall()]
+
+# Columns callers may project from audit_logs (also the default SELECT list)
+AUDIT_LOG_COLUMNS = ('id', 'user_id', 'username', 'tenant_id', 'action', 'resource',
+                     'expression', 'result', 'ip_address', 'user_agent', 'timestamp')
+
+def encode_audit_cursor(row):
+    """Opaque pagination cursor pointing just past an audit row"""
+    raw = json.dumps([row['timestamp'], row['id']]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_audit_cursor(cursor):
+    """Inverse of encode_audit_cursor; raises ValueError on a malformed cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        timestamp, row_id = json.loads(raw)
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(timestamp, str) or not isinstance(row_id, int):
+        raise ValueError('Invalid cursor')
+    return timestamp, row_id
+
+def iter_audit_logs(user_id=None, tenant_id=None, limit=100, cursor=None, columns=None,
+                    chunk_size=256):
+    """Yield audit log rows newest first, reading the cursor in chunks.
 
+    Pages are keyed on (timestamp, id): pass the cursor from the last row of
+    the previous page to continue after it. columns restricts the SELECT list
+    to a subset of AUDIT_LOG_COLUMNS; id and timestamp are always fetched
+    because the keyset needs them.
+    """
+    columns = tuple(columns) if columns else AUDIT_LOG_COLUMNS
+    unknown = set(columns) - set(AUDIT_LOG_COLUMNS)
+    if unknown:
+        raise ValueError(f'Unknown audit log columns: {", ".join(sorted(unknown))}')
+    select = list(columns) + [c for c in ('id', 'timestamp') if c not in columns]
+
+    conditions = []
+    params = []
+    if tenant_id:
+        # Multitenancy: only show logs for users in the same tenant
+        conditions.append('tenant_id = ?')
+        params.append(tenant_id)
+    if user_id:
+        conditions.append('user_id = ?')
+        params.append(user_id)
+    if cursor:
+        conditions.append('(timestamp, id) < (?, ?)')
+        params.extend(decode_audit_cursor(cursor))
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+    params.append(limit)
+
+    with get_db() as conn:
+        rows = conn.execute(f'''
+            SELECT {", ".join(select)} FROM audit_logs
+            {where}
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        ''', params)
+        while True:
+            chunk = rows.fetchmany(chunk_size)
+            if not chunk:
+                break
+            for row in chunk:
+                yield dict(row)
+
+@instrumented
+def get_audit_logs(user_id=None, tenant_id=None, limit=100, cursor=None, columns=None):
+    """Get audit logs, optionally filtered by user or tenant (multitenancy)"""
+    return list(iter_audit_logs(user_id, tenant_id, limit, cursor, columns))
+
+@instrumented
+def get_tenant_user_settings(tenant_id, limit=100, after_username=None, prefix=None):
+    """One page of a tenant's users with their settings, ordered by username.
+
+    after_username continues after the last username of the previous page;
+    prefix restricts the page to usernames starting with it (an index range,
+    not a LIKE scan). limit=None returns every matching user.
+    """
+    conditions = ['u.tenant_id = ?']
+    params = [tenant_id]
+    if after_username is not None:
+        conditions.append('u.username > ?')
+        params.append(after_username)
+    if prefix:
+        conditions.append('u.username >= ? AND u.username < ?')
+        params.extend((prefix, prefix + '\U0010ffff'))
+    params.append(-1 if limit is None else limit)  # LIMIT -1: no limit
+    with get_db() as conn:
+        rows = conn.execute(f'''
+            SELECT u.id, u.username, u.tenant_id,
+                   COALESCE(us.allow_parentheses, 1) as allow_parentheses,
+                   COALESCE(us.allow_exponents, 1) as allow_exponents
+            FROM users u
+            LEFT JOIN user_settings us ON u.id = us.user_id
+            WHERE {" AND ".join(conditions)}
+            ORDER BY u.username
+            LIMIT ?
+        ''', params)
+        return [dict(row) for row in rows.fetchall()]
+
+@instrumented
 def get_user_settings(user_id):
     """Get user settings (restrictions)"""
     with get_db() as conn:
@@ -643,6 +1569,8 @@ def get_user_settings(user_id):
             'allow_exponents': True
         }
 
+@instrumented
+@retry_on_busy
 def update_user_settings(user_id, allow_parentheses=None, allow_exponents=None):
     """Update user settings (admin only)"""
     with get_db() as conn:
@@ -664,6 +1592,7 @@ def update_user_settings(user_id, allow_parentheses=None, allow_exponents=None):
                 params.append(1 if allow_exponents else 0)
             
             if updates:
+                updates.append('settings_version = settings_version + 1')
                 updates.append('updated_at = CURRENT_TIMESTAMP')
                 params.append(user_id)
                 cursor.execute(f'''
@@ -671,6 +1600,7 @@ def update_user_settings(user_id, allow_parentheses=None, allow_exponents=None):
                     SET {', '.join(updates)}
                     WHERE user_id = ?
                 ''', params)
+                _bump_generation(conn, 'settings')
                 conn.commit()
                 return cursor.rowcount > 0
         else:
@@ -678,9 +1608,10 @@ def update_user_settings(user_id, allow_parentheses=None, allow_exponents=None):
             allow_parens = 1 if allow_parentheses is not False else 0
             allow_exps = 1 if allow_exponents is not False else 0
             cursor.execute('''
-                INSERT INTO user_settings (user_id, allow_parentheses, allow_exponents)
-                VALUES (?, ?, ?)
+                INSERT INTO user_settings (user_id, allow_parentheses, allow_exponents, settings_version)
+                VALUES (?, ?, ?, 1)
             ''', (user_id, allow_parens, allow_exps))
+            _bump_generation(conn, 'settings')
             conn.commit()
             return True
         
@@ -0,0 +1,213 @@
+import atexit
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from calculator_engine import Calculator
+
+try:
+    import resource
+except ImportError:  # Not available on Windows: run without a memory limit
+    resource = None
+
+
+class EvaluationAborted(Exception):
+    """An offloaded evaluation missed its deadline or lost its worker process"""
+
+
+def _worker_main(conn, memory_mb):
+    """Evaluation process: answer (expression, limits) requests until the pipe closes"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C is the parent's business
+    if resource is not None and memory_mb:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    calculator = Calculator()
+    while True:
+        try:
+            expression, limits = conn.recv()
+        except (EOFError, OSError):
+            return
+        conn.send(calculator.evaluate(expression, limits))
+
+
+class _Worker:
+    def __init__(self, context, memory_mb):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, memory_mb),
+                                       name='calc-eval', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+
+    def close(self):
+        # Closing the pipe ends an idle worker; kill() covers a busy or hung one
+        self.conn.close()
+        self.process.kill()
+        self.process.join(timeout=1)
+
+
+class EvaluationPool:
+    """Pre-forked evaluation processes with a hard per-expression deadline.
+
+    Expressions that may be expensive (any ^, or longer than
+    inline_max_chars) are sent to an idle worker process; the rest stay on
+    the caller's thread. The deadline covers waiting for a free worker as
+    well as the evaluation itself. A worker that misses it is killed and
+    replaced, and every worker is recycled after max_tasks evaluations.
+    Workers run under an address-space limit of memory_mb.
+    """
+
+    def __init__(self, size=2, timeout=1.0, memory_mb=256, max_tasks=500, inline_max_chars=200):
+        self.size = size
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.max_tasks = max_tasks
+        self.inline_max_chars = inline_max_chars
+        # forkserver forks workers from a clean single-threaded process, never
+        # from a gunicorn worker with request threads and open SQLite handles
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self._context = multiprocessing.get_context(method)
+        if method == 'forkserver':
+            self._context.set_forkserver_preload(['eval_pool'])
+        self._cond = threading.Condition()
+        self._reset()
+        self.completed = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.killed = 0
+        self.recycled = 0
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = []
+        self._live = 0
+        self.waiting = 0
+
+    def should_offload(self, expression):
+        return '^' in expression or len(expression) > self.inline_max_chars
+
+    def start(self):
+        """Fork the workers now instead of on first use"""
+        workers = []
+        with self._cond:
+            self._check_pid()
+            missing = self.size - self._live
+            self._live += missing
+        try:
+            for _ in range(missing):
+                workers.append(_Worker(self._context, self.memory_mb))
+        finally:
+            with self._cond:
+                self._live -= missing - len(workers)
+                self._idle.extend(workers)
+                self._cond.notify_all()
+
+    def evaluate(self, expression, limits=None):
+        """Result string for an expression, evaluated in a worker process"""
+        deadline = time.monotonic() + self.timeout
+        worker = self._acquire(deadline)
+        outcome = 'failures'
+        try:
+            worker.conn.send((expression, limits))
+            worker.tasks += 1
+            if not worker.conn.poll(max(0.0, deadline - time.monotonic())):
+                outcome = 'timeouts'
+                raise EvaluationAborted('Evaluation timed out')
+            result = worker.conn.recv()
+            outcome = 'completed'
+        except (EOFError, OSError):
+            # The worker died (e.g. killed for exceeding its memory limit)
+            raise EvaluationAborted('Evaluation failed')
+        finally:
+            self._release(worker, outcome)
+        return result
+
+    def _check_pid(self):
+        # A forked child (gunicorn worker) must not share the parent's processes
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _acquire(self, deadline):
+        with self._cond:
+            self._check_pid()
+            while not self._idle and self._live >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise EvaluationAborted('Evaluation timed out')
+                self.waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            if self._idle:
+                return self._idle.pop()
+            self._live += 1
+        try:
+            return _Worker(self._context, self.memory_mb)
+        except BaseException:
+            with self._cond:
+                self._live -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, worker, outcome):
+        healthy = outcome == 'completed'
+        with self._cond:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            if healthy and worker.tasks < self.max_tasks:
+                self._idle.append(worker)
+                self._cond.notify()
+                return
+            if healthy:
+                self.recycled += 1
+            elif outcome == 'timeouts':
+                self.killed += 1
+        worker.close()
+        with self._cond:
+            if self._pid == os.getpid():
+                self._live -= 1
+            self._cond.notify()
+
+    def shutdown(self):
+        """Stop every idle worker (busy ones are stopped when they are released)"""
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            idle, self._idle = self._idle, []
+            self._live -= len(idle)
+        for worker in idle:
+            worker.close()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self.size,
+                'live': self._live,
+                'idle': len(self._idle),
+                'waiting': self.waiting,
+                'completed': self.completed,
+                'timeouts': self.timeouts,
+                'failures': self.failures,
+                'killed': self.killed,
+                'recycled': self.recycled,
+            }
+
+
+# EVAL_BACKEND=pool sends expensive expressions to worker processes
+BACKEND = os.environ.get('EVAL_BACKEND', 'inline').lower()
+if BACKEND not in ('inline', 'pool'):
+    raise ValueError(f'Unknown EVAL_BACKEND: {BACKEND}')
+
+pool = None
+if BACKEND == 'pool':
+    pool = EvaluationPool(
+        size=int(os.environ.get('EVAL_POOL_SIZE', 2)),
+        timeout=int(os.environ.get('EVAL_TIMEOUT_MS', 1000)) / 1000,
+        memory_mb=int(os.environ.get('EVAL_MEMORY_MB', 256)),
+        max_tasks=int(os.environ.get('EVAL_MAX_TASKS_PER_CHILD', 500)),
+        inline_max_chars=int(os.environ.get('EVAL_INLINE_MAX_CHARS', 200))
+    )
+    atexit.register(pool.shutdown)
@@ -1,18 +1,57 @@
 # Gunicorn configuration
+import gc
 import multiprocessing
 import os
+import shutil
+import tempfile
 
 # Server socket
 bind = "0.0.0.0:2000"
 backlog = 2048
 
-# Worker processes
-workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "sync"
+# Worker processes, chosen by GUNICORN_PROFILE:
+#   sync    - one request per process; simplest, most memory per connection
+#   gthread - fewer processes with a thread pool each; per-thread SQLite connections
+#   gevent  - cooperative greenlets (needs the gevent package); pooled SQLite connections
+WORKER_PROFILES = {
+    "sync": {"workers": multiprocessing.cpu_count() * 2 + 1, "worker_class": "sync",
+             "threads": 1, "timeout": 120, "preload": True},
+    "gthread": {"workers": multiprocessing.cpu_count() + 1, "worker_class": "gthread",
+                "threads": 8, "timeout": 30, "preload": True},
+    # Preloading would import the app before gevent monkey-patches the worker
+    "gevent": {"workers": multiprocessing.cpu_count() + 1, "worker_class": "gevent",
+               "threads": 1, "timeout": 30, "preload": False},
+}
+profile = os.environ.get("GUNICORN_PROFILE", "sync").lower()
+if profile not in WORKER_PROFILES:
+    raise ValueError(f"Unknown GUNICORN_PROFILE: {profile}")
+
+workers = int(os.environ.get("WEB_CONCURRENCY", WORKER_PROFILES[profile]["workers"]))
+worker_class = WORKER_PROFILES[profile]["worker_class"]
+threads = int(os.environ.get("GUNICORN_THREADS", WORKER_PROFILES[profile]["threads"]))
 worker_connections = 1000
-timeout = 120
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", WORKER_PROFILES[profile]["timeout"]))
 keepalive = 5
 
+# Import the app once in the master and fork workers from it: they start
+# faster and share its memory copy-on-write. GUNICORN_PRELOAD=false restores
+# per-worker imports (needed for code reloads on HUP).
+preload_app = os.environ.get(
+    "GUNICORN_PRELOAD", str(WORKER_PROFILES[profile]["preload"])
+).lower() in ("1", "true", "yes")
+
+if profile == "gevent":
+    # Greenlets are short-lived, so per-thread connections would pile up: share a
+    # bounded pool instead. Keep lock waits short; retry_on_busy backs off with
+    # time.sleep, which gevent's monkey-patching turns into a cooperative yield.
+    os.environ.setdefault("DB_CONNECTION_STRATEGY", "pool")
+    os.environ.setdefault("DB_BUSY_TIMEOUT_MS", "250")
+
+# Per-tenant admission control (rate_limiter.TenantAdmission) is opt-in: it
+# costs two SQLite write transactions per request. When TENANT_MAX_INFLIGHT is
+# set, a request cannot outlive the worker timeout, so neither does its lease.
+os.environ.setdefault("ADMISSION_LEASE_SECONDS", str(timeout))
+
 # Logging
 accesslog = "-"
 errorlog = "-"
@@ -28,3 +67,68 @@ umask = 0
 user = None
 group = None
 tmp_upload_dir = None
+
+# Audit rows are written by a background group-commit thread in each worker
+os.environ.setdefault("AUDIT_WRITE_BEHIND", "true")
+
+# Workers share Prometheus metrics through mmap'd files in this directory
+# (must be set before the app, and with it prometheus_client, is imported)
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR",
+                      os.path.join(tempfile.gettempdir(), "calculator_prometheus"))
+# With preload_app the master imports the app before on_starting runs
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+# Server hooks
+def when_ready(server):
+    """Move the preloaded app's objects out of the GC's reach before forking.
+
+    Collections would otherwise touch every object's header in each worker
+    and un-share the pages the master loaded.
+    """
+    if server.cfg.preload_app:
+        gc.freeze()
+
+def pre_fork(server, worker):
+    """Close the master's SQLite connections (opened by migrate/ensure_schema) before forking"""
+    if server.cfg.preload_app:
+        from database import close_all_connections
+        close_all_connections()
+
+def post_fork(server, worker):
+    """Reset inherited SQLite state and start this worker's evaluation processes (EVAL_BACKEND=pool)"""
+    if server.cfg.preload_app:
+        from database import reinit_after_fork
+        reinit_after_fork()
+    from eval_pool import pool
+    if pool is not None:
+        pool.start()
+
+def worker_exit(server, worker):
+    """Flush queued audit rows, stop evaluation processes and close pooled SQLite connections"""
+    from audit_writer import writer
+    from database import close_all_connections
+    from eval_pool import pool
+    writer.shutdown()
+    if pool is not None:
+        pool.shutdown()
+    close_all_connections()
+
+def on_starting(server):
+    """Empty the metrics directory and migrate the schema once, before any worker boots
+
+    With preload_app the master's import has already migrated (ensure_schema),
+    so migrate() finds nothing to do.
+    """
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    # Stale files would be merged into /metrics
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+    # Workers then only compare PRAGMA user_version (database.ensure_schema)
+    from database import close_all_connections, migrate
+    migrate()
+    close_all_connections()
+
+def child_exit(server, worker):
+    """Drop a dead worker's live gauges from /metrics"""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import metrics
+
+_local = threading.local()
+
+
+def _env_flag(name, default='true'):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes')
+
+
+# Server-Timing response header with per-phase durations
+SERVER_TIMING_ENABLED = _env_flag('SERVER_TIMING')
+# One JSON log line per request on the 'calculator.requests' logger
+REQUEST_LOG_ENABLED = _env_flag('REQUEST_LOG')
+
+
+def enabled():
+    """Whether anything consumes per-request figures (Server-Timing or the request log)"""
+    return SERVER_TIMING_ENABLED or REQUEST_LOG_ENABLED
+
+
+request_logger = logging.getLogger('calculator.requests')
+if REQUEST_LOG_ENABLED and not request_logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    request_logger.addHandler(_handler)
+    request_logger.setLevel(logging.INFO)
+    request_logger.propagate = False
+
+
+class RequestMetrics:
+    """Counters and timings collected while one request runs on this thread"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.eval_time = 0.0
+        # database.py function name -> [calls, seconds]
+        self.operations = {}
+
+    def add_operation(self, name, elapsed):
+        entry = self.operations.get(name)
+        if entry is None:
+            self.operations[name] = [1, elapsed]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """Server-Timing header value (durations in milliseconds)"""
+        parts = [
+            f'total;dur={self.elapsed() * 1000:.2f}',
+            f'db;dur={self.db_time * 1000:.2f};desc="{self.queries} queries"',
+        ]
+        if self.eval_time:
+            parts.append(f'eval;dur={self.eval_time * 1000:.2f}')
+        for name, (calls, seconds) in self.operations.items():
+            parts.append(f'db-{name};dur={seconds * 1000:.2f};desc="{calls}x"')
+        return ', '.join(parts)
+
+    def as_dict(self):
+        return {
+            'duration_ms': round(self.elapsed() * 1000, 3),
+            'queries': self.queries,
+            'db_ms': round(self.db_time * 1000, 3),
+            'eval_ms': round(self.eval_time * 1000, 3),
+            'operations': {name: {'calls': calls, 'ms': round(seconds * 1000, 3)}
+                           for name, (calls, seconds) in self.operations.items()},
+        }
+
+
+def start_request():
+    _local.metrics = RequestMetrics()
+    return _local.metrics
+
+
+def current():
+    """The current request's metrics, or None outside an instrumented request"""
+    return getattr(_local, 'metrics', None)
+
+
+def end_request():
+    _local.metrics = None
+
+
+def count_statement(statement):
+    """sqlite3 trace callback: count every statement run for the current request"""
+    request_metrics = getattr(_local, 'metrics', None)
+    if request_metrics is not None:
+        request_metrics.queries += 1
+
+
+def record_db_time(elapsed):
+    request_metrics = getattr(_local, 'metrics', None)
+    if request_metrics is not None:
+        request_metrics.db_time += elapsed
+
+
+@contextmanager
+def timed_eval():
+    """Attribute the enclosed block to expression evaluation"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.EVAL_SECONDS.observe(elapsed)
+        request_metrics = getattr(_local, 'metrics', None)
+        if request_metrics is not None:
+            request_metrics.eval_time += elapsed
+
+
+def instrumented(func):
+    """Time a database.py function (nested calls count toward the outer one only)"""
+    name = func.__name__
+    histogram = metrics.DB_OPERATION_SECONDS.labels(name)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'operation_depth', 0):
+            return func(*args, **kwargs)
+        _local.operation_depth = 1
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.operation_depth = 0
+            elapsed = time.perf_counter() - start
+            histogram.observe(elapsed)
+            request_metrics = getattr(_local, 'metrics', None)
+            if request_metrics is not None:
+                request_metrics.add_operation(name, elapsed)
+    return wrapper
+
+
+def log_request(request_metrics, method, path, endpoint, status):
+    if not REQUEST_LOG_ENABLED:
+        return
+    record = {'method': method, 'path': path, 'endpoint': endpoint, 'status': status}
+    record.update(request_metrics.as_dict())
+    request_logger.info(json.dumps(record))
@@ -0,0 +1,117 @@
+import os
+import threading
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess
+)
+
+# With PROMETHEUS_MULTIPROC_DIR set (gunicorn_config.py does it), every worker
+# writes its samples to mmap'd files in that directory and /metrics merges them
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+
+HTTP_REQUESTS = Counter(
+    'calculator_http_requests_total', 'HTTP requests by route and status',
+    ['method', 'route', 'status']
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'calculator_http_request_duration_seconds', 'HTTP request latency by route',
+    ['method', 'route'], buckets=REQUEST_BUCKETS
+)
+DB_OPERATION_SECONDS = Histogram(
+    'calculator_db_operation_duration_seconds', 'Latency of database.py operations',
+    ['operation'], buckets=FAST_BUCKETS
+)
+EVAL_SECONDS = Histogram(
+    'calculator_eval_duration_seconds', 'Calculator.evaluate latency', buckets=FAST_BUCKETS
+)
+CALCULATE_DENIED = Counter(
+    'calculator_calculate_denied_total', 'Calculations refused by user restrictions', ['reason']
+)
+RESULT_CACHE_REQUESTS = Counter(
+    'calculator_result_cache_requests_total', 'Result cache lookups', ['outcome']
+)
+RESULT_CACHE_ENTRIES = Gauge(
+    'calculator_result_cache_entries', 'Entries in the result caches of live workers',
+    multiprocess_mode='livesum'
+)
+AUDIT_QUEUE_DEPTH = Gauge(
+    'calculator_audit_queue_depth', 'Audit rows waiting in write-behind queues of live workers',
+    multiprocess_mode='livesum'
+)
+EVAL_POOL_TASKS = Counter(
+    'calculator_eval_pool_tasks_total', 'Expressions sent to evaluation processes by outcome', ['outcome']
+)
+EVAL_POOL_KILLED = Counter(
+    'calculator_eval_pool_killed_total', 'Evaluation processes killed for missing their deadline'
+)
+EVAL_POOL_RECYCLED = Counter(
+    'calculator_eval_pool_recycled_total', 'Evaluation processes retired after their task quota'
+)
+EVAL_POOL_WAITING = Gauge(
+    'calculator_eval_pool_waiting', 'Requests waiting for a free evaluation process in live workers',
+    multiprocess_mode='livesum'
+)
+RATE_LIMIT_REQUESTS = Counter(
+    'calculator_rate_limit_requests_total',
+    'Rate limit and tenant admission checks by limit and outcome '
+    '(limited = answered 429, store_busy = let through unchecked)',
+    ['limit', 'outcome']
+)
+
+# Running totals already exported from this process (ResultCache and
+# EvaluationPool count since startup; Prometheus counters only go up)
+_exported = {}
+_exported_lock = threading.Lock()
+
+
+def observe_request(method, route, status, seconds):
+    HTTP_REQUESTS.labels(method, route, str(status)).inc()
+    HTTP_REQUEST_SECONDS.labels(method, route).observe(seconds)
+
+
+def _export_totals(totals):
+    """Advance each counter by how much its running total grew since the last export"""
+    # Threaded workers call this concurrently: claim each delta under the lock
+    with _exported_lock:
+        deltas = []
+        for counter, total in totals:
+            delta = total - _exported.get(counter, 0)
+            if delta > 0:
+                deltas.append((counter, delta))
+                _exported[counter] = total
+    for counter, delta in deltas:
+        counter.inc(delta)
+
+
+def sync_worker_stats(cache=None, audit_writer=None, eval_pool=None):
+    """Copy this worker's result cache, audit queue and evaluation pool figures into the shared metrics"""
+    if cache is not None:
+        stats = cache.stats()
+        _export_totals([(RESULT_CACHE_REQUESTS.labels('hit'), stats['hits']),
+                        (RESULT_CACHE_REQUESTS.labels('miss'), stats['misses'])])
+        RESULT_CACHE_ENTRIES.set(stats['entries'])
+    if audit_writer is not None:
+        AUDIT_QUEUE_DEPTH.set(audit_writer.depth())
+    if eval_pool is not None:
+        stats = eval_pool.stats()
+        _export_totals([(EVAL_POOL_TASKS.labels('completed'), stats['completed']),
+                        (EVAL_POOL_TASKS.labels('timeout'), stats['timeouts']),
+                        (EVAL_POOL_TASKS.labels('failed'), stats['failures']),
+                        (EVAL_POOL_KILLED, stats['killed']),
+                        (EVAL_POOL_RECYCLED, stats['recycled'])])
+        EVAL_POOL_WAITING.set(stats['waiting'])
+
+
+def render():
+    """Current metrics in Prometheus text format: (body, content type)"""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
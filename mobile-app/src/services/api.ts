@@ -33,6 +33,14 @@ interface CalculateResponse {
   error?: string;
 }
 
+interface BatchCalculateResponse {
+  results: {
+    expression: string;
+    result: string;
+    error?: string;
+  }[];
+}
+
 interface UsersWithoutTenantResponse {
   users_without_tenant?: {
     id: number;
@@ -106,6 +114,11 @@ class ApiService {
 
       const data = await response.json() as T & { error?: string; message?: string };
 
+      // Permissions/settings embedded in our token are outdated - fetch a fresh one
+      if (response.headers.get('X-Token-Refresh') === 'required') {
+        void this.refreshToken();
+      }
+
       if (!response.ok) {
         if (response.status === 401) {
           await this.removeToken();
@@ -139,6 +152,20 @@ class ApiService {
     return response;
   }
 
+  async refreshToken(): Promise<void> {
+    try {
+      const response = await this.request<{ success: boolean; token?: string }>('/api/auth/refresh', {
+        method: 'POST',
+      });
+      if (response.success && response.token) {
+        await this.setToken(response.token);
+      }
+    } catch (error) {
+      // eslint-disable-next-line no-console
+      console.error('Token refresh error:', error);
+    }
+  }
+
   async logout(): Promise<void> {
     try {
       await this.request('/logout', { method: 'POST' });
@@ -165,6 +192,13 @@ class ApiService {
     });
   }
 
+  async calculateBatch(expressions: string[]): Promise<BatchCalculateResponse> {
+    return await this.request<BatchCalculateResponse>('/calculate/batch', {
+      method: 'POST',
+      body: JSON.stringify({ expressions }),
+    });
+  }
+
   async getUsersWithoutTenant(): Promise<{ id: number; username: string }[]> {
     const data = await this.request<UsersWithoutTenantResponse>('/admin/assign-tenant');
     return data.users_without_tenant || [];
@@ -195,6 +229,20 @@ class ApiService {
     return data.logs || [];
   }
 
+  async getAuditLogsPage(options: { limit?: number; userId?: number; cursor?: string; fields?: string[] } = {}): Promise<{
+    logs: any[];
+    next_cursor: string | null;
+  }> {
+    const params = new URLSearchParams();
+    if (options.limit) params.append('limit', options.limit.toString());
+    if (options.userId) params.append('user_id', options.userId.toString());
+    if (options.cursor) params.append('cursor', options.cursor);
+    if (options.fields?.length) params.append('fields', options.fields.join(','));
+    const query = params.toString() ? `?${params.toString()}` : '';
+    const data = await this.request<{ logs: any[]; next_cursor: string | null }>(`/audit${query}`);
+    return { logs: data.logs || [], next_cursor: data.next_cursor ?? null };
+  }
+
   async getAuditUsers(): Promise<{ id: number; username: string; log_count: number }[]> {
     const data = await this.request<{ users: any[] }>('/audit/users');
     return data.users || [];
@@ -0,0 +1,190 @@
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+
+import database
+import metrics
+
+_PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+# Threads of one worker take turns on the limiter's writes: a Python lock hands
+# over in microseconds, where SQLite's busy handler sleeps a millisecond or more
+_write_lock = threading.Lock()
+
+
+def _store_busy(limit, error):
+    """True, after a warning and a store_busy count, when error is SQLite staying locked past its retries"""
+    if not database.is_busy_error(error):
+        return False
+    logging.warning(f'Rate limit store busy, letting the request through unchecked ({limit}): {error}')
+    metrics.RATE_LIMIT_REQUESTS.labels(limit, 'store_busy').inc()
+    return True
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """Token bucket: bursts of up to capacity requests, refilled to capacity over period seconds"""
+    capacity: int
+    period: float
+
+    @property
+    def rate(self):
+        return self.capacity / self.period
+
+    @classmethod
+    def parse(cls, text):
+        """A limit written as count/unit, e.g. '10/minute' (second, minute, hour or day)"""
+        count, _, unit = text.strip().partition('/')
+        unit = unit.strip().lower()
+        unit = unit[:-1] if unit.endswith('s') else unit
+        if unit not in _PERIODS or not count.strip().isdigit() or int(count) < 1:
+            raise ValueError(f'Invalid rate limit {text!r}: expected e.g. 10/minute')
+        return cls(capacity=int(count), period=_PERIODS[unit])
+
+
+@dataclass(frozen=True)
+class Decision:
+    allowed: bool
+    remaining: int
+    retry_after: int  # whole seconds until the refused request would fit (0 when allowed)
+
+
+class RateLimiter:
+    """Named token buckets shared by every worker through SQLite.
+
+    hit(name, key) takes tokens from the bucket for that key under the
+    limit called name. Buckets live in the rate_limit_buckets table, so all
+    gunicorn workers draw from the same counts. Every sweep_interval
+    seconds a worker deletes the buckets that have refilled and the
+    admission leases that have expired.
+    """
+
+    def __init__(self, limits, enabled=True, sweep_interval=60.0):
+        self.limits = dict(limits)
+        self.enabled = enabled
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    def hit(self, name, key, cost=1):
+        limit = self.limits[name]
+        # A request larger than the whole bucket waits for a full one instead of never fitting
+        cost = min(cost, limit.capacity)
+        now = time.time()
+        try:
+            with _write_lock:
+                taken, tokens = database.take_rate_limit_tokens(f'{name}:{key}', cost, limit.capacity,
+                                                                limit.rate, now)
+        except sqlite3.OperationalError as e:
+            # Fail open: a locked database must not turn into refused requests
+            if not _store_busy(name, e):
+                raise
+            return Decision(allowed=True, remaining=0, retry_after=0)
+        metrics.RATE_LIMIT_REQUESTS.labels(name, 'allowed' if taken else 'limited').inc()
+        self._maybe_sweep(now)
+        if taken:
+            return Decision(allowed=True, remaining=int(tokens), retry_after=0)
+        return Decision(allowed=False, remaining=int(tokens),
+                        retry_after=max(1, math.ceil((cost - tokens) / limit.rate)))
+
+    def _maybe_sweep(self, now):
+        with self._lock:
+            if time.monotonic() < self._next_sweep:
+                return
+            self._next_sweep = time.monotonic() + self.sweep_interval
+        # A bucket left alone for a whole period is full again, the same as no row
+        longest = max(limit.period for limit in self.limits.values())
+        try:
+            database.prune_rate_limits(now - longest, now)
+        except sqlite3.OperationalError as e:
+            # The next sweep catches up
+            if not _store_busy('sweep', e):
+                raise
+
+
+# Lease handed out when the store was too busy to record one
+UNCHECKED = object()
+
+
+class TenantAdmission:
+    """Caps how many requests of one tenant are in flight across all workers.
+
+    Each admitted request holds a lease row until it finishes; leases of a
+    worker that died mid-request stop counting after lease_seconds.
+    max_inflight=0 disables the cap.
+    """
+
+    def __init__(self, max_inflight=0, lease_seconds=60.0):
+        self.max_inflight = max_inflight
+        self.lease_seconds = lease_seconds
+
+    @property
+    def enabled(self):
+        return self.max_inflight > 0
+
+    def acquire(self, tenant_id):
+        """Lease id for a new in-flight request, None when the tenant is at its quota.
+
+        UNCHECKED (admit without a lease) when the database stays locked.
+        """
+        now = time.time()
+        try:
+            with _write_lock:
+                lease = database.acquire_admission_lease(tenant_id, self.max_inflight,
+                                                         now + self.lease_seconds, now)
+        except sqlite3.OperationalError as e:
+            if not _store_busy('tenant_inflight', e):
+                raise
+            return UNCHECKED
+        metrics.RATE_LIMIT_REQUESTS.labels('tenant_inflight',
+                                           'allowed' if lease is not None else 'limited').inc()
+        return lease
+
+    def release(self, lease):
+        if lease is UNCHECKED:
+            return
+        try:
+            with _write_lock:
+                database.release_admission_lease(lease)
+        except sqlite3.OperationalError as e:
+            # The lease expires after lease_seconds instead
+            if not _store_busy('tenant_inflight', e):
+                raise
+
+
+def client_address(remote_addr, forwarded_for, proxy_hops):
+    """Address to limit by: as seen by the outermost of proxy_hops trusted proxies, else the peer.
+
+    Entries further left in X-Forwarded-For are supplied by the client and
+    could be rotated to dodge the limit.
+    """
+    if proxy_hops and forwarded_for:
+        hops = [hop.strip() for hop in forwarded_for.split(',')]
+        if len(hops) >= proxy_hops:
+            return hops[-proxy_hops]
+    return remote_addr
+
+
+# Token buckets are opt-in: each check is a SQLite write transaction that all
+# workers take turns on (tenant quotas are switched separately)
+ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+# Reverse proxies in front of the app that append to X-Forwarded-For
+PROXY_HOPS = int(os.environ.get('RATE_LIMIT_PROXY_HOPS', 0))
+
+limiter = RateLimiter({
+    # per client address, POST only
+    'login': RateLimit.parse(os.environ.get('RATE_LIMIT_LOGIN', '10/minute')),
+    # per client address
+    'refresh': RateLimit.parse(os.environ.get('RATE_LIMIT_REFRESH', '30/minute')),
+    # per user; /calculate/batch takes one token per expression
+    'calculate': RateLimit.parse(os.environ.get('RATE_LIMIT_CALCULATE', '300/minute')),
+}, enabled=ENABLED, sweep_interval=float(os.environ.get('RATE_LIMIT_SWEEP_SECONDS', 60)))
+
+admission = TenantAdmission(
+    max_inflight=int(os.environ.get('TENANT_MAX_INFLIGHT', 0)),
+    lease_seconds=float(os.environ.get('ADMISSION_LEASE_SECONDS', 60))
+)
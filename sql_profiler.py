@@ -0,0 +1,189 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+# Opt-in: wrap every connection handed out by get_db in the profiler
+ENABLED = os.environ.get('SQL_PROFILE', 'false').lower() in ('1', 'true', 'yes')
+# Statements slower than this (milliseconds, execute + fetch) are logged with their query plan
+SLOW_QUERY_MS = float(os.environ.get('SQL_SLOW_QUERY_MS', 100))
+
+logger = logging.getLogger('calculator.sql')
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+@lru_cache(maxsize=2048)
+def normalize_sql(sql):
+    """Statement text with whitespace collapsed and inline literals replaced by ?"""
+    return _LITERAL_RE.sub('?', _WHITESPACE_RE.sub(' ', sql).strip())
+
+
+class StatementStats:
+    __slots__ = ('count', 'total', 'max', 'rows')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+
+
+class SQLProfiler:
+    """Per-process statement statistics keyed by normalized SQL"""
+
+    def __init__(self, slow_query_ms=SLOW_QUERY_MS):
+        self.slow_query_ms = slow_query_ms
+        self._stats = {}
+        self._lock = threading.Lock()
+        self.slow_queries = 0
+
+    def record(self, sql, elapsed, rows):
+        key = normalize_sql(sql)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = StatementStats()
+            stats.count += 1
+            stats.total += elapsed
+            stats.rows += rows
+            if elapsed > stats.max:
+                stats.max = elapsed
+        return elapsed * 1000 >= self.slow_query_ms
+
+    def top(self, limit=20, sort='total'):
+        """The heaviest statements as dicts (sort: total, max, count or rows)"""
+        with self._lock:
+            items = [(sql, s.count, s.total, s.max, s.rows) for sql, s in self._stats.items()]
+        index = {'count': 1, 'total': 2, 'max': 3, 'rows': 4}[sort]
+        items.sort(key=lambda item: item[index], reverse=True)
+        return [{
+            'sql': sql,
+            'count': count,
+            'total_ms': round(total * 1000, 3),
+            'mean_ms': round(total * 1000 / count, 3),
+            'max_ms': round(maximum * 1000, 3),
+            'rows': rows,
+        } for sql, count, total, maximum, rows in items[:limit]]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.slow_queries = 0
+
+    def log_slow(self, conn, sql, params, elapsed, rows):
+        with self._lock:
+            self.slow_queries += 1
+        plan = ''
+        if params is not None and sql.lstrip().upper().startswith(_EXPLAINABLE):
+            try:
+                # Plain cursor so the EXPLAIN itself is not profiled
+                rows_plan = sqlite3.Cursor(conn).execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+                plan = ' | '.join(row[3] for row in rows_plan)
+            except sqlite3.Error as e:
+                plan = f'unavailable ({e})'
+        logger.warning(f'Slow query ({elapsed * 1000:.1f} ms, {rows} rows): '
+                       f'{normalize_sql(sql)} -- plan: {plan}')
+
+
+profiler = SQLProfiler()
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """Cursor that times each statement from execute() until its rows are exhausted"""
+
+    _sql = None
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        self._begin(sql, parameters, time.perf_counter() - start)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        start = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        self._begin(sql, None, time.perf_counter() - start)
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._elapsed += time.perf_counter() - start
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._elapsed += time.perf_counter() - start
+        self._rows += len(rows)
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._elapsed += time.perf_counter() - start
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # conn.execute(...).fetchone() never exhausts the cursor: record it when dropped
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+    def _begin(self, sql, parameters, elapsed):
+        self._sql = sql
+        self._params = parameters
+        self._elapsed = elapsed
+        self._rows = 0
+        if self.description is None:
+            # No result set (INSERT/UPDATE/DELETE): the statement is already done
+            self._rows = max(self.rowcount, 0)
+            self._finish()
+
+    def _finish(self):
+        sql = self._sql
+        if sql is None:
+            return
+        self._sql = None
+        if profiler.record(sql, self._elapsed, self._rows):
+            profiler.log_slow(self.connection, sql, self._params, self._elapsed, self._rows)
+
+
+class ProfilingConnection(sqlite3.Connection):
+    """Connection whose cursors (including conn.execute shortcuts) are profiled"""
+
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
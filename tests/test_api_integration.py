@@ -69,6 +69,7 @@ def client():
         yield client
     
     # Cleanup
+    database.close_all_connections()
     database.DATABASE = original_db
     if os.path.exists(temp_db.name):
         os.unlink(temp_db.name)
@@ -100,6 +101,11 @@ def auth_token(client):
         return data.get('token')
     return None
 
+@pytest.fixture
+def metrics_enabled(monkeypatch):
+    import calculator_app
+    monkeypatch.setattr(calculator_app, 'METRICS_ENABLED', True)
+
 class TestAPIAuthentication:
     def test_login_success(self, client):
         from database import get_db
@@ -148,3 +154,538 @@ class TestAPIAuthentication:
         
         # Should return 401 (authentication required) before checking expression
         assert response.status_code == 401, f"Expected 401, got {response.status_code}: {response.get_json()}"
+
+    def test_exponent_restriction_covers_double_star(self, client, auth_token):
+        if not auth_token:
+            pytest.skip("Could not get auth token")
+        from database import get_db, update_user_settings
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM users WHERE username = 'testuser'")
+            user_id = cursor.fetchone()[0]
+        update_user_settings(user_id, allow_exponents=False)
+
+        response = client.post('/calculate',
+                              json={'expression': '2 ** 3'},
+                              headers={'Authorization': f'Bearer {auth_token}'},
+                              content_type='application/json')
+
+        assert response.status_code == 403
+
+
+class TestBatchCalculate:
+    def test_batch_results_and_audit(self, client, auth_token):
+        if not auth_token:
+            pytest.skip("Could not get auth token")
+        response = client.post('/calculate/batch',
+                              json={'expressions': ['2+2', '2++3', '', '(1+2)*3']},
+                              headers={'Authorization': f'Bearer {auth_token}'},
+                              content_type='application/json')
+
+        assert response.status_code == 200
+        results = response.get_json()['results']
+        assert [r['result'] for r in results] == ['4', 'Invalid expression', 'Empty expression', '9']
+        assert 'error' in results[2]
+
+        from database import get_db
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM audit_logs WHERE action = 'calculate' AND username = 'testuser'")
+            assert cursor.fetchone()[0] == 3
+
+    def test_batch_keeps_per_item_denials(self, client, auth_token):
+        if not auth_token:
+            pytest.skip("Could not get auth token")
+        from database import get_db, update_user_settings
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM users WHERE username = 'testuser'")
+            user_id = cursor.fetchone()[0]
+        update_user_settings(user_id, allow_parentheses=False)
+
+        response = client.post('/calculate/batch',
+                              json={'expressions': ['1+1', '(1+1)']},
+                              headers={'Authorization': f'Bearer {auth_token}'},
+                              content_type='application/json')
+
+        results = response.get_json()['results']
+        assert results[0]['result'] == '2'
+        assert results[1]['error'] == 'Parentheses are not allowed for your account'
+
+    def test_batch_rejects_non_list(self, client, auth_token):
+        if not auth_token:
+            pytest.skip("Could not get auth token")
+        response = client.post('/calculate/batch',
+                              json={'expressions': '2+2'},
+                              headers={'Authorization': f'Bearer {auth_token}'},
+                              content_type='application/json')
+        assert response.status_code == 400
+
+
+class TestFatTokens:
+    @pytest.fixture(autouse=True)
+    def embed_claims(self, monkeypatch):
+        import calculator_app
+        monkeypatch.setattr(calculator_app, 'JWT_EMBED_CLAIMS', True)
+
+    def _user_id(self):
+        from database import get_db
+        with get_db() as conn:
+            return conn.execute("SELECT id FROM users WHERE username = 'testuser'").fetchone()[0]
+
+    def test_login_token_embeds_claims(self, client, auth_token):
+        from calculator_app import verify_token
+        payload = verify_token(auth_token)
+        assert 'calculate' in payload['perms']
+        assert payload['settings'] == {'allow_parentheses': True, 'allow_exponents': True}
+
+    def test_settings_change_marks_token_stale(self, client, auth_token):
+        from database import update_user_settings
+        headers = {'Authorization': f'Bearer {auth_token}'}
+        response = client.post('/calculate', json={'expression': '2^2'}, headers=headers)
+        assert response.status_code == 200
+        assert 'X-Token-Refresh' not in response.headers
+
+        update_user_settings(self._user_id(), allow_exponents=False)
+
+        # Stale claims are ignored: the database settings apply and a refresh is requested
+        response = client.post('/calculate', json={'expression': '2^2'}, headers=headers)
+        assert response.status_code == 403
+        assert response.headers['X-Token-Refresh'] == 'required'
+
+        response = client.post('/api/auth/refresh', headers=headers)
+        new_token = response.get_json()['token']
+        from calculator_app import verify_token
+        assert verify_token(new_token)['settings']['allow_exponents'] is False
+
+        response = client.post('/calculate', json={'expression': '2+2'},
+                               headers={'Authorization': f'Bearer {new_token}'})
+        assert response.status_code == 200
+        assert 'X-Token-Refresh' not in response.headers
+
+
+class TestStatelessTokenRequests:
+    def test_bearer_request_does_not_set_cookie(self, client, auth_token):
+        if not auth_token:
+            pytest.skip("Could not get auth token")
+        # Fresh client without the /login session cookie: only the bearer token authenticates
+        response = app.test_client().post('/calculate',
+                              json={'expression': '1+1'},
+                              headers={'Authorization': f'Bearer {auth_token}'})
+        assert response.status_code == 200
+        assert 'Set-Cookie' not in response.headers
+
+    def test_check_auth_accepts_bearer_token(self, client, auth_token):
+        if not auth_token:
+            pytest.skip("Could not get auth token")
+        response = app.test_client().get('/check-auth', headers={'Authorization': f'Bearer {auth_token}'})
+        assert response.status_code == 200
+        assert response.get_json()['username'] == 'testuser'
+
+
+class TestAuditPagination:
+    @pytest.fixture
+    def admin_client(self, client):
+        from database import get_db, log_audit
+        import hashlib
+        password_hash = hashlib.sha256('adminpass'.encode()).hexdigest()
+        with get_db() as conn:
+            cursor = conn.cursor()
+            role_id = cursor.execute("SELECT id FROM roles WHERE name = 'admin'").fetchone()[0]
+            cursor.execute("INSERT OR IGNORE INTO tenants (name) VALUES ('audit-tenant')")
+            tenant_id = cursor.execute("SELECT id FROM tenants WHERE name = 'audit-tenant'").fetchone()[0]
+            cursor.execute("INSERT INTO users (username, password_hash, role_id, tenant_id) VALUES (?, ?, ?, ?)",
+                          ('auditadmin', password_hash, role_id, tenant_id))
+        for i in range(7):
+            log_audit(None, 'someone', 'calculate', expression=f'{i}*2', tenant_id=tenant_id)
+        response = client.post('/login', json={'username': 'auditadmin', 'password': 'adminpass'})
+        assert response.status_code == 200
+        return client
+
+    def test_pages_follow_cursor(self, admin_client):
+        seen = []
+        cursor = None
+        while True:
+            url = '/audit?limit=3' + (f'&cursor={cursor}' if cursor else '')
+            data = admin_client.get(url).get_json()
+            seen.extend(log['id'] for log in data['logs'])
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+        # 7 calculations plus the admin's own login row
+        assert len(seen) == 8
+        assert len(set(seen)) == 8
+        assert seen == sorted(seen, reverse=True)
+
+    def test_fields_projection(self, admin_client):
+        data = admin_client.get('/audit?fields=action,expression&limit=2').get_json()
+        assert set(data['logs'][0]) == {'action', 'expression'}
+
+    def test_unknown_field_rejected(self, admin_client):
+        response = admin_client.get('/audit?fields=password_hash')
+        assert response.status_code == 400
+
+    def test_bad_cursor_rejected(self, admin_client):
+        response = admin_client.get('/audit?cursor=garbage')
+        assert response.status_code == 400
+
+    def test_audit_users_counts(self, admin_client):
+        users = admin_client.get('/audit/users').get_json()['users']
+        # The admin's own login is the only row attributed to a user in the tenant
+        assert users == [{'id': users[0]['id'], 'username': 'auditadmin', 'log_count': 1}]
+
+    def test_rebuild_command(self, admin_client):
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['rebuild-audit-counts'])
+        assert result.exit_code == 0
+        assert 'rebuilt' in result.output
+        users = admin_client.get('/audit/users').get_json()['users']
+        assert users[0]['log_count'] == 1
+
+    def test_limit_is_capped(self, admin_client, monkeypatch):
+        import calculator_app
+        monkeypatch.setattr(calculator_app, 'AUDIT_MAX_PAGE_SIZE', 2)
+        data = admin_client.get('/audit?limit=1000000').get_json()
+        assert len(data['logs']) == 2
+        assert data['next_cursor']
+
+
+class TestHistory:
+    def test_history_only_calculations(self, client, auth_token):
+        if not auth_token:
+            pytest.skip("Could not get auth token")
+        headers = {'Authorization': f'Bearer {auth_token}'}
+        for i in range(3):
+            client.post('/calculate', json={'expression': f'{i}+1'}, headers=headers)
+            client.post('/login', json={'username': 'testuser', 'password': 'testpass'})
+        data = client.get('/history?limit=2', headers=headers).get_json()
+        assert [c['expression'] for c in data['calculations']] == ['2+1', '1+1']
+        older = client.get(f"/history?limit=2&before={data['next_before']}", headers=headers).get_json()
+        assert [c['expression'] for c in older['calculations']] == ['0+1']
+        assert older['next_before'] is None
+
+
+class TestAdminUserSettings:
+    @pytest.fixture
+    def admin_client(self, client):
+        from database import get_db
+        import hashlib
+        password_hash = hashlib.sha256('adminpass'.encode()).hexdigest()
+        with get_db() as conn:
+            cursor = conn.cursor()
+            admin_role = cursor.execute("SELECT id FROM roles WHERE name = 'admin'").fetchone()[0]
+            user_role = cursor.execute("SELECT id FROM roles WHERE name = 'user'").fetchone()[0]
+            cursor.execute("INSERT INTO tenants (name) VALUES ('settings-a'), ('settings-b')")
+            tenant_a = cursor.execute("SELECT id FROM tenants WHERE name = 'settings-a'").fetchone()[0]
+            tenant_b = cursor.execute("SELECT id FROM tenants WHERE name = 'settings-b'").fetchone()[0]
+            cursor.execute("INSERT INTO users (username, password_hash, role_id, tenant_id) VALUES (?, ?, ?, ?)",
+                          ('boss', password_hash, admin_role, tenant_a))
+            for i in range(5):
+                cursor.execute("INSERT INTO users (username, password_hash, role_id, tenant_id) VALUES (?, ?, ?, ?)",
+                              (f'alice{i}', 'x', user_role, tenant_a))
+                cursor.execute("INSERT INTO users (username, password_hash, role_id, tenant_id) VALUES (?, ?, ?, ?)",
+                              (f'alice-b{i}', 'x', user_role, tenant_b))
+        response = client.post('/login', json={'username': 'boss', 'password': 'adminpass'})
+        assert response.status_code == 200
+        return client
+
+    def test_pages_cover_exactly_the_tenant(self, admin_client):
+        from database import get_db
+        seen = []
+        after = None
+        while True:
+            url = '/admin/user-settings?limit=2' + (f'&after={after}' if after else '')
+            data = admin_client.get(url).get_json()
+            seen.extend(user['username'] for user in data['users'])
+            after = data['next_after']
+            if not after:
+                break
+        with get_db() as conn:
+            expected = [row[0] for row in conn.execute(
+                "SELECT username FROM users WHERE tenant_id = "
+                "(SELECT id FROM tenants WHERE name = 'settings-a') ORDER BY username")]
+        assert seen == expected
+
+    def test_unpaged_request_returns_every_user(self, admin_client, monkeypatch):
+        import calculator_app
+        monkeypatch.setattr(calculator_app, 'ADMIN_USERS_PAGE_SIZE', 2)
+        data = admin_client.get('/admin/user-settings').get_json()
+        # boss and alice0-4: more than one page, none dropped
+        assert len(data['users']) == 6
+        assert data['next_after'] is None
+        assert len(admin_client.get('/admin/user-settings?limit=50').get_json()['users']) == 2
+
+    def test_prefix_search(self, admin_client):
+        data = admin_client.get('/admin/user-settings?q=alice').get_json()
+        assert [user['username'] for user in data['users']] == [f'alice{i}' for i in range(5)]
+
+    def test_compact_format(self, admin_client):
+        data = admin_client.get('/admin/user-settings?format=compact&q=boss').get_json()
+        assert data['columns'] == ['id', 'username', 'allow_parentheses', 'allow_exponents']
+        assert data['rows'][0][1:] == ['boss', 1, 1]
+
+
+class TestRequestInstrumentation:
+    def test_server_timing_on_calculate(self, client, auth_token):
+        if not auth_token:
+            pytest.skip("Could not get auth token")
+        response = client.post('/calculate', json={'expression': '6*7'},
+                              headers={'Authorization': f'Bearer {auth_token}'})
+        header = response.headers['Server-Timing']
+        assert 'total;dur=' in header
+        assert 'eval;dur=' in header
+        assert 'db-log_audit' in header
+
+    def test_request_log_line(self, client, caplog):
+        import json
+        import logging
+        import instrumentation
+        instrumentation.request_logger.propagate = True
+        try:
+            with caplog.at_level(logging.INFO, logger='calculator.requests'):
+                client.get('/check-auth')
+        finally:
+            instrumentation.request_logger.propagate = False
+        record = json.loads(caplog.records[-1].getMessage())
+        assert record['endpoint'] == 'check_auth'
+        assert record['status'] == 401
+        assert {'duration_ms', 'queries', 'db_ms', 'eval_ms', 'operations'} <= set(record)
+
+
+class TestMetricsEndpoint:
+    def test_metrics_exposes_requests_and_denials(self, client, auth_token, metrics_enabled):
+        if not auth_token:
+            pytest.skip("Could not get auth token")
+        from database import get_db
+        headers = {'Authorization': f'Bearer {auth_token}'}
+        with get_db() as conn:
+            user_id = conn.execute("SELECT id FROM users WHERE username = 'testuser'").fetchone()[0]
+            conn.execute("INSERT OR REPLACE INTO user_settings (user_id, allow_parentheses, allow_exponents) "
+                         "VALUES (?, 0, 1)", (user_id,))
+        client.post('/calculate', json={'expression': '(1+2)'}, headers=headers)
+        client.post('/calculate', json={'expression': '1+2'}, headers=headers)
+
+        response = client.get('/metrics')
+        assert response.status_code == 200
+        assert response.content_type.startswith('text/plain')
+        body = response.get_data(as_text=True)
+        assert 'calculator_calculate_denied_total{reason="Parentheses not allowed"}' in body
+        assert 'calculator_http_requests_total{method="POST",route="/calculate",status="200"}' in body
+        assert 'calculator_db_operation_duration_seconds_bucket' in body
+        assert 'calculator_eval_duration_seconds_count' in body
+        assert 'calculator_audit_queue_depth' in body
+
+    def test_metrics_off_by_default(self, client):
+        assert client.get('/metrics').status_code == 404
+
+    def test_disabled_metrics_are_not_collected(self, client, monkeypatch):
+        import metrics
+        calls = []
+        monkeypatch.setattr(metrics, 'observe_request', lambda *args: calls.append('observe'))
+        monkeypatch.setattr(metrics, 'sync_worker_stats', lambda *args: calls.append('sync'))
+        client.get('/login')
+        assert calls == []
+
+    def test_metrics_token_required_when_set(self, client, metrics_enabled, monkeypatch):
+        import calculator_app
+        monkeypatch.setattr(calculator_app, 'METRICS_TOKEN', 'scrape-secret')
+        assert client.get('/metrics').status_code == 401
+        assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+        response = client.get('/metrics', headers={'Authorization': 'Bearer scrape-secret'})
+        assert response.status_code == 200
+        assert 'calculator_http_requests_total' in response.get_data(as_text=True)
+
+
+class TestEvaluationLimits:
+
+    def test_tenant_budget_override(self, client, auth_token):
+        if not auth_token:
+            pytest.skip("Could not get auth token")
+        from database import get_db, set_tenant_eval_limits
+        headers = {'Authorization': f'Bearer {auth_token}'}
+        with get_db() as conn:
+            tenant_id = conn.execute("SELECT id FROM tenants WHERE name = 'test-tenant'").fetchone()[0]
+
+        response = client.post('/calculate', json={'expression': '9^9^9'}, headers=headers)
+        assert response.get_json()['result'] == 'Result too large'
+        assert client.post('/calculate', json={'expression': '10^20'}, headers=headers).get_json()['result'] == str(10 ** 20)
+
+        set_tenant_eval_limits(tenant_id, max_digits=10, overflow='scientific')
+        response = client.post('/calculate/batch', json={'expressions': ['10^20', '10^5']}, headers=headers)
+        assert [r['result'] for r in response.get_json()['results']] == ['1.00000e+20', '100000']
+
+        set_tenant_eval_limits(tenant_id)
+        assert client.post('/calculate', json={'expression': '10^20'}, headers=headers).get_json()['result'] == str(10 ** 20)
+
+
+class TestEvaluationPoolBackend:
+    def test_missed_deadline_reported(self, client, auth_token, monkeypatch, metrics_enabled):
+        if not auth_token:
+            pytest.skip("Could not get auth token")
+        import calculator_app
+        from eval_pool import EvaluationPool
+        pool = EvaluationPool(size=1, timeout=1e-6)
+        monkeypatch.setattr(calculator_app.calculator, 'offload', pool)
+        monkeypatch.setattr(calculator_app.eval_pool, 'pool', pool)
+        headers = {'Authorization': f'Bearer {auth_token}'}
+        try:
+            response = client.post('/calculate', json={'expression': '2^12'}, headers=headers)
+            assert response.get_json()['result'] == 'Evaluation timed out'
+            # Cheap expressions never reach the pool
+            response = client.post('/calculate', json={'expression': '2*12'}, headers=headers)
+            assert response.get_json()['result'] == '24'
+            body = client.get('/metrics').get_data(as_text=True)
+            assert 'calculator_eval_pool_killed_total 1.0' in body
+            assert 'calculator_eval_pool_waiting' in body
+        finally:
+            pool.shutdown()
+
+
+class TestSQLProfileEndpoint:
+    def test_admin_sees_top_statements(self, client, monkeypatch):
+        import database
+        import sql_profiler
+        monkeypatch.setattr(sql_profiler, 'ENABLED', True)
+        monkeypatch.setattr(sql_profiler, 'profiler', sql_profiler.SQLProfiler())
+        database.close_all_connections()  # reconnect with the profiling factory
+        response = client.post('/login', json={'username': 'admin', 'password': 'admin123'})
+        headers = {'Authorization': f"Bearer {response.get_json()['token']}"}
+        data = client.get('/admin/sql-profile?sort=count', headers=headers).get_json()
+        assert data['statements']
+        assert {'sql', 'count', 'total_ms', 'max_ms', 'rows'} <= set(data['statements'][0])
+        assert client.delete('/admin/sql-profile', headers=headers).get_json()['success']
+
+    def test_disabled_by_default(self, client, monkeypatch):
+        import sql_profiler
+        monkeypatch.setattr(sql_profiler, 'ENABLED', False)
+        response = client.post('/login', json={'username': 'admin', 'password': 'admin123'})
+        headers = {'Authorization': f"Bearer {response.get_json()['token']}"}
+        assert client.get('/admin/sql-profile', headers=headers).status_code == 404
+
+
+class TestAppFactory:
+    def test_create_app_builds_independent_app(self, client):
+        from calculator_app import create_app
+        other = create_app()
+        assert other is not app
+        assert {rule.rule for rule in other.url_map.iter_rules()} == {rule.rule for rule in app.url_map.iter_rules()}
+        assert other.test_client().get('/check-auth').status_code == 401
+
+    def test_google_client_built_on_first_use(self, tmp_path):
+        import subprocess
+        # A fresh interpreter: authlib may already be imported by other tests
+        env = dict(os.environ, SECRET_KEY='test', DATABASE_PATH=str(tmp_path / 'lazy.db'))
+        env.pop('GOOGLE_CLIENT_ID', None)
+        env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+        probe = (
+            "import sys, calculator_app\n"
+            "assert 'authlib' not in sys.modules\n"
+            "client = calculator_app.app.test_client()\n"
+            "assert client.get('/login').status_code == 200\n"
+            "assert client.get('/login/google').status_code == 503\n"
+            "assert 'authlib' not in sys.modules\n"
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run([sys.executable, '-c', probe], cwd=root, env=env,
+                                capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
+
+    def test_google_client_registered_when_configured(self, client, monkeypatch):
+        import calculator_app
+        monkeypatch.setenv('GOOGLE_CLIENT_ID', 'id')
+        monkeypatch.setenv('GOOGLE_CLIENT_SECRET', 'secret')
+        monkeypatch.setattr(calculator_app, '_google', None)
+        with app.app_context():
+            google = calculator_app.get_google_client()
+            assert google.name == 'google'
+            assert calculator_app.get_google_client() is google
+
+
+class TestRateLimiting:
+    @pytest.fixture
+    def limiter(self, monkeypatch):
+        import rate_limiter
+        from rate_limiter import RateLimit, RateLimiter
+        limiter = RateLimiter({
+            'login': RateLimit(capacity=2, period=60),
+            'refresh': RateLimit(capacity=2, period=60),
+            'calculate': RateLimit(capacity=3, period=60),
+        })
+        monkeypatch.setattr(rate_limiter, 'limiter', limiter)
+        return limiter
+
+    def test_login_limited_per_client(self, client, limiter, metrics_enabled):
+        for _ in range(2):
+            assert client.post('/login', json={'username': 'nobody', 'password': 'x'}).status_code == 401
+        response = client.post('/login', json={'username': 'admin', 'password': 'admin123'})
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) >= 1
+        assert response.get_json()['retry_after'] == int(response.headers['Retry-After'])
+        # The login page itself is not limited
+        assert client.get('/login').status_code == 200
+        # Behind no trusted proxy, a forged X-Forwarded-For is ignored
+        response = client.post('/login', json={'username': 'admin', 'password': 'admin123'},
+                               headers={'X-Forwarded-For': '203.0.113.9'})
+        assert response.status_code == 429
+        body = client.get('/metrics').get_data(as_text=True)
+        assert 'calculator_rate_limit_requests_total{limit="login",outcome="limited"}' in body
+
+    def test_calculate_limited_per_user_with_batch_cost(self, client, auth_token, limiter):
+        if not auth_token:
+            pytest.skip("Could not get auth token")
+        headers = {'Authorization': f'Bearer {auth_token}'}
+        response = client.post('/calculate/batch', json={'expressions': ['1+1', '2+2']}, headers=headers)
+        assert response.status_code == 200
+        assert client.post('/calculate', json={'expression': '1+1'}, headers=headers).status_code == 200
+        response = client.post('/calculate', json={'expression': '1+1'}, headers=headers)
+        assert response.status_code == 429
+        assert 'Retry-After' in response.headers
+
+    def test_refresh_limited(self, client, auth_token, limiter):
+        if not auth_token:
+            pytest.skip("Could not get auth token")
+        headers = {'Authorization': f'Bearer {auth_token}'}
+        statuses = [client.post('/api/auth/refresh', headers=headers).status_code for _ in range(3)]
+        assert statuses == [200, 200, 429]
+
+    def test_tenant_concurrency_quota(self, client, auth_token, monkeypatch):
+        if not auth_token:
+            pytest.skip("Could not get auth token")
+        import rate_limiter
+        from calculator_app import verify_token
+        from rate_limiter import TenantAdmission
+        admission = TenantAdmission(max_inflight=1, lease_seconds=30)
+        monkeypatch.setattr(rate_limiter, 'admission', admission)
+        headers = {'Authorization': f'Bearer {auth_token}'}
+        tenant_id = verify_token(auth_token)['tenant_id']
+        # Another worker is busy with this tenant's only slot
+        lease = admission.acquire(tenant_id)
+        response = client.post('/calculate', json={'expression': '1+1'}, headers=headers)
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == '1'
+        admission.release(lease)
+        assert client.post('/calculate', json={'expression': '1+1'}, headers=headers).status_code == 200
+        # The request's own lease was released when it finished
+        assert client.post('/calculate', json={'expression': '2+2'}, headers=headers).status_code == 200
+
+    def test_locked_store_fails_open(self, client, auth_token, limiter, monkeypatch, metrics_enabled):
+        if not auth_token:
+            pytest.skip("Could not get auth token")
+        import sqlite3
+        import database
+        import rate_limiter
+        from rate_limiter import TenantAdmission
+        monkeypatch.setattr(rate_limiter, 'admission', TenantAdmission(max_inflight=1, lease_seconds=30))
+
+        def locked(*args):
+            raise sqlite3.OperationalError('database is locked')
+        monkeypatch.setattr(database, 'take_rate_limit_tokens', locked)
+        monkeypatch.setattr(database, 'acquire_admission_lease', locked)
+        headers = {'Authorization': f'Bearer {auth_token}'}
+        # More requests than the bucket and the tenant quota allow, all let through
+        statuses = [client.post('/calculate', json={'expression': '1+1'}, headers=headers).status_code
+                    for _ in range(5)]
+        assert statuses == [200] * 5
+        body = client.get('/metrics').get_data(as_text=True)
+        assert 'calculator_rate_limit_requests_total{limit="calculate",outcome="store_busy"}' in body
+        assert 'calculator_rate_limit_requests_total{limit="tenant_inflight",outcome="store_busy"}' in body
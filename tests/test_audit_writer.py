@@ -0,0 +1,94 @@
+# tests/test_audit_writer.py
+import pytest
+import sys
+import os
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from database import init_db, get_db
+from audit_writer import AuditWriter
+
+
+def count_audit_rows():
+    with get_db() as conn:
+        return conn.execute('SELECT COUNT(*) FROM audit_logs').fetchone()[0]
+
+
+class TestAuditWriter:
+    def setup_method(self):
+        self.test_db = tempfile.NamedTemporaryFile(delete=False, suffix='.db')
+        self.test_db.close()
+        self.original_db = database.DATABASE
+        database.DATABASE = self.test_db.name
+        init_db()
+
+    def teardown_method(self):
+        database.close_all_connections()
+        database.DATABASE = self.original_db
+        os.unlink(self.test_db.name)
+
+    def test_group_commit(self):
+        writer = AuditWriter(flush_interval=0.05, batch_size=50)
+        for i in range(120):
+            writer.submit({'user_id': 1, 'username': 'admin', 'action': 'calculate', 'expression': f'{i}+1'})
+        assert writer.flush()
+        writer.shutdown()
+        assert count_audit_rows() == 120
+        # 120 rows in batches of at most 50 rows
+        assert 3 <= writer.batches < 120
+
+    def test_shutdown_flushes_pending_rows(self):
+        writer = AuditWriter(flush_interval=10, batch_size=1000)
+        for i in range(10):
+            writer.submit({'user_id': 1, 'username': 'admin', 'action': 'login'})
+        writer.shutdown()
+        assert count_audit_rows() == 10
+
+    def test_tenant_resolved_in_writer(self):
+        writer = AuditWriter()
+        writer.submit({'user_id': 1, 'username': 'admin', 'action': 'logout'})
+        writer.shutdown()
+        with get_db() as conn:
+            assert conn.execute('SELECT tenant_id FROM audit_logs').fetchone()[0] == 1
+
+    def test_backpressure_writes_synchronously(self):
+        writer = AuditWriter(max_queue=1, put_timeout=0.01)
+        # Writer thread not started yet: fill the queue by hand
+        writer._ensure_started = lambda: None
+        writer._queue.put({'user_id': 1, 'username': 'admin', 'action': 'login'})
+        writer.submit({'user_id': 1, 'username': 'admin', 'action': 'logout'})
+        assert writer.sync_writes == 1
+        assert count_audit_rows() == 1
+
+    def test_failed_batch_falls_back_to_single_rows(self, monkeypatch):
+        import sqlite3
+
+        def full_disk(entries):
+            raise sqlite3.OperationalError('database or disk is full')
+        monkeypatch.setattr(database, 'log_audit_many', full_disk)
+        writer = AuditWriter(flush_interval=0.05, batch_size=50)
+        for i in range(5):
+            writer.submit({'user_id': 1, 'username': 'admin', 'action': 'calculate', 'expression': f'{i}+1'})
+        writer.shutdown()
+        assert count_audit_rows() == 5
+        assert writer.written == 5 and writer.failed == 0
+
+    def test_locked_batch_is_retried(self, monkeypatch):
+        import sqlite3
+        log_audit_many = database.log_audit_many
+        attempts = []
+
+        def locked_once(entries):
+            attempts.append(len(entries))
+            if len(attempts) == 1:
+                raise sqlite3.OperationalError('database is locked')
+            return log_audit_many(entries)
+        monkeypatch.setattr(database, 'log_audit_many', locked_once)
+        writer = AuditWriter(flush_interval=0.05, batch_size=50, retry_backoff=0.01)
+        for i in range(3):
+            writer.submit({'user_id': 1, 'username': 'admin', 'action': 'login'})
+        writer.shutdown()
+        assert count_audit_rows() == 3
+        # The same batch went in on the second attempt
+        assert attempts[0] == attempts[1] and writer.failed == 0
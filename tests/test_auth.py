@@ -40,3 +40,46 @@ class TestJWT:
         assert payload['username'] == 'john'
         assert payload['role_name'] == 'admin'
         assert payload['tenant_id'] == 5
+
+    def test_token_with_embedded_claims(self):
+        claims = {'perms': ['calculate'], 'settings': {'allow_parentheses': True, 'allow_exponents': False},
+                  'sv': 3, 'rg': 1}
+        token = generate_token(7, 'fat', 'user', 1, claims)
+        payload = verify_token(token)
+        assert payload['perms'] == ['calculate']
+        assert payload['settings']['allow_exponents'] is False
+        assert payload['sv'] == 3
+
+    def test_plain_token_has_no_claims(self):
+        payload = verify_token(generate_token(1, 'testuser', 'user', 1))
+        assert 'perms' not in payload
+
+    def test_verified_token_cached(self):
+        from calculator_app import token_cache
+        token = generate_token(42, 'cached', 'user', 1)
+        hits = token_cache.hits
+        assert verify_token(token)['user_id'] == 42
+        assert verify_token(token)['user_id'] == 42
+        assert token_cache.hits == hits + 1
+
+    def test_invalid_token_not_cached(self):
+        assert verify_token('not-a-jwt') is None
+        assert verify_token('not-a-jwt') is None
+
+
+class TestVerifiedTokenCache:
+    def test_expired_entry_not_returned(self):
+        import time
+        from calculator_app import VerifiedTokenCache
+        cache = VerifiedTokenCache()
+        cache.put('tok', {'user_id': 1, 'exp': time.time() - 1})
+        assert cache.get('tok') is None
+
+    def test_bounded(self):
+        import time
+        from calculator_app import VerifiedTokenCache
+        cache = VerifiedTokenCache(max_entries=2)
+        for name in ('a', 'b', 'c'):
+            cache.put(name, {'exp': time.time() + 60})
+        assert cache.get('a') is None
+        assert cache.get('c') is not None
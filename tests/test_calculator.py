@@ -5,6 +5,7 @@ import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from calculator_app import Calculator
+from calculator_engine import EvaluationLimits, ResultCache, normalize_expression
 
 class TestCalculator:
     def setup_method(self):
@@ -86,3 +87,128 @@ class TestCalculator:
     def test_negative_numbers(self):
         assert self.calc.evaluate("-5+3") == "-2"
         assert self.calc.evaluate("5+-3") == "2"
+
+    def test_invalid_characters(self):
+        assert self.calc.evaluate("2+a") == "Invalid characters in expression"
+        assert self.calc.evaluate("__import__('os')") == "Invalid characters in expression"
+        # Only ASCII digits are numbers
+        assert self.calc.evaluate("\u0663+1") == "Invalid characters in expression"
+        assert self.calc.evaluate("\uff11+1") == "Invalid characters in expression"
+
+    def test_unary_minus_precedence(self):
+        assert self.calc.evaluate("-2^2") == "-4"
+        assert self.calc.evaluate("2^-1") == "0.5"
+        assert self.calc.evaluate("-(2+3)*2") == "-10"
+
+    def test_is_valid_expression(self):
+        assert self.calc.is_valid_expression("(1+2)*3")
+        assert not self.calc.is_valid_expression("(1+2")
+        assert not self.calc.is_valid_expression("2 3")
+
+    def test_compiled_program_is_reusable(self):
+        program = self.calc.compile("2+3*4")
+        assert program == (2, 3, 4, '*', '+')
+        assert self.calc.execute(program) == 14
+        assert self.calc.execute(program) == 14
+
+    def test_double_star_exponent(self):
+        assert self.calc.evaluate("2**3") == "8"
+        assert self.calc.evaluate("2 ** 3") == "8"
+
+    def test_separated_stars_are_not_an_exponent(self):
+        assert self.calc.evaluate("2* *3") == "Invalid expression"
+        assert self.calc.evaluate("2 * * 3") == "Invalid expression"
+
+
+class TestEvaluationLimits:
+    def setup_method(self):
+        self.calc = Calculator()
+        self.scientific = Calculator(limits=EvaluationLimits(overflow='scientific'))
+
+    def test_huge_powers_refused_without_computing(self):
+        assert self.calc.evaluate("9^9^9") == "Result too large"
+        assert self.calc.evaluate("99999^99999") == "Result too large"
+
+    def test_results_within_budget_are_exact(self):
+        assert len(self.calc.evaluate("10^4299")) == 4300
+        assert self.calc.evaluate("1^99999999999") == "1"
+        assert self.calc.evaluate("2^-99999") == "0.0"
+
+    def test_products_and_sums_are_bounded(self):
+        assert self.calc.evaluate("10^3000*10^3000") == "Result too large"
+        assert self.calc.evaluate("9*10^4299+10^4299") == "Result too large"
+
+    def test_float_overflow(self):
+        assert self.calc.evaluate("2.5^99999") == "Result too large"
+        assert self.calc.evaluate("(2^4000)/3") == "Result too large"
+
+    def test_scientific_final_result(self):
+        assert self.scientific.evaluate("99999^99999") == "3.67881e+499994"
+        assert self.scientific.evaluate("-3^99999") == "-4.44990e+47711"
+        # Intermediate values cannot be approximated
+        assert self.scientific.evaluate("99999^99999+1") == "Result too large"
+
+    def test_per_call_limits(self):
+        small = EvaluationLimits(max_digits=10)
+        assert self.calc.evaluate("10^9", small) == "1000000000"
+        assert self.calc.evaluate("10^10", small) == "Result too large"
+        assert self.calc.evaluate("10^10") == "10000000000"
+
+    def test_cache_keyed_by_limits(self):
+        calc = Calculator(cache=ResultCache())
+        assert calc.evaluate("10^10") == "10000000000"
+        assert calc.evaluate("10^10", EvaluationLimits(max_digits=10)) == "Result too large"
+        assert calc.evaluate("10^10") == "10000000000"
+
+    def test_invalid_limits(self):
+        with pytest.raises(ValueError):
+            EvaluationLimits(overflow='wrap')
+        with pytest.raises(ValueError):
+            EvaluationLimits(max_digits=0)
+
+
+class TestNormalizeExpression:
+    def test_whitespace_removed(self):
+        assert normalize_expression(" 2 + ( 3 * 4 ) ") == "2+(3*4)"
+
+    def test_space_between_numbers_kept(self):
+        assert normalize_expression("2  3") == "2 3"
+
+    def test_double_star_becomes_caret(self):
+        assert normalize_expression("2 ** 3") == "2^3"
+        assert normalize_expression("2 * * 3") == "2**3"
+
+
+class TestResultCache:
+    def setup_method(self):
+        self.cache = ResultCache(max_entries=2)
+        self.calc = Calculator(cache=self.cache)
+
+    def test_hit_on_equivalent_expression(self):
+        assert self.calc.evaluate("2 ** 3") == "8"
+        assert self.calc.evaluate("2^3") == "8"
+        stats = self.cache.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+
+    def test_lru_eviction(self):
+        self.calc.evaluate("1+1")
+        self.calc.evaluate("2+2")
+        self.calc.evaluate("1+1")  # refresh 1+1
+        self.calc.evaluate("3+3")  # evicts 2+2
+        assert self.cache.get("2+2") is None
+        assert self.cache.get("1+1") == "2"
+        assert self.cache.stats()['evictions'] == 1
+
+    def test_memory_bound(self):
+        cache = ResultCache(max_entries=100, max_bytes=1000)
+        for i in range(20):
+            cache.put(f"{i}+{i}", str(i * 2))
+        stats = cache.stats()
+        assert stats['bytes'] <= 1000
+        assert stats['evictions'] > 0
+
+    def test_invalid_results_cached(self):
+        assert "Invalid" in self.calc.evaluate("2++3")
+        assert "Invalid" in self.calc.evaluate("2++3")
+        assert self.cache.stats()['hits'] == 1
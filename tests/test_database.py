@@ -22,6 +22,7 @@ class TestDatabase:
     
     def teardown_method(self):
         import database
+        database.close_all_connections()
         database.DATABASE = self.original_db
         import os
         os.unlink(self.test_db.name)
@@ -51,3 +52,561 @@ class TestDatabase:
             with pytest.raises(sqlite3.IntegrityError):
                 cursor.execute("INSERT INTO users (username, password_hash, email) VALUES (?, ?, ?)", 
                              ('user2', 'hash2', 'test@example.com'))
+
+    def test_get_db_reuses_thread_connection(self, monkeypatch):
+        import database
+        monkeypatch.setattr(database, 'CONNECTION_STRATEGY', 'thread')
+        from database import get_db
+        with get_db() as first:
+            pass
+        with get_db() as second:
+            pass
+        assert first is second
+
+    def test_get_db_per_thread_connections(self, monkeypatch):
+        import database
+        monkeypatch.setattr(database, 'CONNECTION_STRATEGY', 'thread')
+        import threading
+        from database import get_db
+        seen = []
+
+        def worker():
+            with get_db() as conn:
+                conn.execute("SELECT 1")
+                seen.append(conn)
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        with get_db() as conn:
+            assert seen[0] is not conn
+
+    def test_nested_get_db_commits_once(self):
+        from database import get_db
+        with pytest.raises(RuntimeError):
+            with get_db() as outer:
+                outer.execute("INSERT INTO tenants (name) VALUES ('nested-outer')")
+                with get_db() as inner:
+                    inner.execute("INSERT INTO tenants (name) VALUES ('nested-inner')")
+                raise RuntimeError('abort outer transaction')
+        with get_db() as conn:
+            count = conn.execute("SELECT COUNT(*) FROM tenants WHERE name LIKE 'nested-%'").fetchone()[0]
+        assert count == 0
+
+    def test_abandoned_generator_rolls_back(self):
+        from database import get_db
+
+        def stream():
+            with get_db() as conn:
+                conn.execute("INSERT INTO tenants (name) VALUES ('streamed')")
+                yield 'row'
+                yield 'never reached'
+
+        rows = stream()
+        next(rows)
+        rows.close()  # client disconnected mid-response: GeneratorExit inside get_db
+        with get_db() as conn:
+            assert not conn.in_transaction
+            assert conn.execute("SELECT COUNT(*) FROM tenants WHERE name = 'streamed'").fetchone()[0] == 0
+
+    def test_base_exception_rolls_back(self):
+        from database import get_db
+        with pytest.raises(SystemExit):
+            with get_db() as conn:
+                conn.execute("INSERT INTO tenants (name) VALUES ('interrupted')")
+                raise SystemExit
+        with get_db() as conn:
+            assert not conn.in_transaction
+            assert conn.execute("SELECT COUNT(*) FROM tenants WHERE name = 'interrupted'").fetchone()[0] == 0
+
+
+    def test_audit_logs_keyset_pagination(self):
+        from database import log_audit, get_audit_logs, encode_audit_cursor
+        for i in range(5):
+            log_audit(1, 'pager', 'calculate', expression=f'{i}+{i}', tenant_id=7)
+        first = get_audit_logs(tenant_id=7, limit=3)
+        rest = get_audit_logs(tenant_id=7, limit=3, cursor=encode_audit_cursor(first[-1]))
+        ids = [row['id'] for row in first + rest]
+        assert len(ids) == 5
+        assert ids == sorted(ids, reverse=True)
+
+    def test_audit_logs_projection(self):
+        from database import log_audit, get_audit_logs
+        log_audit(1, 'pager', 'calculate', expression='1+1', tenant_id=7)
+        row = get_audit_logs(tenant_id=7, columns=['expression'])[0]
+        assert row['expression'] == '1+1'
+        assert 'user_agent' not in row
+        with pytest.raises(ValueError):
+            get_audit_logs(columns=['password_hash'])
+
+    def test_decode_audit_cursor_rejects_garbage(self):
+        from database import decode_audit_cursor
+        with pytest.raises(ValueError):
+            decode_audit_cursor('not-a-cursor')
+
+
+    def test_calculate_audit_rows_feed_history(self):
+        from database import log_audit, log_audit_many, get_calculation_history
+        log_audit(5, 'hist', 'login', tenant_id=1)
+        log_audit(5, 'hist', 'calculate', expression='1+1', result='2', tenant_id=1)
+        log_audit_many([
+            {'user_id': 5, 'username': 'hist', 'action': 'calculate', 'expression': '2+2',
+             'result': '4', 'tenant_id': 1},
+            {'user_id': 5, 'username': 'hist', 'action': 'calculate_denied', 'expression': '2^2',
+             'tenant_id': 1},
+        ])
+        history = get_calculation_history(5)
+        assert [row['expression'] for row in history] == ['2+2', '1+1']
+        older = get_calculation_history(5, limit=1, before_id=history[0]['id'])
+        assert [row['expression'] for row in older] == ['1+1']
+
+    def test_history_backfilled_from_audit_logs(self):
+        from database import get_db, get_calculation_history
+        with get_db() as conn:
+            conn.execute("DELETE FROM calculations")
+            conn.execute("INSERT INTO audit_logs (user_id, username, action, expression, result) "
+                         "VALUES (9, 'old', 'calculate', '3*3', '9')")
+            # A database from before schema versioning is adopted by the baseline migration
+            conn.execute("PRAGMA user_version = 0")
+        init_db()
+        assert [row['result'] for row in get_calculation_history(9)] == ['9']
+
+    def test_history_query_uses_covering_index(self):
+        from database import get_db
+        with get_db() as conn:
+            plan = ' '.join(row[3] for row in conn.execute(
+                "EXPLAIN QUERY PLAN SELECT id, expression, result, timestamp FROM calculations "
+                "WHERE user_id = ? ORDER BY id DESC LIMIT 50", (1,)))
+        assert 'COVERING INDEX idx_calculations_user' in plan
+        assert 'TEMP B-TREE' not in plan
+
+
+    def test_audit_user_counts_follow_inserts(self):
+        from database import log_audit, log_audit_many, get_audit_user_counts, get_db
+        with get_db() as conn:
+            conn.execute("INSERT INTO users (id, username, password_hash, tenant_id) VALUES (50, 'counted', 'x', 1)")
+        log_audit(50, 'counted', 'login', tenant_id=1)
+        log_audit_many([{'user_id': 50, 'username': 'counted', 'action': 'calculate', 'tenant_id': 1}] * 3)
+        counts = {row['username']: row['log_count'] for row in get_audit_user_counts(1)}
+        assert counts['counted'] == 4
+        assert counts['admin'] == 0
+
+    def test_rebuild_audit_user_counts_fixes_drift(self):
+        from database import log_audit, rebuild_audit_user_counts, get_db
+        log_audit(1, 'admin', 'login', tenant_id=1)
+        with get_db() as conn:
+            conn.execute("UPDATE audit_user_counts SET log_count = 99")
+        rebuild_audit_user_counts(1)
+        with get_db() as conn:
+            count = conn.execute("SELECT log_count FROM audit_user_counts WHERE tenant_id = 1 AND user_id = 1").fetchone()[0]
+        assert count == 1
+
+
+class TestMigrations:
+    def setup_method(self):
+        import database
+        self.test_db = tempfile.NamedTemporaryFile(delete=False, suffix='.db')
+        self.test_db.close()
+        self.original_db = database.DATABASE
+        database.DATABASE = self.test_db.name
+
+    def teardown_method(self):
+        import database
+        database.close_all_connections()
+        database.DATABASE = self.original_db
+        os.unlink(self.test_db.name)
+
+    def test_new_database_migrated_once(self):
+        import database
+        assert database.get_schema_version() == 0
+        assert database.migrate() == [m[0] for m in database.MIGRATIONS]
+        assert database.get_schema_version() == database.SCHEMA_VERSION
+        assert database.migrate() == []
+        assert authenticate_user('admin', 'admin123') is not None
+
+    def test_current_schema_check_is_one_statement(self):
+        import database
+        import instrumentation
+        database.migrate()
+        request_metrics = instrumentation.start_request()
+        try:
+            database.ensure_schema()
+        finally:
+            instrumentation.end_request()
+        assert request_metrics.queries == 1
+
+    def test_no_statement_tracing_without_instrumentation(self, monkeypatch):
+        import database
+        import instrumentation
+        monkeypatch.setattr(instrumentation, 'SERVER_TIMING_ENABLED', False)
+        monkeypatch.setattr(instrumentation, 'REQUEST_LOG_ENABLED', False)
+        database.close_all_connections()
+        request_metrics = instrumentation.start_request()
+        try:
+            database.ensure_schema()
+        finally:
+            instrumentation.end_request()
+        assert request_metrics.queries == 0
+
+    def test_pre_versioning_database_adopted(self):
+        import database
+        with database.get_db() as conn:
+            conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL, "
+                         "password_hash TEXT, email TEXT UNIQUE, role_id INTEGER, tenant_id INTEGER, "
+                         "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, last_login TIMESTAMP)")
+            conn.execute("INSERT INTO users (username, password_hash) VALUES ('legacy', 'x')")
+        database.migrate()
+        with database.get_db() as conn:
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+            usernames = [row[0] for row in conn.execute("SELECT username FROM users")]
+        assert 'google_id' in columns
+        # Existing users are kept, so no default accounts are seeded
+        assert usernames == ['legacy']
+
+    def test_concurrent_migrations_apply_once(self):
+        import threading
+        import database
+        results = []
+
+        def worker():
+            results.append(database.migrate())
+            database.close_db()
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(results, key=len) == [[], [], [], [m[0] for m in database.MIGRATIONS]]
+        with database.get_db() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM roles").fetchone()[0] == 3
+
+    def test_migrate_retries_while_database_is_locked(self):
+        import threading
+        from dataclasses import replace
+        import database
+        original_profile = database.STORAGE_PROFILE
+        database.configure_storage(replace(original_profile, busy_timeout_ms=10,
+                                           busy_retries=5, busy_backoff=0.05))
+        blocker = sqlite3.connect(self.test_db.name, isolation_level=None, check_same_thread=False)
+        try:
+            blocker.execute('PRAGMA journal_mode = WAL')
+            blocker.execute('BEGIN IMMEDIATE')
+            timer = threading.Timer(0.2, blocker.execute, ['COMMIT'])
+            timer.start()
+            assert database.migrate() == [m[0] for m in database.MIGRATIONS]
+            timer.join()
+        finally:
+            blocker.close()
+            database.configure_storage(original_profile)
+
+    def test_migrate_refuses_to_commit_callers_transaction(self):
+        import database
+        database.migrate()
+        with pytest.raises(RuntimeError):
+            with database.get_db() as conn:
+                conn.execute("INSERT INTO tenants (name) VALUES ('caller')")
+                database.migrate()
+        with database.get_db() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM tenants WHERE name = 'caller'").fetchone()[0] == 0
+
+
+class TestConnectionPool:
+    def setup_method(self):
+        import database
+        self.test_db = tempfile.NamedTemporaryFile(delete=False, suffix='.db')
+        self.test_db.close()
+        self.original_db = database.DATABASE
+        self.original_strategy = database.CONNECTION_STRATEGY
+        database.DATABASE = self.test_db.name
+        database.CONNECTION_STRATEGY = 'pool'
+        init_db()
+
+    def teardown_method(self):
+        import database
+        database.close_all_connections()
+        database.CONNECTION_STRATEGY = self.original_strategy
+        database.DATABASE = self.original_db
+        os.unlink(self.test_db.name)
+
+    def test_connection_returned_to_pool(self):
+        import database
+        with database.get_db() as first:
+            assert database._local.conn is first
+        assert database._local.conn is None
+        with database.get_db() as second:
+            pass
+        assert first is second
+
+    def test_nested_blocks_share_checked_out_connection(self):
+        import database
+        with database.get_db() as outer:
+            with database.get_db() as inner:
+                assert inner is outer
+            # Still checked out until the outermost block ends
+            assert database._local.conn is outer
+
+    def test_interrupted_block_returns_clean_connection(self):
+        import database
+        with pytest.raises(KeyboardInterrupt):
+            with database.get_db() as conn:
+                conn.execute("INSERT INTO tenants (name) VALUES ('interrupted')")
+                raise KeyboardInterrupt
+        assert [entry[3] for entry in database._idle] == [conn]
+        assert not conn.in_transaction
+
+    def test_concurrent_checkouts_get_distinct_connections(self):
+        import threading
+        import database
+        barrier = threading.Barrier(4)
+        seen = []
+
+        def worker():
+            with database.get_db() as conn:
+                conn.execute("SELECT 1")
+                seen.append(conn)
+                barrier.wait(timeout=5)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len({id(conn) for conn in seen}) == 4
+        # All four went back to the pool instead of staying bound to their threads
+        assert len(database._idle) == 4
+
+    def test_stale_connections_not_reused(self):
+        import database
+        with database.get_db() as first:
+            pass
+        other_db = tempfile.NamedTemporaryFile(delete=False, suffix='.db')
+        other_db.close()
+        try:
+            database.DATABASE = other_db.name
+            with database.get_db() as second:
+                second.execute("SELECT 1")
+            assert second is not first
+            assert [entry[3] for entry in database._idle] == [second]
+        finally:
+            database.close_all_connections()
+            database.DATABASE = self.test_db.name
+            os.unlink(other_db.name)
+
+    def test_threaded_writes_are_consistent(self):
+        import threading
+        import database
+        errors = []
+
+        def worker(n):
+            try:
+                for i in range(20):
+                    database.log_audit(None, f'pool-{n}', 'calculate', expression=f'{n}+{i}',
+                                       result=str(n + i), tenant_id=1)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        with database.get_db() as conn:
+            count = conn.execute("SELECT COUNT(*) FROM audit_logs WHERE username LIKE 'pool-%'").fetchone()[0]
+        assert count == 160
+
+    def test_forked_worker_reopens_connections(self):
+        import database
+        if not hasattr(os, 'fork'):
+            pytest.skip("os.fork not available")
+        with database.get_db() as parent_conn:
+            parent_conn.execute("SELECT 1")
+        pid = os.fork()
+        if pid == 0:
+            # Child (as in gunicorn's post_fork): never touch the parent's handle
+            status = 1
+            try:
+                database.reinit_after_fork()
+                with database.get_db() as conn:
+                    if conn is not parent_conn and parent_conn in database._inherited:
+                        conn.execute("INSERT INTO tenants (name) VALUES ('forked')")
+                        status = 0
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        assert os.waitstatus_to_exitcode(status) == 0
+        with database.get_db() as conn:
+            assert conn is parent_conn
+            assert conn.execute("SELECT COUNT(*) FROM tenants WHERE name = 'forked'").fetchone()[0] == 1
+
+
+class TestStorageProfile:
+    def setup_method(self):
+        import database
+        self.test_db = tempfile.NamedTemporaryFile(delete=False, suffix='.db')
+        self.test_db.close()
+        self.original_db = database.DATABASE
+        self.original_profile = database.STORAGE_PROFILE
+        database.DATABASE = self.test_db.name
+        database.configure_storage(database.STORAGE_PROFILES['wal'])
+        init_db()
+
+    def teardown_method(self):
+        import database
+        database.configure_storage(self.original_profile)
+        database.DATABASE = self.original_db
+        os.unlink(self.test_db.name)
+
+    def test_wal_pragmas_applied(self):
+        from database import get_db
+        with get_db() as conn:
+            assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+            assert conn.execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+
+    def test_profile_from_env(self, monkeypatch):
+        from database import storage_profile_from_env
+        monkeypatch.setenv('DB_STORAGE_PROFILE', 'legacy')
+        monkeypatch.setenv('DB_BUSY_TIMEOUT_MS', '250')
+        profile = storage_profile_from_env()
+        assert profile.journal_mode == 'DELETE'
+        assert profile.busy_timeout_ms == 250
+
+    def test_retry_on_busy(self):
+        from database import retry_on_busy
+        calls = []
+
+        @retry_on_busy
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise sqlite3.OperationalError('database is locked')
+            return 'ok'
+
+        assert flaky() == 'ok'
+        assert len(calls) == 3
+
+    def test_concurrent_writers(self):
+        import threading
+        from database import log_audit, get_audit_logs, get_db
+        writers, rows_per_writer = 8, 50
+        errors = []
+
+        def write(n):
+            try:
+                for i in range(rows_per_writer):
+                    log_audit(n, f'writer{n}', 'calculate', expression=f'{n}+{i}', tenant_id=1)
+            except Exception as e:
+                errors.append(e)
+
+        def read():
+            try:
+                for _ in range(rows_per_writer):
+                    get_audit_logs(tenant_id=1, limit=20)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(writers)]
+        threads += [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        with get_db() as conn:
+            count = conn.execute("SELECT COUNT(*) FROM audit_logs WHERE action = 'calculate'").fetchone()[0]
+        assert count == writers * rows_per_writer
+
+
+class TestPermissionCache:
+    def setup_method(self):
+        import database
+        self.test_db = tempfile.NamedTemporaryFile(delete=False, suffix='.db')
+        self.test_db.close()
+        self.original_db = database.DATABASE
+        database.DATABASE = self.test_db.name
+        init_db()
+        self.cache = database.permission_cache
+        self.original_interval = self.cache.watcher.check_interval
+
+    def teardown_method(self):
+        import database
+        self.cache.watcher.check_interval = self.original_interval
+        database.close_all_connections()
+        database.DATABASE = self.original_db
+        os.unlink(self.test_db.name)
+
+    def _demote_admin_behind_cache(self):
+        from database import get_db
+        with get_db() as conn:
+            conn.execute("UPDATE users SET role_id = (SELECT id FROM roles WHERE name = 'viewer') "
+                         "WHERE username = 'admin'")
+
+    def test_role_map_precomputed_at_init(self):
+        assert self.cache._role_permissions
+        from database import has_permission
+        assert has_permission(1, 'manage_users')
+        assert not has_permission(2, 'manage_users')
+
+    def test_cached_until_generation_bump(self):
+        from database import has_permission, get_db
+        self.cache.watcher.check_interval = 3600
+        assert has_permission(1, 'view_audit')
+        self._demote_admin_behind_cache()
+        # Stale until another worker's change becomes visible
+        assert has_permission(1, 'view_audit')
+
+        # Simulate another worker bumping the shared generation counter
+        with get_db() as conn:
+            conn.execute("UPDATE cache_generations SET value = value + 1 WHERE name = 'rbac'")
+        self.cache.watcher.check_interval = 0
+        assert not has_permission(1, 'view_audit')
+
+    def test_explicit_invalidation(self):
+        from database import has_permission, invalidate_permission_cache
+        self.cache.watcher.check_interval = 3600
+        assert has_permission(1, 'view_audit')
+        self._demote_admin_behind_cache()
+        invalidate_permission_cache()
+        assert not has_permission(1, 'view_audit')
+
+    def test_tenant_change_invalidates(self):
+        from database import get_user_permissions, remove_user_from_tenant
+        get_user_permissions(2)
+        assert self.cache._user_roles
+        remove_user_from_tenant(2, 1)
+        assert not self.cache._user_roles
+
+    def test_invalidated_when_the_change_commits(self):
+        import threading
+        from database import _bump_generation, close_db, get_db, has_permission
+        self.cache.watcher.check_interval = 3600
+        assert has_permission(1, 'view_audit')
+        seen = []
+
+        def other_request():
+            seen.append(has_permission(1, 'view_audit'))
+            close_db()
+
+        with get_db() as conn:
+            conn.execute("UPDATE users SET role_id = (SELECT id FROM roles WHERE name = 'viewer') "
+                         "WHERE username = 'admin'")
+            _bump_generation(conn, 'rbac')
+            # Another thread reading before the commit must not cache the old role for good
+            thread = threading.Thread(target=other_request)
+            thread.start()
+            thread.join()
+        assert seen == [True]
+        assert not has_permission(1, 'view_audit')
+
+    def test_rolled_back_change_keeps_cache(self):
+        from database import _bump_generation, get_db, has_permission
+        self.cache.watcher.check_interval = 3600
+        assert has_permission(1, 'view_audit')
+        with pytest.raises(RuntimeError):
+            with get_db() as conn:
+                _bump_generation(conn, 'rbac')
+                raise RuntimeError('abort')
+        assert self.cache._user_roles
@@ -0,0 +1,70 @@
+# tests/test_eval_pool.py
+import pytest
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from calculator_engine import Calculator, EvaluationLimits, ResultCache
+from eval_pool import EvaluationAborted, EvaluationPool
+
+
+class TestEvaluationPool:
+    def setup_method(self):
+        self.pool = EvaluationPool(size=2, timeout=10.0, max_tasks=3)
+
+    def teardown_method(self):
+        self.pool.shutdown()
+
+    def test_only_expensive_expressions_offloaded(self):
+        pool = EvaluationPool(inline_max_chars=10)
+        assert pool.should_offload('2^10')
+        assert pool.should_offload('1+' * 10 + '1')
+        assert not pool.should_offload('1+2*3')
+
+    def test_results_match_inline(self):
+        inline = Calculator()
+        for expression in ['2^10', '9^9^9', '2^-1', '(1+2)^3', '2^+']:
+            assert self.pool.evaluate(expression) == inline.evaluate(expression)
+        assert self.pool.evaluate('10^20', EvaluationLimits(max_digits=10)) == 'Result too large'
+
+    def test_workers_reused_then_recycled(self):
+        self.pool.start()
+        assert self.pool.stats()['idle'] == 2
+        for _ in range(6):
+            self.pool.evaluate('2^8')
+        stats = self.pool.stats()
+        assert stats['completed'] == 6
+        assert stats['recycled'] == 2
+        assert stats['live'] <= 2
+
+    def test_missed_deadline_kills_worker(self):
+        self.pool.evaluate('2^8')
+        self.pool.timeout = 1e-6  # no round trip to another process is this fast
+        with pytest.raises(EvaluationAborted, match='timed out'):
+            self.pool.evaluate('2^8')
+        stats = self.pool.stats()
+        assert stats['killed'] == 1
+        assert stats['live'] == 0
+        self.pool.timeout = 10.0
+        assert self.pool.evaluate('2^8') == '256'
+
+    def test_deadline_covers_waiting_for_a_worker(self):
+        pool = EvaluationPool(size=1, timeout=0.05)
+        worker = pool._acquire(float('inf'))
+        try:
+            with pytest.raises(EvaluationAborted):
+                pool.evaluate('2^8')
+            assert pool.stats()['timeouts'] == 1
+        finally:
+            pool._release(worker, 'completed')
+            pool.shutdown()
+
+    def test_aborted_results_not_cached(self):
+        calculator = Calculator(cache=ResultCache(), offload=self.pool)
+        self.pool.timeout = 1e-6
+        with pytest.raises(EvaluationAborted):
+            calculator.evaluate('2^8')
+        self.pool.timeout = 10.0
+        assert calculator.evaluate('2^8') == '256'
+        assert calculator.evaluate('1+1') == '2'
+        assert self.pool.stats()['completed'] == 1
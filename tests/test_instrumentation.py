@@ -0,0 +1,52 @@
+# tests/test_instrumentation.py
+import pytest
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import instrumentation
+from instrumentation import instrumented
+
+
+class TestRequestMetrics:
+    def setup_method(self):
+        instrumentation.start_request()
+
+    def teardown_method(self):
+        instrumentation.end_request()
+
+    def test_nested_operations_count_once(self):
+        @instrumented
+        def inner():
+            return 'inner'
+
+        @instrumented
+        def outer():
+            return inner()
+
+        assert outer() == 'inner'
+        operations = instrumentation.current().operations
+        assert list(operations) == ['outer']
+        assert operations['outer'][0] == 1
+
+    def test_statements_counted(self):
+        instrumentation.count_statement('SELECT 1')
+        instrumentation.count_statement('SELECT 2')
+        assert instrumentation.current().queries == 2
+
+    def test_server_timing_header(self):
+        with instrumentation.timed_eval():
+            pass
+        instrumentation.current().add_operation('get_user_settings', 0.002)
+        header = instrumentation.current().server_timing()
+        assert header.startswith('total;dur=')
+        assert 'eval;dur=' in header
+        assert 'db-get_user_settings;dur=2.00;desc="1x"' in header
+
+    def test_noop_outside_request(self):
+        instrumentation.end_request()
+        instrumentation.count_statement('SELECT 1')
+        instrumentation.record_db_time(1.0)
+        with instrumentation.timed_eval():
+            pass
+        assert instrumentation.current() is None
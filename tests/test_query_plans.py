@@ -0,0 +1,143 @@
+# tests/test_query_plans.py
+import pytest
+import sys
+import os
+import re
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import rate_limiter
+from calculator_app import app
+
+# Lookup tables that hold a handful of rows: scanning them is cheaper than an index
+SMALL_TABLES = {'roles', 'permissions', 'role_permissions', 'cache_generations', 'sqlite_master'}
+
+# Statements that must read a whole table by design
+FULL_LISTINGS = {
+    'SELECT id, name, created_at FROM tenants ORDER BY name',
+    'SELECT rp.role_id, p.name FROM role_permissions rp JOIN permissions p ON p.id = rp.permission_id',
+    'SELECT tenant_id, max_digits, overflow FROM tenant_eval_limits',
+}
+
+# SCAN lines walk a whole table or index (SEARCH lines are range lookups)
+_SCAN_RE = re.compile(r'^SCAN (?!CONSTANT ROW)(\w+)')
+
+_PLANNED_STATEMENTS = ('SELECT', 'UPDATE', 'DELETE', 'INSERT INTO CALCULATIONS',
+                       'INSERT INTO RATE_LIMIT_BUCKETS', 'INSERT INTO ADMISSION_LEASES')
+
+
+@pytest.fixture
+def traced_statements(monkeypatch):
+    """Run with every pooled connection tracing the SQL it executes"""
+    temp_db = tempfile.NamedTemporaryFile(delete=False, suffix='.db')
+    temp_db.close()
+    original_db = database.DATABASE
+    database.close_all_connections()
+    database.DATABASE = temp_db.name
+
+    statements = []
+    connect = database._connect
+
+    def traced_connect(path):
+        conn = connect(path)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    # Startup-only statements (schema, seed data, backfills) are not checked
+    app.config['TESTING'] = True
+    database.init_db()
+    database.close_all_connections()
+    monkeypatch.setattr(database, '_connect', traced_connect)
+    # Exercise the limiter's bucket and lease statements on every calculation
+    monkeypatch.setattr(rate_limiter, 'limiter', rate_limiter.RateLimiter(rate_limiter.limiter.limits))
+    monkeypatch.setattr(rate_limiter, 'admission', rate_limiter.TenantAdmission(max_inflight=100))
+    yield statements
+
+    database.close_all_connections()
+    database.DATABASE = original_db
+    os.unlink(temp_db.name)
+
+
+def run_workload():
+    """Exercise every query path in database.py and calculator_app.py"""
+    admin = app.test_client()
+    response = admin.post('/login', json={'username': 'admin', 'password': 'admin123'})
+    assert response.status_code == 200
+    token = response.get_json()['token']
+    headers = {'Authorization': f'Bearer {token}'}
+
+    user = app.test_client()
+    user.post('/login', json={'username': 'user', 'password': 'admin123'})
+
+    user_id = database.authenticate_user('user', 'admin123')['id']
+    new_tenant = database.create_tenant('plan-tenant', user_id)['tenant_id']
+    database.create_user_by_email('planner@example.com', 1)
+    database.check_duplicate_user(username='planner', email='planner@example.com', google_id='g-1')
+    database.authenticate_google_user('g-2', 'google@example.com', 'Google User')
+    database.get_users_without_tenant()
+    database.invalidate_permission_cache()
+
+    for expression in ('1+1', '2*(3+4)', '2^8'):
+        user.post('/calculate', json={'expression': expression})
+    user.post('/calculate/batch', json={'expressions': ['1+2', '3*4']})
+    user.get('/history')
+    history = user.get('/history?limit=1').get_json()
+    user.get(f"/history?limit=1&before={history['next_before']}")
+    user.get('/user/info')
+    user.get('/check-auth')
+    user.post('/api/auth/refresh', headers=headers)
+
+    page = admin.get('/audit?limit=2').get_json()
+    admin.get(f"/audit?limit=2&cursor={page['next_cursor']}")
+    admin.get(f'/audit?user_id={user_id}')
+    admin.get('/audit?fields=action,expression')
+    admin.get('/audit/users')
+    admin.get('/admin/user-settings')
+    settings_page = admin.get('/admin/user-settings?q=u&limit=1').get_json()
+    admin.get(f"/admin/user-settings?format=compact&after={settings_page['next_after']}")
+    admin.put(f'/admin/user-settings/{user_id}', json={'allow_parentheses': True, 'allow_exponents': False})
+    admin.get('/admin/assign-tenant')
+    admin.post('/admin/assign-tenant', json={'user_id': user_id, 'tenant_id': 1})
+    admin.post('/admin/create-user', json={'email': 'created@example.com'})
+    admin.post('/admin/remove-tenant', json={'user_id': user_id})
+    database.delete_tenant(new_tenant, new_tenant)
+    database.get_all_tenants()
+    user.post('/logout')
+
+    # Refused tokens, and the periodic sweep of buckets and leases
+    now = time.time()
+    for _ in range(2):
+        database.take_rate_limit_tokens('plan:refused', 1, 1, 0.001, now)
+    database.prune_rate_limits(now - 60, now)
+
+
+def explain(statement):
+    with database.get_db() as conn:
+        return [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {statement}')]
+
+
+class TestQueryPlans:
+    def test_no_full_scans_or_temp_sorts(self, traced_statements):
+        run_workload()
+        database.close_all_connections()
+
+        checked = set()
+        problems = []
+        for statement in traced_statements:
+            sql = ' '.join(statement.split())
+            if not sql.upper().startswith(_PLANNED_STATEMENTS) or sql in checked or sql in FULL_LISTINGS:
+                continue
+            if sql.upper().startswith('SELECT') and 'FROM' not in sql.upper():
+                continue
+            checked.add(sql)
+            for detail in explain(sql):
+                match = _SCAN_RE.match(detail)
+                if match and match.group(1) not in SMALL_TABLES:
+                    problems.append(f'{detail}: {sql}')
+                if 'TEMP B-TREE' in detail:
+                    problems.append(f'{detail}: {sql}')
+
+        assert len(checked) > 20  # the workload really went through the app
+        assert problems == []
@@ -0,0 +1,118 @@
+# tests/test_rate_limiter.py
+import pytest
+import sys
+import os
+import tempfile
+import threading
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from rate_limiter import RateLimit, RateLimiter, TenantAdmission, client_address
+
+
+class TestRateLimit:
+    def test_parse(self):
+        assert RateLimit.parse('10/minute') == RateLimit(capacity=10, period=60)
+        assert RateLimit.parse(' 5 / seconds ') == RateLimit(capacity=5, period=1)
+        assert RateLimit.parse('120/hour').rate == pytest.approx(120 / 3600)
+
+    @pytest.mark.parametrize('text', ['10', '0/minute', 'ten/minute', '10/fortnight'])
+    def test_parse_rejects_invalid(self, text):
+        with pytest.raises(ValueError):
+            RateLimit.parse(text)
+
+    def test_client_address(self):
+        assert client_address('10.0.0.1', '1.1.1.1, 2.2.2.2', 0) == '10.0.0.1'
+        # Only the entry added by the trusted proxy counts, not what the client sent
+        assert client_address('10.0.0.1', 'spoofed, 2.2.2.2', 1) == '2.2.2.2'
+        assert client_address('10.0.0.1', None, 1) == '10.0.0.1'
+
+
+class TestSharedBuckets:
+    def setup_method(self):
+        self.test_db = tempfile.NamedTemporaryFile(delete=False, suffix='.db')
+        self.test_db.close()
+        self.original_db = database.DATABASE
+        database.DATABASE = self.test_db.name
+        database.init_db()
+
+    def teardown_method(self):
+        database.close_all_connections()
+        database.DATABASE = self.original_db
+        os.unlink(self.test_db.name)
+
+    def test_bucket_refills_over_time(self, monkeypatch):
+        import rate_limiter
+        clock = [1000.0]
+        monkeypatch.setattr(rate_limiter.time, 'time', lambda: clock[0])
+        limiter = RateLimiter({'login': RateLimit(capacity=3, period=60)})
+        assert [limiter.hit('login', 'a').allowed for _ in range(4)] == [True, True, True, False]
+        denied = limiter.hit('login', 'a')
+        assert denied.retry_after == 20
+        # Other keys have their own bucket
+        assert limiter.hit('login', 'b').allowed
+        clock[0] += 20
+        assert limiter.hit('login', 'a').allowed
+        assert not limiter.hit('login', 'a').allowed
+
+    def test_oversized_cost_waits_for_a_full_bucket(self):
+        limiter = RateLimiter({'calculate': RateLimit(capacity=5, period=60)})
+        assert limiter.hit('calculate', 1, cost=50).allowed
+        decision = limiter.hit('calculate', 1, cost=50)
+        assert not decision.allowed
+        assert 1 <= decision.retry_after <= 60
+
+    def test_concurrent_hits_never_overspend(self):
+        limiter = RateLimiter({'login': RateLimit(capacity=25, period=3600)})
+        allowed = []
+
+        def worker():
+            for _ in range(10):
+                allowed.append(limiter.hit('login', 'shared').allowed)
+            database.close_db()
+
+        threads = [threading.Thread(target=worker) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert allowed.count(True) == 25
+
+    def test_sweep_drops_refilled_buckets_and_expired_leases(self, monkeypatch):
+        import rate_limiter
+        clock = [1000.0]
+        monkeypatch.setattr(rate_limiter.time, 'time', lambda: clock[0])
+        limiter = RateLimiter({'login': RateLimit(capacity=3, period=60)}, sweep_interval=0)
+        limiter.hit('login', 'old')
+        TenantAdmission(max_inflight=1, lease_seconds=5).acquire(1)
+        clock[0] += 61
+        limiter.hit('login', 'new')
+        with database.get_db() as conn:
+            assert [row[0] for row in conn.execute('SELECT key FROM rate_limit_buckets')] == ['login:new']
+            assert conn.execute('SELECT COUNT(*) FROM admission_leases').fetchone()[0] == 0
+
+    def test_admission_quota_per_tenant(self, monkeypatch):
+        import rate_limiter
+        clock = [1000.0]
+        monkeypatch.setattr(rate_limiter.time, 'time', lambda: clock[0])
+        admission = TenantAdmission(max_inflight=2, lease_seconds=30)
+        first, second = admission.acquire(1), admission.acquire(1)
+        assert first is not None and second is not None
+        assert admission.acquire(1) is None
+        # Another tenant is unaffected
+        assert admission.acquire(2) is not None
+        admission.release(first)
+        assert admission.acquire(1) is not None
+        # Leases of a crashed worker stop counting once they expire
+        clock[0] += 31
+        assert admission.acquire(1) is not None
+
+    def test_other_database_errors_are_not_swallowed(self, monkeypatch):
+        import sqlite3
+
+        def broken(*args):
+            raise sqlite3.OperationalError('no such table: rate_limit_buckets')
+        monkeypatch.setattr(database, 'take_rate_limit_tokens', broken)
+        limiter = RateLimiter({'login': RateLimit(capacity=3, period=60)})
+        with pytest.raises(sqlite3.OperationalError):
+            limiter.hit('login', 'a')
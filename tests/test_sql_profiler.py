@@ -0,0 +1,53 @@
+# tests/test_sql_profiler.py
+import pytest
+import sys
+import os
+import logging
+import sqlite3
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sql_profiler
+from sql_profiler import ProfilingConnection, SQLProfiler, normalize_sql
+
+
+class TestSQLProfiler:
+    def setup_method(self):
+        self.profiler = SQLProfiler(slow_query_ms=10_000)
+        self.original = sql_profiler.profiler
+        sql_profiler.profiler = self.profiler
+        self.conn = sqlite3.connect(':memory:', factory=ProfilingConnection)
+        self.conn.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)')
+        self.conn.executemany('INSERT INTO items (name) VALUES (?)', [('a',), ('b',), ('c',)])
+
+    def teardown_method(self):
+        sql_profiler.profiler = self.original
+        self.conn.close()
+
+    def stats_for(self, prefix):
+        return next(s for s in self.profiler.top(50) if s['sql'].startswith(prefix))
+
+    def test_counts_executions_and_rows(self):
+        for _ in range(2):
+            self.conn.execute('SELECT * FROM items WHERE id > ?', (0,)).fetchall()
+        for row in self.conn.execute('SELECT name FROM items'):
+            pass
+        stats = self.stats_for('SELECT * FROM items')
+        assert stats['count'] == 2
+        assert stats['rows'] == 6
+        assert self.stats_for('SELECT name FROM items')['rows'] == 3
+        assert self.stats_for('INSERT INTO items')['rows'] == 3
+
+    def test_normalize_sql(self):
+        assert normalize_sql("SELECT *\n  FROM t WHERE a = 5 AND b = 'x'") == 'SELECT * FROM t WHERE a = ? AND b = ?'
+
+    def test_slow_query_logged_with_plan(self, caplog):
+        self.profiler.slow_query_ms = 0
+        with caplog.at_level(logging.WARNING, logger='calculator.sql'):
+            self.conn.execute('SELECT name FROM items WHERE id = ?', (1,)).fetchone()
+        assert self.profiler.slow_queries >= 1
+        assert any('SEARCH items USING INTEGER PRIMARY KEY' in r.getMessage() for r in caplog.records)
+
+    def test_top_sorted_by_count(self):
+        for _ in range(3):
+            self.conn.execute('SELECT 1').fetchone()
+        assert self.profiler.top(1, sort='count')[0]['sql'] == 'SELECT ?'